@@ -0,0 +1,246 @@
+"""Admission control in front of the upstream call.
+
+BIG_MODEL and SMALL_MODEL each get a gate with a concurrency cap and a
+bounded priority queue; every other model passed through shares one more
+gate, so client-chosen model names cannot grow the set of gates. Requests over the
+cap wait in the queue, interactive (small model) traffic ahead of long big
+model jobs, and give up after a queue-time deadline. When the queue is full a
+request is rejected at once, unless it outranks the lowest-priority waiter,
+which is then rejected in its place. Under a burst the proxy therefore sends
+Gemini a steady number of calls and sheds the excess quickly instead of
+turning it into a wave of upstream 429s and retries.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Lower value = served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BATCH: "batch"}
+
+# Gate shared by all models without a configured cap
+OTHER_MODELS_GATE = "other"
+
+# Weight of the newest sample in the service time average
+SERVICE_TIME_ALPHA = 0.2
+
+
+class AdmissionRejected(Exception):
+    """A request was not admitted: the queue is full or its queue deadline passed."""
+
+    def __init__(self, model: str, reason: str, retry_after: float):
+        super().__init__(f"{model} is overloaded ({reason}), retry after {retry_after:.0f}s")
+        self.model = model
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "future", "removed")
+
+    def __init__(self, priority: int, seq: int, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.removed = False
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AdmissionPermit:
+    """One admitted request's slot; release exactly once."""
+
+    def __init__(self, gate: "ModelGate"):
+        self._gate = gate
+        self._acquired_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self._gate._release(time.monotonic() - self._acquired_at)
+
+    def hold(self, stream: AsyncIterator[Any]) -> "PermitStream":
+        """Wrap ``stream`` so the slot stays taken until the stream ends or is closed."""
+        return PermitStream(stream, self)
+
+
+class PermitStream:
+    """Async iterator that releases its permit when exhausted, closed or collected.
+
+    A plain async generator would leak the slot if the response was never
+    iterated (client gone before the body started), since its ``finally``
+    only runs once iteration has begun.
+    """
+
+    def __init__(self, stream: AsyncIterator[Any], permit: AdmissionPermit):
+        self._stream = stream
+        self._permit = permit
+
+    def __aiter__(self) -> "PermitStream":
+        return self
+
+    async def __anext__(self) -> Any:
+        try:
+            return await self._stream.__anext__()
+        except BaseException:
+            self._permit.release()
+            raise
+
+    async def aclose(self):
+        try:
+            aclose = getattr(self._stream, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        finally:
+            self._permit.release()
+
+    def __del__(self):
+        self._permit.release()
+
+
+class ModelGate:
+    """Concurrency cap plus bounded priority queue for one upstream model."""
+
+    def __init__(self, model: str, max_concurrency: int, max_queue: int, queue_timeout: float):
+        self.model = model
+        self.max_concurrency = max(max_concurrency, 1)
+        self.max_queue = max(max_queue, 0)
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        self.queued = 0
+        self._heap: List[_Waiter] = []
+        self._seq = itertools.count()
+        self.service_time = 0.0
+        self.admitted = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+        self.evicted = 0
+
+    def retry_after(self) -> float:
+        """Rough time until a new request could be served (whole seconds, at least 1)."""
+        backlog = (self.queued + 1) / self.max_concurrency
+        return float(max(1, math.ceil(self.service_time * backlog)))
+
+    async def acquire(self, priority: int = PRIORITY_BATCH) -> AdmissionPermit:
+        if self.active < self.max_concurrency and not self.queued:
+            self.active += 1
+            self.admitted += 1
+            return AdmissionPermit(self)
+
+        if self.queued >= self.max_queue:
+            victim = self._lowest_priority_waiter()
+            if victim is None or victim.priority <= priority:
+                self.rejected_full += 1
+                raise AdmissionRejected(self.model, "queue full", self.retry_after())
+            # Make room for more urgent traffic at the expense of the least urgent waiter
+            self._remove(victim)
+            self.evicted += 1
+            victim.future.set_exception(AdmissionRejected(self.model, "displaced by higher priority", self.retry_after()))
+
+        waiter = _Waiter(priority, next(self._seq), asyncio.get_running_loop().create_future())
+        heapq.heappush(self._heap, waiter)
+        self.queued += 1
+        queued_at = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.future.done():
+                self._remove(waiter)
+                self.rejected_timeout += 1
+                raise AdmissionRejected(self.model, "queue timeout", self.retry_after())
+        except asyncio.CancelledError:
+            # Client went away while queued; pass on a slot that was already handed over
+            if not waiter.future.done():
+                self._remove(waiter)
+            elif waiter.future.exception() is None:
+                AdmissionPermit(self).release()
+            raise
+
+        waiter.future.result()  # raises AdmissionRejected when displaced
+        self.admitted += 1
+        self.waited += 1
+        self.total_wait += time.monotonic() - queued_at
+        return AdmissionPermit(self)
+
+    def _lowest_priority_waiter(self) -> Optional[_Waiter]:
+        live = [waiter for waiter in self._heap if not waiter.removed]
+        return max(live) if live else None
+
+    def _remove(self, waiter: _Waiter):
+        waiter.removed = True
+        self.queued -= 1
+        # Removed waiters are skipped lazily; compact when they pile up
+        if len(self._heap) > 2 * self.queued + 16:
+            self._heap = [w for w in self._heap if not w.removed]
+            heapq.heapify(self._heap)
+
+    def _release(self, held_for: float):
+        self.service_time += SERVICE_TIME_ALPHA * (held_for - self.service_time)
+        while self._heap:
+            waiter = heapq.heappop(self._heap)
+            if waiter.removed:
+                continue
+            # Hand the slot straight to the next waiter; ``active`` stays the same
+            waiter.removed = True
+            self.queued -= 1
+            waiter.future.set_result(True)
+            return
+        self.active = max(self.active - 1, 0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "active": self.active,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "admitted": self.admitted,
+            "rejected_queue_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+            "displaced": self.evicted,
+            "avg_queue_wait_ms": round(self.total_wait / self.waited * 1000, 1) if self.waited else 0.0,
+            "avg_service_time_s": round(self.service_time, 2),
+        }
+
+
+class AdmissionController:
+    """Per-model gates; models without a configured cap share one gate with the default cap."""
+
+    def __init__(self, model_limits: Dict[str, int], default_concurrency: int,
+                 max_queue: int = 64, queue_timeout: float = 30.0):
+        self.model_limits = dict(model_limits)
+        self.default_concurrency = default_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.gates: Dict[str, ModelGate] = {}
+
+    def gate(self, model: str) -> ModelGate:
+        if model not in self.model_limits:
+            model = OTHER_MODELS_GATE
+        gate = self.gates.get(model)
+        if gate is None:
+            limit = self.model_limits.get(model, self.default_concurrency)
+            gate = ModelGate(model, limit, self.max_queue, self.queue_timeout)
+            self.gates[model] = gate
+        return gate
+
+    async def acquire(self, model: str, priority: int = PRIORITY_BATCH) -> AdmissionPermit:
+        return await self.gate(model).acquire(priority)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": True,
+            "queue_timeout": self.queue_timeout,
+            "models": {model: gate.stats() for model, gate in self.gates.items()},
+        }
@@ -0,0 +1,504 @@
+"""End-to-end benchmark: the proxy in front of a local mock Gemini server.
+
+Starts benchmarks/mock_gemini.py and the proxy (uvicorn server:app, pointed at
+the mock through GEMINI_BASE_URL) as subprocesses, then drives /v1/messages and
+/v1/messages/count_tokens with Claude Code-shaped payloads (long tool-use
+histories, many tools, images) at several concurrency levels.
+
+Per scenario and concurrency level it reports requests/sec, p50/p99 latency
+and time to first token, the latency the proxy adds on top of the mock's own
+(fixed) timing, proxy CPU time per request and proxy RSS growth per concurrent
+stream. Results are JSON so runs can be compared:
+
+    python benchmarks/bench_e2e.py --output before.json
+    python benchmarks/bench_e2e.py --output after.json --compare before.json
+
+Usage: python benchmarks/bench_e2e.py [--engine litellm|native] [--workers N] [--scenarios a,b]
+           [--concurrency 1,8,32] [--requests 64] [--json] [--output FILE] [--compare FILE]
+           [mock options: --chunks --chunk-chars --ttft-ms --chunk-interval-ms --latency-ms --tool-calls]
+
+Proxy settings can be overridden through the environment (e.g. HEDGING=true).
+With --workers N the proxy runs as N worker processes (WORKERS) and its CPU
+and memory figures are summed over the supervisor and workers.
+CPU and memory figures need Linux /proc.
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from mock_gemini import MockSettings, settings_from_args
+
+FAKE_API_KEY = "AIza" + "B" * 35
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+# Claude Code-shaped payloads
+def tool_definitions(count: int):
+    tools = []
+    for i in range(count):
+        tools.append({
+            "name": f"Tool{i}",
+            "description": f"Tool number {i}. " + "Reads, edits or searches files in the workspace. " * 6,
+            "input_schema": {
+                "$schema": "http://json-schema.org/draft-07/schema#",
+                "type": "object",
+                "additionalProperties": False,
+                "properties": {
+                    "file_path": {"type": "string", "description": "Absolute path to the file"},
+                    "offset": {"type": "integer", "minimum": 0},
+                    "limit": {"type": "integer", "exclusiveMinimum": 0},
+                    "mode": {"type": "string", "enum": ["read", "write", "append"], "default": "read"},
+                    "edits": {
+                        "type": "array",
+                        "items": {
+                            "type": "object",
+                            "properties": {"old_string": {"type": "string"}, "new_string": {"type": "string"}},
+                            "required": ["old_string", "new_string"],
+                        },
+                    },
+                },
+                "required": ["file_path"],
+            },
+        })
+    return tools
+
+
+def image_block(size_kb: int, seed: int):
+    data = random.Random(seed).randbytes(size_kb * 1024)
+    return {"type": "image", "source": {"type": "base64", "media_type": "image/png",
+                                        "data": base64.b64encode(data).decode("ascii")}}
+
+
+def history(turns: int, tool_count: int):
+    """Alternating user / assistant tool_use / user tool_result turns, like an agent session."""
+    file_contents = "def handler(event):\n    return {'status': 200, 'body': event}\n" * 20
+    messages = [{"role": "user", "content": "Refactor the request handlers and keep the tests passing."}]
+    for turn in range(turns):
+        tool_id = f"toolu_{turn:04d}"
+        messages.append({"role": "assistant", "content": [
+            {"type": "text", "text": f"Step {turn}: looking at the next file."},
+            {"type": "tool_use", "id": tool_id, "name": f"Tool{turn % max(tool_count, 1)}",
+             "input": {"file_path": f"/src/module_{turn}.py", "limit": 200}},
+        ]})
+        messages.append({"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": tool_id, "content": file_contents},
+        ]})
+    return messages
+
+
+def system_prompt():
+    return [
+        {"type": "text", "text": "You are an interactive CLI coding agent. " * 150},
+        {"type": "text", "text": "Environment: linux, git repository, python 3.12. " * 20,
+         "cache_control": {"type": "ephemeral"}},
+    ]
+
+
+class Scenario:
+    def __init__(self, name: str, path: str, stream: bool, turns: int = 0, tools: int = 0,
+                 images: int = 0, image_kb: int = 256, system: bool = True):
+        self.name = name
+        self.path = path
+        self.stream = stream
+        self.turns = turns
+        self.tools = tools
+        self.images = images
+        self.image_kb = image_kb
+        self.system = system
+        self._base = None
+
+    def base_payload(self):
+        if self._base is None:
+            messages = history(self.turns, self.tools)
+            if self.images:
+                first = messages[0]
+                first["content"] = [{"type": "text", "text": first["content"]}] + [
+                    image_block(self.image_kb, seed) for seed in range(self.images)
+                ]
+            self._base = {"model": "claude-sonnet-4-20250514", "max_tokens": 4096, "messages": messages}
+            if self.system:
+                self._base["system"] = system_prompt()
+            if self.tools:
+                self._base["tools"] = tool_definitions(self.tools)
+        return self._base
+
+    def payload(self, request_no: int) -> bytes:
+        """Same history every time (as in a long session), new last user turn per request."""
+        base = self.base_payload()
+        payload = dict(base, messages=base["messages"] + [
+            {"role": "assistant", "content": "Done with that step."},
+            {"role": "user", "content": f"Next task #{request_no}: continue with the refactor."},
+        ])
+        if self.path == "/v1/messages":
+            payload["stream"] = self.stream
+        else:
+            payload.pop("max_tokens")
+        return json.dumps(payload).encode()
+
+
+SCENARIOS = {
+    scenario.name: scenario for scenario in (
+        Scenario("stream_short", "/v1/messages", stream=True, system=False),
+        Scenario("stream_agent", "/v1/messages", stream=True, turns=60, tools=40),
+        Scenario("nonstream_agent", "/v1/messages", stream=False, turns=60, tools=40),
+        Scenario("stream_images", "/v1/messages", stream=True, turns=10, tools=20, images=2),
+        Scenario("count_tokens_agent", "/v1/messages/count_tokens", stream=False, turns=60, tools=40),
+    )
+}
+
+
+# Process helpers
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def child_pids(pid: int):
+    """Direct children of ``pid`` (the workers, when the proxy runs with WORKERS > 1)."""
+    children = []
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else ():
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                if int(f.read().rsplit(")", 1)[1].split()[1]) == pid:
+                    children.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return children
+
+
+def process_cpu_seconds(pid: int):
+    """CPU time of ``pid`` and its children (a worker supervisor and its workers)."""
+    total = None
+    for process in [pid] + child_pids(pid):
+        try:
+            with open(f"/proc/{process}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            total = (total or 0) + (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
+
+
+def process_rss_kb(pid: int):
+    """RSS of ``pid`` and its children."""
+    total = None
+    for process in [pid] + child_pids(pid):
+        try:
+            with open(f"/proc/{process}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total = (total or 0) + int(line.split()[1])
+        except OSError:
+            continue
+    return total
+
+
+async def wait_until_up(url: str, timeout: float = 120.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:.0f}s")
+
+
+def start_processes(args, mock: MockSettings):
+    mock_port, proxy_port = free_port(), free_port()
+    mock_cmd = [sys.executable, os.path.join(BENCH_DIR, "mock_gemini.py"), "--port", str(mock_port),
+                "--chunks", str(mock.chunks), "--chunk-chars", str(mock.chunk_chars),
+                "--ttft-ms", str(mock.ttft_ms), "--chunk-interval-ms", str(mock.chunk_interval_ms),
+                "--latency-ms", str(mock.latency_ms), "--tool-calls", str(mock.tool_calls)]
+    max_concurrency = str(max(args.concurrency) * 2)
+    env = dict(os.environ)
+    env.update({"GEMINI_API_KEY": FAKE_API_KEY, "GEMINI_BASE_URL": f"http://127.0.0.1:{mock_port}",
+                "UPSTREAM_ENGINE": args.engine})
+    # Keep the proxy's own limits out of the way unless the caller sets them
+    for name, value in (("LOG_LEVEL", "WARNING"), ("LITELLM_LOCAL_MODEL_COST_MAP", "True"),
+                        ("BIG_MODEL_MAX_CONCURRENCY", max_concurrency),
+                        ("SMALL_MODEL_MAX_CONCURRENCY", max_concurrency),
+                        ("OTHER_MODEL_MAX_CONCURRENCY", max_concurrency),
+                        ("ADMISSION_MAX_QUEUE", max_concurrency)):
+        env.setdefault(name, value)
+    if args.workers > 1:
+        # Multi-worker mode is started by server.py's own supervisor
+        env.update({"WORKERS": str(args.workers), "HOST": "127.0.0.1", "PORT": str(proxy_port)})
+        proxy_cmd = [sys.executable, "server.py"]
+    else:
+        proxy_cmd = [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+                     "--port", str(proxy_port), "--log-level", "warning"]
+    output = None if args.verbose else subprocess.DEVNULL
+    mock_process = subprocess.Popen(mock_cmd, stdout=output, stderr=output)
+    proxy_process = subprocess.Popen(proxy_cmd, cwd=REPO_DIR, env=env, stdout=output, stderr=output)
+    return mock_process, proxy_process, f"http://127.0.0.1:{mock_port}", f"http://127.0.0.1:{proxy_port}"
+
+
+# Load generation
+def percentile(values, pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(max(int(round(pct / 100 * len(ordered) + 0.5)) - 1, 0), len(ordered) - 1)
+    return round(ordered[index], 2)
+
+
+async def one_request(client: httpx.AsyncClient, scenario: Scenario, request_no: int):
+    """Returns (latency_ms, ttft_ms or None, ok)."""
+    body = scenario.payload(request_no)
+    headers = {"content-type": "application/json"}
+    start = time.perf_counter()
+    ttft = None
+    if scenario.stream:
+        async with client.stream("POST", scenario.path, content=body, headers=headers) as response:
+            async for chunk in response.aiter_bytes():
+                if ttft is None and b"content_block_delta" in chunk:
+                    ttft = (time.perf_counter() - start) * 1000
+            ok = response.status_code == 200
+    else:
+        response = await client.post(scenario.path, content=body, headers=headers)
+        ok = response.status_code == 200
+    return (time.perf_counter() - start) * 1000, ttft, ok
+
+
+async def calibrate_mock(mock_url: str, scenario: Scenario, samples: int):
+    """Median (latency_ms, ttft_ms) of the mock on its own, subtracted to get the proxy's added latency.
+
+    Measured rather than taken from the settings: timer overshoot on every
+    chunk interval adds up over a stream.
+    """
+    if scenario.path != "/v1/messages":
+        return 0.0, 0.0
+    method = "streamGenerateContent?alt=sse" if scenario.stream else "generateContent"
+    body = {"contents": [{"role": "user", "parts": [{"text": "calibrate"}]}]}
+    latencies, ttfts = [], []
+    async with httpx.AsyncClient(base_url=mock_url, timeout=120) as client:
+        for _ in range(samples):
+            start = time.perf_counter()
+            ttft = None
+            async with client.stream("POST", f"/v1beta/models/gemini-2.5-pro:{method}", json=body) as response:
+                async for _ in response.aiter_bytes():
+                    if ttft is None:
+                        ttft = (time.perf_counter() - start) * 1000
+            latencies.append((time.perf_counter() - start) * 1000)
+            ttfts.append(ttft or 0.0)
+    return percentile(latencies, 50), percentile(ttfts, 50)
+
+
+async def sample_rss(pid: int, peak: list, stop: asyncio.Event):
+    while not stop.is_set():
+        rss = process_rss_kb(pid)
+        if rss is not None:
+            peak[0] = max(peak[0], rss)
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=0.02)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_level(client, scenario: Scenario, concurrency: int, total: int, pid: int, baseline,
+                    counter: list):
+    latencies, ttfts, errors = [], [], 0
+    queue = asyncio.Queue()
+    for _ in range(total):
+        counter[0] += 1
+        queue.put_nowait(counter[0])
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            request_no = queue.get_nowait()
+            try:
+                latency, ttft, ok = await one_request(client, scenario, request_no)
+            except httpx.HTTPError:
+                errors += 1
+                continue
+            if not ok:
+                errors += 1
+                continue
+            latencies.append(latency)
+            if ttft is not None:
+                ttfts.append(ttft)
+
+    rss_before = process_rss_kb(pid)
+    cpu_before = process_cpu_seconds(pid)
+    peak = [rss_before or 0]
+    stop = asyncio.Event()
+    sampler = asyncio.ensure_future(sample_rss(pid, peak, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - start
+    stop.set()
+    await sampler
+    cpu_after = process_cpu_seconds(pid)
+
+    mock_latency, mock_ttft = baseline
+    completed = len(latencies)
+    row = {
+        "scenario": scenario.name,
+        "concurrency": concurrency,
+        "requests": completed,
+        "errors": errors,
+        "request_bytes": len(scenario.payload(0)),
+        "rps": round(completed / wall, 2) if wall > 0 else None,
+        "latency_p50_ms": percentile(latencies, 50),
+        "latency_p99_ms": percentile(latencies, 99),
+        "mock_latency_ms": mock_latency,
+        "added_latency_p50_ms": percentile([l - mock_latency for l in latencies], 50),
+        "added_latency_p99_ms": percentile([l - mock_latency for l in latencies], 99),
+    }
+    if scenario.stream:
+        row["ttft_p50_ms"] = percentile(ttfts, 50)
+        row["ttft_p99_ms"] = percentile(ttfts, 99)
+        row["mock_ttft_ms"] = mock_ttft
+        row["added_ttft_p50_ms"] = percentile([t - mock_ttft for t in ttfts], 50)
+        row["added_ttft_p99_ms"] = percentile([t - mock_ttft for t in ttfts], 99)
+    if cpu_before is not None and cpu_after is not None and completed:
+        row["cpu_ms_per_request"] = round((cpu_after - cpu_before) * 1000 / completed, 3)
+    if rss_before is not None:
+        row["rss_peak_mb"] = round(peak[0] / 1024, 1)
+        if scenario.stream:
+            row["memory_per_stream_kb"] = round(max(peak[0] - rss_before, 0) / concurrency, 1)
+    return row
+
+
+async def run_suite(args, mock: MockSettings):
+    mock_process, proxy_process, mock_url, proxy_url = start_processes(args, mock)
+    try:
+        await wait_until_up(f"{mock_url}/mock/stats")
+        await wait_until_up(f"{proxy_url}/health")
+        limits = httpx.Limits(max_connections=max(args.concurrency) * 2, max_keepalive_connections=max(args.concurrency))
+        counter = [0]
+        rows = []
+        async with httpx.AsyncClient(base_url=proxy_url, limits=limits, timeout=120) as client:
+            for name in args.scenarios:
+                scenario = SCENARIOS[name]
+                baseline = await calibrate_mock(mock_url, scenario, args.calibration)
+                await run_level(client, scenario, 1, args.warmup, proxy_process.pid, baseline, counter)
+                for concurrency in args.concurrency:
+                    total = max(args.requests, concurrency)
+                    row = await run_level(client, scenario, concurrency, total, proxy_process.pid, baseline, counter)
+                    rows.append(row)
+                    if not args.json:
+                        print_row(row)
+        return rows
+    finally:
+        for process in (proxy_process, mock_process):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+# Reporting
+COLUMNS = ("rps", "added_latency_p50_ms", "added_latency_p99_ms", "added_ttft_p50_ms", "cpu_ms_per_request",
+           "memory_per_stream_kb")
+
+
+def print_row(row):
+    if not getattr(print_row, "header_done", False):
+        print(f"{'scenario':<20} {'conc':>4} {'ok/err':>9} " + " ".join(f"{c:>22}" for c in COLUMNS))
+        print_row.header_done = True
+    values = " ".join(f"{'-' if row.get(c) is None else row[c]:>22}" for c in COLUMNS)
+    print(f"{row['scenario']:<20} {row['concurrency']:>4} {row['requests']:>5}/{row['errors']:<3} {values}")
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def compare(results, baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = {(row["scenario"], row["concurrency"]): row for row in json.load(f)["results"]}
+    print(f"\nChange vs {baseline_path} (negative is better except rps):")
+    for row in results["results"]:
+        before = baseline.get((row["scenario"], row["concurrency"]))
+        if before is None:
+            continue
+        deltas = []
+        for column in COLUMNS:
+            if row.get(column) is not None and before.get(column):
+                deltas.append(f"{column} {100 * (row[column] - before[column]) / abs(before[column]):+.1f}%")
+        print(f"  {row['scenario']:<20} c={row['concurrency']:<4} " + ", ".join(deltas))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="End-to-end proxy benchmark against a mock Gemini server")
+    parser.add_argument("--engine", choices=("litellm", "native"), default=os.environ.get("UPSTREAM_ENGINE", "native"))
+    parser.add_argument("--workers", type=int, default=int(os.environ.get("WORKERS", "1")),
+                        help="proxy worker processes (WORKERS)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--requests", type=int, default=64, help="requests per scenario and concurrency level")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--calibration", type=int, default=10, help="direct mock requests per scenario")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON only")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    parser.add_argument("--compare", help="earlier JSON results to diff against")
+    parser.add_argument("--verbose", action="store_true", help="show proxy and mock output")
+    parser.add_argument("--chunks", type=int, default=50)
+    parser.add_argument("--chunk-chars", type=int, default=40)
+    parser.add_argument("--ttft-ms", type=float, default=200)
+    parser.add_argument("--chunk-interval-ms", type=float, default=10)
+    parser.add_argument("--latency-ms", type=float, default=500)
+    parser.add_argument("--tool-calls", type=int, default=1)
+    args = parser.parse_args()
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios {unknown}, choose from {list(SCENARIOS)}")
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+    return args
+
+
+def main():
+    args = parse_args()
+    mock = settings_from_args(args)
+    rows = asyncio.run(run_suite(args, mock))
+    results = {
+        "meta": {
+            "revision": git_revision(),
+            "engine": args.engine,
+            "workers": args.workers,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "mock": mock.as_dict(),
+        },
+        "results": rows,
+    }
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
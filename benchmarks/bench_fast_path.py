@@ -0,0 +1,161 @@
+"""Microbenchmark: strict vs fast request path (FAST_PATH) in-process.
+
+Uses the Claude Code-shaped payloads from bench_e2e.py (same history every
+request, new last turn) and times, per request:
+
+* parse: strict is json.loads + pydantic validation into MessagesRequest /
+  TokenCountRequest; fast is fast_request.parse_request (orjson if installed)
+  + model mapping;
+* convert: the configured engine's request conversion (conversation cache on,
+  as in a running proxy);
+* respond: strict is FastAPI's jsonable_encoder + JSONResponse for a returned
+  MessagesResponse; fast is fast_json_response.
+
+Before timing it checks that both paths produce the same upstream request.
+For the end-to-end effect, run bench_e2e.py with FAST_PATH=all in the
+environment and compare against a run without it.
+
+Usage: python benchmarks/bench_fast_path.py [--engine native|litellm] [--scenarios a,b]
+           [--requests 200] [--json]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_e2e import FAKE_API_KEY, SCENARIOS, percentile
+
+DEFAULT_SCENARIOS = "nonstream_agent,stream_images,count_tokens_agent"
+
+
+def sample_response(server):
+    return server.MessagesResponse(
+        id="msg_0123456789abcdef01234567",
+        model="claude-sonnet-4-20250514",
+        content=[
+            server.ContentBlockText(type="text", text="I'll update the handler and rerun the tests. " * 20),
+            server.ContentBlockToolUse(type="tool_use", id="toolu_0001", name="Tool1",
+                                       input={"file_path": "/src/module_1.py", "edits": [
+                                           {"old_string": "return event", "new_string": "return dict(event)"}]}),
+        ],
+        stop_reason="tool_use",
+        usage=server.Usage(input_tokens=52000, output_tokens=240),
+    )
+
+
+def strict_steps(server, model_class):
+    from fastapi.encoders import jsonable_encoder
+
+    def parse(body: bytes):
+        return model_class.model_validate(json.loads(body.decode("utf-8")))
+
+    def respond(response):
+        return server.JSONResponse(jsonable_encoder(response)).body
+    return parse, respond
+
+
+def fast_steps(server, model_class):
+    def parse(body: bytes):
+        return server.parse_trusted_body(body, model_class)
+
+    def respond(response):
+        return server.fast_json_response(response).body
+    return parse, respond
+
+
+def convert_for(server):
+    if server.native_client is not None:
+        return server.convert_anthropic_to_gemini
+    return server.convert_anthropic_to_litellm
+
+
+def check_equivalent(server, scenario, model_class):
+    body = scenario.payload(0)
+    strict = strict_steps(server, model_class)[0](body)
+    fast = fast_steps(server, model_class)[0](body)
+    if model_class is server.TokenCountRequest:
+        return server.message_cache_key(strict.messages[-1]) == server.message_cache_key(fast.messages[-1])
+    convert = convert_for(server)
+    return convert(strict) == convert(fast) and server.request_identity(strict) == server.request_identity(fast)
+
+
+def measure(server, scenario, steps, requests: int, offset: int):
+    parse, respond = steps
+    convert = convert_for(server)
+    response = sample_response(server)
+    timings = {"parse": [], "convert": [], "respond": [], "total": []}
+    for request_no in range(offset, offset + requests):
+        body = scenario.payload(request_no)
+        started = time.perf_counter()
+        request = parse(body)
+        parsed = time.perf_counter()
+        if scenario.path == "/v1/messages":
+            convert(request)
+        converted = time.perf_counter()
+        respond(response if scenario.path == "/v1/messages" else {"input_tokens": 52000})
+        finished = time.perf_counter()
+        for name, elapsed in (("parse", parsed - started), ("convert", converted - parsed),
+                              ("respond", finished - converted), ("total", finished - started)):
+            timings[name].append(elapsed * 1000)
+    return {name: percentile(values, 50) for name, values in timings.items()}
+
+
+def run(args):
+    os.environ.setdefault("GEMINI_API_KEY", FAKE_API_KEY)
+    os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["UPSTREAM_ENGINE"] = args.engine
+    import fast_request
+    import server
+
+    rows = []
+    for name in args.scenarios:
+        scenario = SCENARIOS[name]
+        model_class = server.MessagesRequest if scenario.path == "/v1/messages" else server.TokenCountRequest
+        if not check_equivalent(server, scenario, model_class):
+            raise SystemExit(f"{name}: strict and fast paths disagree on the converted request")
+        # Warm the conversation cache with the shared history, then alternate to even out drift
+        measure(server, scenario, strict_steps(server, model_class), 5, 1)
+        strict = measure(server, scenario, strict_steps(server, model_class), args.requests, 10)
+        fast = measure(server, scenario, fast_steps(server, model_class), args.requests, 10 + args.requests)
+        row = {"scenario": name, "body_kb": round(len(scenario.payload(0)) / 1024),
+               "strict_ms": strict, "fast_ms": fast,
+               "speedup": round(strict["total"] / fast["total"], 2) if fast["total"] else None}
+        rows.append(row)
+        if not args.json:
+            print(f"{name:<20} {row['body_kb']:>5}KB  strict {strict['total']:.2f}ms "
+                  f"(parse {strict['parse']:.2f} convert {strict['convert']:.2f} respond {strict['respond']:.3f})  "
+                  f"fast {fast['total']:.2f}ms (parse {fast['parse']:.2f} convert {fast['convert']:.2f} "
+                  f"respond {fast['respond']:.3f})  x{row['speedup']}")
+    return {"engine": args.engine, "decoder": "orjson" if fast_request.orjson is not None else "json",
+            "requests": args.requests, "results": rows}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Strict vs fast request path, in-process")
+    parser.add_argument("--engine", choices=("litellm", "native"), default=os.environ.get("UPSTREAM_ENGINE", "native"))
+    parser.add_argument("--scenarios", default=DEFAULT_SCENARIOS)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+    args.scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    return args
+
+
+def main():
+    results = run(parse_args())
+    if "--json" in sys.argv:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""Memory benchmark: peak proxy RSS per image-heavy request.
+
+Starts benchmarks/mock_gemini.py and the proxy like bench_e2e.py, then sends
+rounds of concurrent streaming requests that each carry their own base64
+images (distinct per request, so nothing is shared or deduplicated). For
+every round it samples the proxy's RSS and reports the peak growth over the
+idle baseline per request, and that growth divided by the request body size
+(roughly how many copies of the payload the proxy holds at once).
+
+The proxy runs with MALLOC_MMAP_THRESHOLD_ set so that glibc serves every
+large buffer with its own mapping and returns it on free. Without that,
+freed image buffers stay in the heap and later rounds would under-report.
+
+Usage: python benchmarks/bench_image_memory.py [--engine native|litellm] [--images 4]
+           [--image-kb 2048] [--concurrency 1,4] [--rounds 3] [--json] [--output FILE]
+Needs Linux /proc.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from bench_e2e import image_block, percentile, process_rss_kb, sample_rss, start_processes, wait_until_up
+from mock_gemini import MockSettings
+
+MMAP_THRESHOLD = str(128 * 1024)
+
+
+def payload(images: int, image_kb: int, seed: int) -> bytes:
+    content = [{"type": "text", "text": "What changed between these screenshots?"}]
+    content += [image_block(image_kb, seed * 1000 + index) for index in range(images)]
+    return json.dumps({
+        "model": "claude-sonnet-4-20250514", "max_tokens": 1024, "stream": True,
+        "messages": [{"role": "user", "content": content}],
+    }).encode()
+
+
+async def send(client: httpx.AsyncClient, body: bytes) -> bool:
+    async with client.stream("POST", "/v1/messages", content=body,
+                             headers={"content-type": "application/json"}) as response:
+        async for _ in response.aiter_bytes():
+            pass
+        return response.status_code == 200
+
+
+async def settle_rss(pid: int, seconds: float = 1.0) -> int:
+    """Idle RSS once the previous round's buffers have been released."""
+    await asyncio.sleep(seconds)
+    return process_rss_kb(pid) or 0
+
+
+async def run_level(client, pid: int, args, concurrency: int, seed: list):
+    rounds = []
+    errors = 0
+    for _ in range(args.rounds):
+        bodies = []
+        for _ in range(concurrency):
+            seed[0] += 1
+            bodies.append(payload(args.images, args.image_kb, seed[0]))
+        baseline = await settle_rss(pid)
+        peak = [baseline]
+        stop = asyncio.Event()
+        sampler = asyncio.ensure_future(sample_rss(pid, peak, stop))
+        results = await asyncio.gather(*(send(client, body) for body in bodies), return_exceptions=True)
+        stop.set()
+        await sampler
+        errors += sum(1 for ok in results if ok is not True)
+        rounds.append((peak[0] - baseline) / concurrency)
+    body_kb = len(bodies[0]) / 1024
+    growth_kb = percentile(rounds, 50)
+    return {
+        "concurrency": concurrency,
+        "rounds": args.rounds,
+        "errors": errors,
+        "request_body_kb": round(body_kb),
+        "peak_rss_per_request_kb": round(growth_kb),
+        "payload_copies": round(growth_kb / body_kb, 2) if body_kb else None,
+    }
+
+
+async def run(args):
+    mock = MockSettings(chunks=5, chunk_chars=40, ttft_ms=50, chunk_interval_ms=5, latency_ms=50)
+    os.environ.setdefault("MALLOC_MMAP_THRESHOLD_", MMAP_THRESHOLD)
+    mock_process, proxy_process, _, proxy_url = start_processes(args, mock)
+    try:
+        await wait_until_up(f"{proxy_url}/health")
+        async with httpx.AsyncClient(base_url=proxy_url, timeout=300) as client:
+            # Warm up imports, pools and the allocator with the same request shape
+            for _ in range(2):
+                await send(client, payload(args.images, args.image_kb, 0))
+            seed = [0]
+            rows = []
+            for concurrency in args.concurrency:
+                row = await run_level(client, proxy_process.pid, args, concurrency, seed)
+                rows.append(row)
+                if not args.json:
+                    print(f"c={row['concurrency']:<3} body={row['request_body_kb']}KB "
+                          f"peak RSS/request={row['peak_rss_per_request_kb']}KB "
+                          f"copies={row['payload_copies']} errors={row['errors']}")
+        return rows
+    finally:
+        for process in (proxy_process, mock_process):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except Exception:
+                process.kill()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Peak proxy RSS per image-heavy request")
+    parser.add_argument("--engine", choices=("litellm", "native"), default=os.environ.get("UPSTREAM_ENGINE", "native"))
+    parser.add_argument("--images", type=int, default=4, help="images per request")
+    parser.add_argument("--image-kb", type=int, default=2048, help="decoded size of each image")
+    parser.add_argument("--concurrency", default="1,4")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--output", help="also write the JSON results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show proxy and mock output")
+    args = parser.parse_args()
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+    return args
+
+
+def main():
+    args = parse_args()
+    rows = asyncio.run(run(args))
+    results = {"engine": args.engine, "images": args.images, "image_kb": args.image_kb,
+               "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()), "results": rows}
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Microbenchmark: per-chunk cost of decoding fragmented upstream streams.
+
+Compares IncrementalJSONDecoder against the previous rescan-from-zero buffer
+parser. The incremental decoder's per-chunk cost should stay flat as the stream
+(or a single fragmented object) grows; the legacy parser grows with the buffer.
+
+Usage: python benchmarks/bench_stream_decoder.py [--json]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from stream_decoder import IncrementalJSONDecoder
+
+
+def legacy_try_parse_buffered_chunk(buffer):
+    """The pre-decoder algorithm: rescan the whole buffer on every feed."""
+    if not buffer.strip():
+        return None, ""
+    brace_count = 0
+    start_pos = -1
+    for i, char in enumerate(buffer):
+        if char == '{':
+            if start_pos == -1:
+                start_pos = i
+            brace_count += 1
+        elif char == '}':
+            brace_count -= 1
+            if brace_count == 0 and start_pos != -1:
+                try:
+                    return json.loads(buffer[start_pos:i + 1]), buffer[i + 1:]
+                except json.JSONDecodeError:
+                    continue
+    return None, buffer
+
+
+def make_fragments(total_chars, fragment_size=16):
+    """One large chunk object (e.g. a long tool argument) split into small fragments."""
+    text = "x{y} " * (total_chars // 5)
+    payload = json.dumps({"choices": [{"delta": {"content": text}, "finish_reason": None}]})
+    return [payload[i:i + fragment_size] for i in range(0, len(payload), fragment_size)]
+
+
+def bench_incremental(fragments):
+    decoder = IncrementalJSONDecoder()
+    start = time.perf_counter()
+    decoded = 0
+    for fragment in fragments:
+        decoded += len(decoder.feed(fragment))
+    elapsed = time.perf_counter() - start
+    assert decoded == 1
+    return elapsed
+
+
+def bench_legacy(fragments):
+    buffer = ""
+    decoded = 0
+    start = time.perf_counter()
+    for fragment in fragments:
+        buffer += fragment
+        parsed, buffer = legacy_try_parse_buffered_chunk(buffer)
+        if parsed is not None:
+            decoded += 1
+    elapsed = time.perf_counter() - start
+    return elapsed
+
+
+def main():
+    results = []
+    for total_chars in (1_000, 4_000, 16_000, 64_000):
+        fragments = make_fragments(total_chars)
+        incremental = bench_incremental(fragments)
+        legacy = bench_legacy(fragments)
+        results.append({
+            "stream_chars": total_chars,
+            "chunks": len(fragments),
+            "incremental_us_per_chunk": round(incremental / len(fragments) * 1e6, 3),
+            "legacy_us_per_chunk": round(legacy / len(fragments) * 1e6, 3),
+        })
+
+    if "--json" in sys.argv:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'chars':>8} {'chunks':>7} {'incremental us/chunk':>22} {'legacy us/chunk':>17}")
+    for row in results:
+        print(f"{row['stream_chars']:>8} {row['chunks']:>7} "
+              f"{row['incremental_us_per_chunk']:>22} {row['legacy_us_per_chunk']:>17}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""Local mock of the Gemini REST API for end-to-end benchmarks.
+
+Serves ``generateContent``, ``streamGenerateContent`` (SSE), ``countTokens``,
+``cachedContents`` and Files API uploads for any model and API version, with a fixed and
+configurable response shape and timing, so the proxy's own overhead can be
+measured. Point the proxy at it with ``GEMINI_BASE_URL=http://127.0.0.1:<port>``.
+
+Usage: python benchmarks/mock_gemini.py [--port 8099] [--chunks 50] [--chunk-chars 40]
+           [--ttft-ms 200] [--chunk-interval-ms 10] [--latency-ms 500] [--tool-calls 0]
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+FILLER = "The quick brown fox {jumps} over the lazy dog; \"quoted\" text, code: x = [1, 2]\n"
+
+
+class MockSettings:
+    """Response shape and timing (the command line also reads MOCK_GEMINI_* environment variables)."""
+
+    def __init__(self, chunks: int = 50, chunk_chars: int = 40, ttft_ms: float = 200,
+                 chunk_interval_ms: float = 10, latency_ms: float = 500, tool_calls: int = 0):
+        self.chunks = max(chunks, 1)
+        self.chunk_chars = chunk_chars
+        self.ttft_ms = ttft_ms
+        self.chunk_interval_ms = chunk_interval_ms
+        self.latency_ms = latency_ms
+        self.tool_calls = tool_calls
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+def text_of(length: int, offset: int = 0) -> str:
+    repeated = FILLER * (length // len(FILLER) + 2)
+    start = offset % len(FILLER)
+    return repeated[start:start + length]
+
+
+def tool_call_parts(count: int):
+    return [
+        {"functionCall": {"name": f"Tool{i}", "args": {"file_path": f"/src/module_{i}.py", "limit": 200}}}
+        for i in range(count)
+    ]
+
+
+def usage(settings: MockSettings, request_bytes: int):
+    output_tokens = settings.chunks * max(settings.chunk_chars // 4, 1)
+    return {"promptTokenCount": request_bytes // 4, "candidatesTokenCount": output_tokens,
+            "totalTokenCount": request_bytes // 4 + output_tokens}
+
+
+def build_app(settings: MockSettings) -> Starlette:
+    stats = {"requests": 0, "streams": 0, "count_tokens": 0, "request_bytes": 0, "uploads": 0, "upload_bytes": 0}
+    pending_uploads = {}
+
+    async def generate(request: Request, method: str) -> Response:
+        body = await request.body()
+        stats["requests"] += 1
+        stats["request_bytes"] += len(body)
+        if method == "countTokens":
+            stats["count_tokens"] += 1
+            return JSONResponse({"totalTokens": len(body) // 4})
+        if method == "streamGenerateContent":
+            stats["streams"] += 1
+            return StreamingResponse(stream_events(len(body)), media_type="text/event-stream")
+        if method == "generateContent":
+            await asyncio.sleep(settings.latency_ms / 1000)
+            parts = [{"text": text_of(settings.chunks * settings.chunk_chars)}] + tool_call_parts(settings.tool_calls)
+            return JSONResponse({
+                "candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP"}],
+                "usageMetadata": usage(settings, len(body)),
+                "responseId": f"mock-{stats['requests']}",
+            })
+        return JSONResponse({"error": {"code": 404, "message": f"Unknown method {method}"}}, status_code=404)
+
+    async def stream_events(request_bytes: int):
+        await asyncio.sleep(settings.ttft_ms / 1000)
+        for index in range(settings.chunks):
+            if index:
+                await asyncio.sleep(settings.chunk_interval_ms / 1000)
+            parts = [{"text": text_of(settings.chunk_chars, index * settings.chunk_chars)}]
+            candidate = {"content": {"role": "model", "parts": parts}}
+            event = {"candidates": [candidate]}
+            if index == settings.chunks - 1:
+                parts.extend(tool_call_parts(settings.tool_calls))
+                candidate["finishReason"] = "STOP"
+                event["usageMetadata"] = usage(settings, request_bytes)
+            yield f"data: {json.dumps(event)}\r\n\r\n".encode()
+
+    async def upload(request: Request) -> Response:
+        # Resumable protocol: "start" hands out a session URL, "upload, finalize" receives the bytes
+        if request.headers.get("x-goog-upload-command", "").startswith("start"):
+            await request.body()
+            pending_uploads[str(len(pending_uploads) + 1)] = request.headers.get("x-goog-upload-header-content-type")
+            session_url = f"{request.url.scheme}://{request.url.netloc}{request.url.path}?upload_id={len(pending_uploads)}"
+            return Response(headers={"x-goog-upload-url": session_url, "x-goog-upload-status": "active"})
+        body = await request.body()
+        stats["uploads"] += 1
+        stats["upload_bytes"] += len(body)
+        name = f"files/mock-{stats['uploads']}"
+        expire_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 48 * 3600))
+        return JSONResponse({"file": {
+            "name": name, "uri": f"https://generativelanguage.googleapis.com/v1beta/{name}",
+            "mimeType": pending_uploads.get(request.query_params.get("upload_id", "")) or "application/octet-stream",
+            "sizeBytes": str(len(body)), "state": "ACTIVE", "expirationTime": expire_time,
+        }})
+
+    async def dispatch(request: Request) -> Response:
+        path = request.path_params["path"]
+        if path.startswith("upload/"):
+            return await upload(request)
+        if path.rstrip("/").endswith("cachedContents") or "/cachedContents/" in f"/{path}":
+            body = await request.body()
+            expire_time = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(time.time() + 300))
+            return JSONResponse({"name": f"cachedContents/mock-{stats['requests']}", "expireTime": expire_time,
+                                 "usageMetadata": {"totalTokenCount": len(body) // 4}})
+        if ":" not in path:
+            return JSONResponse({"error": {"code": 404, "message": f"Unknown path {path}"}}, status_code=404)
+        return await generate(request, path.rsplit(":", 1)[1])
+
+    async def mock_stats(request: Request) -> Response:
+        return JSONResponse({"settings": settings.as_dict(), **stats})
+
+    return Starlette(routes=[
+        Route("/mock/stats", mock_stats, methods=["GET"]),
+        Route("/{path:path}", dispatch, methods=["GET", "POST", "PATCH"]),
+    ])
+
+
+def parse_args(argv=None):
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description="Mock Gemini API for benchmarks")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=int(env("MOCK_GEMINI_PORT", "8099")))
+    parser.add_argument("--chunks", type=int, default=int(env("MOCK_GEMINI_CHUNKS", "50")))
+    parser.add_argument("--chunk-chars", type=int, default=int(env("MOCK_GEMINI_CHUNK_CHARS", "40")))
+    parser.add_argument("--ttft-ms", type=float, default=float(env("MOCK_GEMINI_TTFT_MS", "200")))
+    parser.add_argument("--chunk-interval-ms", type=float, default=float(env("MOCK_GEMINI_CHUNK_INTERVAL_MS", "10")))
+    parser.add_argument("--latency-ms", type=float, default=float(env("MOCK_GEMINI_LATENCY_MS", "500")))
+    parser.add_argument("--tool-calls", type=int, default=int(env("MOCK_GEMINI_TOOL_CALLS", "0")))
+    return parser.parse_args(argv)
+
+
+def settings_from_args(args) -> MockSettings:
+    return MockSettings(args.chunks, args.chunk_chars, args.ttft_ms, args.chunk_interval_ms,
+                        args.latency_ms, args.tool_calls)
+
+
+def main():
+    args = parse_args()
+    uvicorn.run(build_app(settings_from_args(args)), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,207 @@
+"""Regression checks and load tests from recorded upstream streams.
+
+Recordings are written by the proxy with STREAM_CAPTURE_DIR set (see
+stream_capture.py): the originating request, every upstream chunk with its
+timing, and the SSE bytes the proxy sent back.
+
+``check`` feeds each recording's upstream chunks through the current stream
+handler in-process and compares the SSE output with the recorded one, byte for
+byte (message ids and the message_start timing metadata are normalized). The
+recording's coalescing settings are applied; with coalescing on, chunks are
+replayed at recorded timing so frames merge the same way.
+
+``load`` starts the proxy with UPSTREAM_ENGINE=replay on the recordings and
+sends their requests at the given concurrency, reporting requests/sec and
+latency / time-to-first-token percentiles without any Gemini traffic.
+
+Usage: python benchmarks/replay_streams.py check DIR [--speed S] [--verbose]
+       python benchmarks/replay_streams.py load DIR [--speed 1] [--concurrency 1,8,32]
+           [--requests 64] [--json]
+"""
+import argparse
+import asyncio
+import difflib
+import glob
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from bench_e2e import FAKE_API_KEY, free_port, percentile, wait_until_up
+from stream_capture import CAPTURE_SUFFIX, Recording
+
+_MESSAGE_ID_RE = re.compile(r'"(msg_|msg_error_)[0-9a-f-]{24,36}"')
+_METADATA_RE = re.compile(r', "metadata": \{[^\n]*?\}\}(?=\}\n)')
+
+
+def normalize(sse: str) -> str:
+    sse = _MESSAGE_ID_RE.sub(r'"\1<id>"', sse)
+    return _METADATA_RE.sub("", sse)
+
+
+def load_recordings(directory: str):
+    paths = sorted(glob.glob(os.path.join(directory, f"*{CAPTURE_SUFFIX}")))
+    if not paths:
+        raise SystemExit(f"No recordings (*{CAPTURE_SUFFIX}) in {directory}")
+    return [Recording(path) for path in paths]
+
+
+# check
+async def replay_through_handler(server, recording: Recording, speed: float) -> str:
+    settings = recording.header.get("settings", {})
+    server.config.stream_coalesce_window_ms = settings.get("stream_coalesce_window_ms", 0)
+    server.config.stream_coalesce_max_chars = settings.get("stream_coalesce_max_chars", 512)
+    if speed is None:
+        speed = 1.0 if server.config.stream_coalesce_window_ms > 0 else 0.0
+    request = server.MessagesRequest.model_validate(recording.request)
+    output = []
+    async for frame in server.handle_streaming_with_recovery(
+            recording.replay(speed), request, recording.header.get("cache_creation_tokens", 0)):
+        output.append(frame.decode("utf-8") if isinstance(frame, bytes) else frame)
+    return "".join(output)
+
+
+async def run_check(args) -> int:
+    os.environ.setdefault("GEMINI_API_KEY", FAKE_API_KEY)
+    os.environ.setdefault("LITELLM_LOCAL_MODEL_COST_MAP", "True")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    import server
+
+    failures = 0
+    for recording in load_recordings(args.directory):
+        name = os.path.basename(recording.path)
+        if not recording.header.get("complete", True):
+            print(f"⏭️  {name}: incomplete recording (client disconnected), skipped")
+            continue
+        expected = normalize(recording.sse_output)
+        actual = normalize(await replay_through_handler(server, recording, args.speed))
+        if actual == expected:
+            print(f"✅ {name}: {len(recording.upstream)} upstream events, {len(expected)} SSE bytes identical")
+            continue
+        failures += 1
+        print(f"❌ {name}: SSE output differs from the recording")
+        if args.verbose:
+            diff = difflib.unified_diff(expected.splitlines(), actual.splitlines(),
+                                        "recorded", "replayed", lineterm="", n=1)
+            print("\n".join(diff))
+    return 1 if failures else 0
+
+
+# load
+def start_proxy(args):
+    port = free_port()
+    max_concurrency = str(max(args.concurrency) * 2)
+    env = dict(os.environ)
+    env.update({"GEMINI_API_KEY": FAKE_API_KEY, "UPSTREAM_ENGINE": "replay",
+                "STREAM_REPLAY_DIR": os.path.abspath(args.directory), "STREAM_REPLAY_SPEED": str(args.speed)})
+    for name, value in (("LOG_LEVEL", "WARNING"), ("LITELLM_LOCAL_MODEL_COST_MAP", "True"),
+                        ("BIG_MODEL_MAX_CONCURRENCY", max_concurrency),
+                        ("SMALL_MODEL_MAX_CONCURRENCY", max_concurrency),
+                        ("OTHER_MODEL_MAX_CONCURRENCY", max_concurrency),
+                        ("ADMISSION_MAX_QUEUE", max_concurrency)):
+        env.setdefault(name, value)
+    cmd = [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1", "--port", str(port),
+           "--log-level", "warning"]
+    output = None if args.verbose else subprocess.DEVNULL
+    process = subprocess.Popen(cmd, cwd=REPO_DIR, env=env, stdout=output, stderr=output)
+    return process, f"http://127.0.0.1:{port}"
+
+
+async def one_request(client: httpx.AsyncClient, payload: dict):
+    started = time.monotonic()
+    ttft = None
+    async with client.stream("POST", "/v1/messages", json=payload) as response:
+        async for line in response.aiter_lines():
+            if ttft is None and line.startswith("event: content_block_delta"):
+                ttft = time.monotonic() - started
+        ok = response.status_code == 200
+    return ok, (time.monotonic() - started) * 1000, None if ttft is None else ttft * 1000
+
+
+async def run_level(client, payloads, concurrency: int, total: int):
+    latencies, ttfts, errors = [], [], 0
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(dict(payloads[i % len(payloads)], stream=True))
+
+    async def worker():
+        nonlocal errors
+        while not queue.empty():
+            payload = queue.get_nowait()
+            try:
+                ok, latency, ttft = await one_request(client, payload)
+            except httpx.HTTPError:
+                ok, latency, ttft = False, None, None
+            if not ok:
+                errors += 1
+                continue
+            latencies.append(latency)
+            if ttft is not None:
+                ttfts.append(ttft)
+
+    started = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.monotonic() - started
+    return {"concurrency": concurrency, "requests": total, "errors": errors,
+            "rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+            "latency_p50_ms": percentile(latencies, 50), "latency_p99_ms": percentile(latencies, 99),
+            "ttft_p50_ms": percentile(ttfts, 50), "ttft_p99_ms": percentile(ttfts, 99)}
+
+
+async def run_load(args) -> int:
+    payloads = [recording.request for recording in load_recordings(args.directory)]
+    process, url = start_proxy(args)
+    try:
+        await wait_until_up(f"{url}/health")
+        rows = []
+        async with httpx.AsyncClient(base_url=url, timeout=300,
+                                     limits=httpx.Limits(max_connections=max(args.concurrency) * 2)) as client:
+            for concurrency in args.concurrency:
+                row = await run_level(client, payloads, concurrency, max(args.requests, concurrency))
+                rows.append(row)
+                if not args.json:
+                    print(f"c={row['concurrency']:<4} rps={row['rps']:<8} p50={row['latency_p50_ms']}ms "
+                          f"p99={row['latency_p99_ms']}ms ttft_p50={row['ttft_p50_ms']}ms errors={row['errors']}")
+        if args.json:
+            print(json.dumps({"recordings": len(payloads), "speed": args.speed, "results": rows}, indent=2))
+    finally:
+        process.terminate()
+        process.wait(timeout=10)
+    return 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Check or load-test the proxy with recorded upstream streams")
+    commands = parser.add_subparsers(dest="command", required=True)
+    check = commands.add_parser("check", help="replay recordings through the stream handler and diff the SSE output")
+    check.add_argument("directory")
+    check.add_argument("--speed", type=float, default=None,
+                       help="replay speed (default: recorded timing if coalescing was on, else no waiting)")
+    check.add_argument("--verbose", action="store_true", help="print a diff for mismatches")
+    load = commands.add_parser("load", help="load-test a proxy running UPSTREAM_ENGINE=replay")
+    load.add_argument("directory")
+    load.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 = as fast as possible (default: 1)")
+    load.add_argument("--concurrency", type=lambda s: [int(c) for c in s.split(",")], default=[1, 8, 32])
+    load.add_argument("--requests", type=int, default=64)
+    load.add_argument("--json", action="store_true")
+    load.add_argument("--verbose", action="store_true", help="show proxy output")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    runner = run_check if args.command == "check" else run_load
+    sys.exit(asyncio.run(runner(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""Small in-process cache helpers shared by the request/response conversion caches."""
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+def fingerprint(obj: Any) -> str:
+    """Stable content hash of a JSON-compatible object (key order independent)."""
+    canonical = json.dumps(obj, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.blake2b(canonical.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def freeze(value: Any) -> Hashable:
+    """Convert a JSON-like value into a hashable, type-tagged tuple structure.
+
+    Much cheaper than serializing and hashing the value, and exact: dicts, lists
+    and non-string scalars are tagged so that e.g. ``{"a": 1}``, ``{"a": True}``
+    and ``[["a", 1]]`` freeze to different keys.
+    """
+    if isinstance(value, str):
+        return value
+    if isinstance(value, dict):
+        return ("d",) + tuple((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return ("l",) + tuple(freeze(item) for item in value)
+    return (type(value).__name__, value)
+
+
+class LRUCache:
+    """Bounded least-recently-used mapping with hit/miss counters.
+
+    Entries are evicted once there are more than ``maxsize`` of them or, when
+    ``max_weight`` is set, once the summed entry weights (e.g. approximate bytes)
+    exceed it. A ``maxsize`` of 0 disables the cache: ``get`` always misses and
+    ``set`` is a no-op. Safe to share between the event loop and worker threads.
+    """
+
+    def __init__(self, maxsize: int = 128, max_weight: int = 0):
+        self.maxsize = maxsize
+        self.max_weight = max_weight
+        self.weight = 0
+        self._data: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            try:
+                value, _ = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, weight: int = 1):
+        if not self.enabled or (self.max_weight and weight > self.max_weight):
+            return
+        with self._lock:
+            previous = self._data.pop(key, None)
+            if previous is not None:
+                self.weight -= previous[1]
+            self._data[key] = (value, weight)
+            self.weight += weight
+            while len(self._data) > self.maxsize or (self.max_weight and self.weight > self.max_weight):
+                _, (_, evicted_weight) = self._data.popitem(last=False)
+                self.weight -= evicted_weight
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        stats = {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+        if self.max_weight:
+            stats["weight"] = self.weight
+            stats["max_weight"] = self.max_weight
+        return stats
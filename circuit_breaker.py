@@ -0,0 +1,139 @@
+"""Per-model circuit breakers for upstream overload.
+
+When a Gemini model is overloaded (429 / 5xx / timeouts) every request would
+otherwise keep hitting it and burn through its retries. A breaker per mapped
+model counts consecutive overload failures:
+
+* ``closed``: calls go through; ``failure_threshold`` failures in a row open it;
+* ``open``: the model is skipped (ModelManager routes to the next model of its
+  failover chain) until ``open_seconds`` have passed;
+* ``half_open``: up to ``half_open_max_calls`` probe calls go through; a success
+  closes the breaker, a failure opens it again.
+"""
+import logging
+import time
+from typing import Any, Dict
+
+logger = logging.getLogger(__name__)
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Every model that could serve the request has an open breaker."""
+
+    def __init__(self, model: str, retry_after: float):
+        super().__init__(f"Circuit open for {model}, retry after {retry_after:.0f}s")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Closed / open / half-open state machine for one model."""
+
+    def __init__(self, model: str, failure_threshold: int = 5, open_seconds: float = 30.0,
+                 half_open_max_calls: int = 1):
+        self.model = model
+        self.failure_threshold = max(failure_threshold, 1)
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = max(half_open_max_calls, 1)
+        self._state = STATE_CLOSED
+        self.opened_at = 0.0
+        self.consecutive_failures = 0
+        self.probes_in_flight = 0
+        self.times_opened = 0
+        self.successes = 0
+        self.failures = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == STATE_OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self._state = STATE_HALF_OPEN
+            self.probes_in_flight = 0
+        return self._state
+
+    def available(self) -> bool:
+        state = self.state
+        if state == STATE_CLOSED:
+            return True
+        if state == STATE_HALF_OPEN:
+            return self.probes_in_flight < self.half_open_max_calls
+        return False
+
+    def retry_after(self) -> float:
+        if self.state != STATE_OPEN:
+            return 0.0
+        return max(self.opened_at + self.open_seconds - time.monotonic(), 0.0)
+
+    def before_call(self):
+        if self.state == STATE_HALF_OPEN:
+            self.probes_in_flight += 1
+
+    def record_success(self):
+        self.successes += 1
+        self.consecutive_failures = 0
+        if self.state == STATE_HALF_OPEN:
+            logger.info(f"🟢 Circuit closed for {self.model}")
+            self._state = STATE_CLOSED
+            self.probes_in_flight = 0
+
+    def record_failure(self):
+        self.failures += 1
+        self.consecutive_failures += 1
+        state = self.state
+        if state == STATE_HALF_OPEN or (state == STATE_CLOSED and self.consecutive_failures >= self.failure_threshold):
+            self._open()
+
+    def record_ignored(self):
+        """The call ended without telling us anything about the model (cancelled, client error)."""
+        if self.state == STATE_HALF_OPEN and self.probes_in_flight:
+            self.probes_in_flight -= 1
+
+    def _open(self):
+        self._state = STATE_OPEN
+        self.opened_at = time.monotonic()
+        self.probes_in_flight = 0
+        self.times_opened += 1
+        logger.warning(f"🔴 Circuit opened for {self.model} after {self.consecutive_failures} consecutive failures, "
+                       f"skipping it for {self.open_seconds:.0f}s")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "times_opened": self.times_opened,
+            "retry_after": round(self.retry_after(), 1),
+            "successes": self.successes,
+            "failures": self.failures,
+        }
+
+
+class CircuitBreakerRegistry:
+    """Breakers created on demand per model name."""
+
+    def __init__(self, failure_threshold: int = 5, open_seconds: float = 30.0, half_open_max_calls: int = 1):
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self.breakers: Dict[str, CircuitBreaker] = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = CircuitBreaker(model, self.failure_threshold, self.open_seconds, self.half_open_max_calls)
+            self.breakers[model] = breaker
+        return breaker
+
+    def available(self, model: str) -> bool:
+        breaker = self.breakers.get(model)
+        return breaker is None or breaker.available()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": True,
+            "failure_threshold": self.failure_threshold,
+            "open_seconds": self.open_seconds,
+            "models": {model: breaker.stats() for model, breaker in self.breakers.items()},
+        }
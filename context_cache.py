@@ -0,0 +1,264 @@
+"""Gemini explicit context caching driven by Anthropic ``cache_control`` breakpoints.
+
+Anthropic clients mark cache breakpoints on tools, system blocks and message
+blocks. For the native engine those breakpoints are mapped onto Gemini
+``cachedContents`` resources: the request prefix up to a breakpoint (system
+instruction, tools, tool config and the leading contents) is uploaded once with
+a TTL, and later requests that share the prefix send only the remaining
+contents plus a ``cachedContent`` reference.
+
+Prefixes are identified by a rolling hash over the frozen request parts, so
+every prefix length of a request can be looked up in O(1); a hash match is
+confirmed by comparing the frozen parts themselves. That lets a new
+turn reuse the previous turn's cache even though the client moved its
+breakpoint forward; the longer prefix is then created in the background for
+the next turn.
+"""
+import asyncio
+import json
+import logging
+import time
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from cache_utils import LRUCache, freeze
+from gemini_native import GeminiAPIError, GeminiNativeClient, gemini_model_name
+
+logger = logging.getLogger(__name__)
+
+# Request fields that move into the cachedContents resource
+CACHED_FIELDS = ("systemInstruction", "tools", "toolConfig")
+
+# Do not hand out a cache that is about to expire
+EXPIRY_MARGIN_SECONDS = 10
+
+
+def is_stale_cache_error(error: GeminiAPIError) -> bool:
+    """True when Gemini rejected a request because its cachedContent is gone or not ours."""
+    return error.status_code in (403, 404) and "cachedcontent" in error.message.lower().replace(" ", "")
+
+
+class PrefixKey:
+    """Cache key for one request prefix: the rolling hash, compared by the exact frozen parts.
+
+    ``parts`` is shared by every prefix of a request and only its first
+    ``length`` contents belong to this key; ``stored()`` drops the rest before
+    the key is kept in a cache.
+    """
+    __slots__ = ("hash", "seed", "parts", "length")
+
+    def __init__(self, prefix_hash: int, seed: Tuple, parts: Tuple, length: int):
+        self.hash = prefix_hash
+        self.seed = seed
+        self.parts = parts
+        self.length = length
+
+    def __hash__(self) -> int:
+        return self.hash
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, PrefixKey):
+            return NotImplemented
+        if self.hash != other.hash or self.length != other.length or self.seed != other.seed:
+            return False
+        return self.parts[:self.length] == other.parts[:other.length]
+
+    def stored(self) -> "PrefixKey":
+        if len(self.parts) == self.length:
+            return self
+        return PrefixKey(self.hash, self.seed, self.parts[:self.length], self.length)
+
+
+@dataclass
+class CachedContentEntry:
+    name: str
+    prefix_len: int
+    token_count: int
+    expire_at: float
+    api_key: Optional[str] = None
+
+
+class GeminiContextCache:
+    """Creates, refreshes and reuses Gemini cachedContents for request prefixes."""
+
+    def __init__(self, client: GeminiNativeClient, ttl_seconds: int = 300,
+                 min_tokens: int = 1024, max_entries: int = 256):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+        self.min_tokens = min_tokens
+        self.entries = LRUCache(max_entries)
+        # Prefixes Gemini refused or that are too small; retried after one TTL
+        self._skipped = LRUCache(max_entries * 4)
+        self._creating: Dict[PrefixKey, asyncio.Task] = {}
+        self._background: Set[asyncio.Task] = set()
+        self.created = 0
+        self.create_failures = 0
+        self.refreshed = 0
+        self.reused = 0
+        self.tokens_created = 0
+
+    @staticmethod
+    def prefix_keys(model: str, body: Dict[str, Any], api_key: Optional[str] = None) -> List[PrefixKey]:
+        """Keys of every prefix: index i covers the cached fields plus contents[:i].
+
+        cachedContents belong to the key's project, so the key is part of the seed.
+        """
+        seed = (gemini_model_name(model), api_key) + tuple(freeze(body.get(field)) for field in CACHED_FIELDS)
+        parts = tuple(freeze(content) for content in body.get("contents", []))
+        prefix_hash = hash(seed)
+        keys = [PrefixKey(prefix_hash, seed, parts, 0)]
+        for length, part in enumerate(parts, 1):
+            prefix_hash = hash((prefix_hash, part))
+            keys.append(PrefixKey(prefix_hash, seed, parts, length))
+        return keys
+
+    def _live_entry(self, prefix_key: PrefixKey) -> Optional[CachedContentEntry]:
+        if prefix_key not in self.entries:
+            return None
+        entry = self.entries.get(prefix_key)
+        if entry is None or entry.expire_at - EXPIRY_MARGIN_SECONDS <= time.monotonic():
+            return None
+        return entry
+
+    def invalidate(self, prefix_key: Optional[PrefixKey]):
+        """Forget an entry Gemini no longer recognises (deleted or expired server-side)."""
+        if prefix_key is not None and prefix_key in self.entries:
+            self.entries.set(prefix_key, None)
+
+    async def prepare(self, model: str, body: Dict[str, Any], breakpoint: Optional[int],
+                      api_key: Optional[str] = None) -> Tuple[Dict[str, Any], int, Optional[PrefixKey]]:
+        """Rewrite ``body`` to use a cached prefix where possible.
+
+        ``breakpoint`` is the number of leading contents covered by the client's
+        last cache_control marker (0 for tools/system only, None for no marker).
+        ``api_key`` is the key the request will be sent with (None for the client default).
+        Returns the request body to send, the number of tokens written to a new
+        cache by this request, and the prefix key of the cache in use.
+        """
+        contents = body.get("contents", [])
+        if not contents:
+            return body, 0, None
+
+        keys = self.prefix_keys(model, body, api_key)
+        # Gemini needs at least one content after the cached prefix
+        max_prefix = len(contents) - 1
+        target = min(breakpoint, max_prefix) if breakpoint is not None else None
+
+        # Longest prefix that already has a live cache
+        for prefix_len in range(max_prefix, -1, -1):
+            entry = self._live_entry(keys[prefix_len])
+            if entry is not None:
+                self.reused += 1
+                self._refresh_if_needed(keys[prefix_len], entry)
+                if target is not None and target > prefix_len:
+                    self._create_in_background(model, body, target, keys[target], api_key)
+                return self._strip_prefix(body, entry), 0, keys[prefix_len]
+
+        if target is None:
+            return body, 0, None
+
+        entry = await self._create(model, body, target, keys[target], api_key)
+        if entry is None:
+            return body, 0, None
+        return self._strip_prefix(body, entry), entry.token_count, keys[target]
+
+    @staticmethod
+    def _strip_prefix(body: Dict[str, Any], entry: CachedContentEntry) -> Dict[str, Any]:
+        stripped = {key: value for key, value in body.items() if key not in CACHED_FIELDS}
+        stripped["contents"] = body["contents"][entry.prefix_len:]
+        stripped["cachedContent"] = entry.name
+        return stripped
+
+    def _cache_body(self, model: str, body: Dict[str, Any], prefix_len: int) -> Dict[str, Any]:
+        cache_body: Dict[str, Any] = {
+            "model": f"models/{gemini_model_name(model)}",
+            "ttl": f"{self.ttl_seconds}s",
+        }
+        if prefix_len:
+            cache_body["contents"] = body["contents"][:prefix_len]
+        for field in CACHED_FIELDS:
+            if body.get(field):
+                cache_body[field] = body[field]
+        return cache_body
+
+    async def _create(self, model: str, body: Dict[str, Any], prefix_len: int,
+                      prefix_key: PrefixKey, api_key: Optional[str]) -> Optional[CachedContentEntry]:
+        """Create (or join an in-flight creation of) the cache for one prefix."""
+        if prefix_key in self._skipped and self._skipped.get(prefix_key, 0) > time.monotonic():
+            return None
+        task = self._creating.get(prefix_key)
+        if task is None:
+            task = asyncio.ensure_future(self._create_cached_content(model, body, prefix_len, prefix_key, api_key))
+            self._creating[prefix_key.stored()] = task
+            task.add_done_callback(lambda _: self._creating.pop(prefix_key, None))
+        return await asyncio.shield(task)
+
+    async def _create_cached_content(self, model: str, body: Dict[str, Any], prefix_len: int,
+                                     prefix_key: PrefixKey, api_key: Optional[str]) -> Optional[CachedContentEntry]:
+        cache_body = self._cache_body(model, body, prefix_len)
+        if "contents" not in cache_body and not any(field in cache_body for field in CACHED_FIELDS):
+            return None
+
+        # Rough local estimate (4 chars/token) to avoid requests Gemini will reject as too small
+        if len(json.dumps(cache_body)) // 4 < self.min_tokens:
+            self._skipped.set(prefix_key.stored(), time.monotonic() + self.ttl_seconds)
+            return None
+
+        try:
+            response = await self.client.create_cached_content(cache_body, api_key=api_key)
+        except (GeminiAPIError, ConnectionError, TimeoutError) as e:
+            self.create_failures += 1
+            logger.warning(f"Gemini context cache creation failed, sending uncached: {e}")
+            self._skipped.set(prefix_key.stored(), time.monotonic() + self.ttl_seconds)
+            return None
+
+        token_count = (response.get("usageMetadata") or {}).get("totalTokenCount", 0)
+        entry = CachedContentEntry(
+            name=response["name"],
+            prefix_len=prefix_len,
+            token_count=token_count,
+            expire_at=time.monotonic() + self.ttl_seconds,
+            api_key=api_key,
+        )
+        self.entries.set(prefix_key.stored(), entry)
+        self.created += 1
+        self.tokens_created += token_count
+        logger.debug(f"Created Gemini context cache {entry.name} ({token_count} tokens, {prefix_len} contents)")
+        return entry
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _create_in_background(self, model: str, body: Dict[str, Any], prefix_len: int, prefix_key: PrefixKey,
+                              api_key: Optional[str]):
+        if prefix_key in self._creating or self._live_entry(prefix_key) is not None:
+            return
+        self._spawn(self._create(model, body, prefix_len, prefix_key, api_key))
+
+    def _refresh_if_needed(self, prefix_key: PrefixKey, entry: CachedContentEntry):
+        # Extend the TTL once less than half of it remains, so active sessions keep their cache
+        if entry.expire_at - time.monotonic() > self.ttl_seconds / 2:
+            return
+        entry.expire_at = time.monotonic() + self.ttl_seconds
+        self._spawn(self._refresh(prefix_key, entry))
+
+    async def _refresh(self, prefix_key: PrefixKey, entry: CachedContentEntry):
+        try:
+            await self.client.update_cached_content_ttl(entry.name, self.ttl_seconds, api_key=entry.api_key)
+            self.refreshed += 1
+        except (GeminiAPIError, ConnectionError, TimeoutError) as e:
+            logger.warning(f"Gemini context cache refresh failed for {entry.name}: {e}")
+            self.invalidate(prefix_key)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self.entries),
+            "created": self.created,
+            "create_failures": self.create_failures,
+            "reused": self.reused,
+            "refreshed": self.refreshed,
+            "tokens_created": self.tokens_created,
+            "ttl_seconds": self.ttl_seconds,
+        }
@@ -0,0 +1,244 @@
+"""Validation-light request parsing for trusted clients (FAST_PATH).
+
+The strict path validates every body into the pydantic request models, which
+for a long agent conversation means building a model object per message and
+content block on every call. Clients that already send well-formed Anthropic
+requests (they passed AUTH_TOKEN, or FAST_PATH=all) can skip that: the body is
+decoded with orjson when it is installed and checked only for the structure
+the converters rely on (field presence, container and scalar types, known
+block types and roles). Objects the converters read become ``Record``s, plain
+views that read the decoded dicts as attributes, so the conversion code runs
+on them unchanged.
+
+Unlike the pydantic models, nothing is coerced ("1024" is not an int here)
+and unknown fields are kept rather than dropped.
+"""
+import json
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(body: bytes) -> Any:
+    """Decode a JSON body (orjson when available)."""
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body.decode("utf-8"))
+
+
+class Record:
+    """A decoded JSON object read through attributes, standing in for a pydantic model.
+
+    The dict itself becomes the instance ``__dict__`` (no copy), so attribute
+    reads cost what they cost on a model and assignments (``request.model =
+    mapped``) write the dict. Unset optional fields must be filled in first.
+    """
+    __slots__ = ("__dict__",)
+
+    def __init__(self, data: Optional[Dict[str, Any]] = None, **fields: Any):
+        self.__dict__ = data if data is not None else fields
+
+    def __repr__(self) -> str:
+        return f"Record({self.__dict__!r})"
+
+    def model_dump(self, exclude_none: bool = False) -> Dict[str, Any]:
+        """Plain dict copy; like the models, cache_control markers are left out."""
+        return _plain(self, exclude_none)
+
+
+def _plain(value: Any, exclude_none: bool) -> Any:
+    if isinstance(value, Record):
+        return {key: _plain(item, exclude_none) for key, item in value.__dict__.items()
+                if key != "cache_control" and not (exclude_none and item is None)}
+    if isinstance(value, list):
+        return [_plain(item, exclude_none) for item in value]
+    return value
+
+
+class StructureError(ValueError):
+    """A body that does not have the request structure; carries a pydantic-style error."""
+
+    def __init__(self, loc: Tuple[Any, ...], msg: str, error_type: str, value: Any = None):
+        super().__init__(f"{'.'.join(map(str, loc))}: {msg}")
+        self.error = {"type": error_type, "loc": loc, "msg": msg, "input": value}
+
+
+_MISSING = object()
+
+# Python type accepted for each JSON kind, with the pydantic error for a mismatch
+_KINDS = {
+    "str": (str, "string_type", "Input should be a valid string"),
+    "int": (int, "int_type", "Input should be a valid integer"),
+    "number": ((int, float), "float_type", "Input should be a valid number"),
+    "bool": (bool, "bool_type", "Input should be a valid boolean"),
+    "dict": (dict, "dict_type", "Input should be a valid dictionary"),
+    "list": (list, "list_type", "Input should be a valid list"),
+    "content": ((str, list, dict), "union_type", "Input should be a valid string, list or dictionary"),
+}
+
+# Defaults of the optional request fields (as in MessagesRequest / TokenCountRequest)
+MESSAGES_REQUEST_DEFAULTS = {
+    "system": None, "stop_sequences": None, "stream": False, "temperature": 1.0, "top_p": None, "top_k": None,
+    "metadata": None, "tools": None, "tool_choice": None, "thinking": None, "original_model": None,
+}
+TOKEN_COUNT_REQUEST_DEFAULTS = {
+    "system": None, "tools": None, "thinking": None, "tool_choice": None, "original_model": None,
+}
+
+# Required fields of each content block type
+_BLOCK_FIELDS = {
+    "text": (("text", "str"),),
+    "image": (("source", "dict"),),
+    "tool_use": (("id", "str"), ("name", "str"), ("input", "dict")),
+    "tool_result": (("tool_use_id", "str"), ("content", "content")),
+}
+
+# The same, as isinstance() arguments for the checks on the common (valid) path
+_BLOCK_TYPES = {
+    block_type: tuple((name, _KINDS[kind][0]) for name, kind in fields) for block_type, fields in _BLOCK_FIELDS.items()
+}
+
+_ROLES = ("user", "assistant")
+
+
+def _check(value: Any, kind: str, loc: Tuple[Any, ...]) -> Any:
+    types, error_type, msg = _KINDS[kind]
+    # bool is an int subclass, but never a valid integer or number field
+    if not isinstance(value, types) or (isinstance(value, bool) and kind in ("int", "number")):
+        raise StructureError(loc, msg, error_type, value)
+    return value
+
+
+def _field(data: Dict[str, Any], name: str, kind: str, loc: Tuple[Any, ...], required: bool = True) -> Any:
+    value = data.get(name, _MISSING)
+    if value is _MISSING or value is None:
+        if required:
+            raise StructureError(loc + (name,), "Field required", "missing")
+        return None
+    return _check(value, kind, loc + (name,))
+
+
+# Messages and blocks are checked inline; the raising checkers below only run
+# once something is wrong, to report where
+def _block_error(block: Any, loc: Tuple[Any, ...]):
+    _check(block, "dict", loc)
+    fields = _BLOCK_FIELDS.get(block.get("type"))
+    if fields is None:
+        raise StructureError(loc + ("type",), f"Input should be {', '.join(map(repr, _BLOCK_FIELDS))}",
+                             "literal_error", block.get("type"))
+    for name, kind in fields:
+        _field(block, name, kind, loc)
+
+
+def _message_error(message: Any, loc: Tuple[Any, ...]):
+    _check(message, "dict", loc)
+    if message.get("role") not in _ROLES:
+        raise StructureError(loc + ("role",), "Input should be 'user' or 'assistant'", "literal_error",
+                             message.get("role"))
+    content = message.get("content", _MISSING)
+    if content is _MISSING:
+        raise StructureError(loc + ("content",), "Field required", "missing")
+    _check(content, "list", loc + ("content",))
+
+
+def _blocks(content: list, loc: Tuple[Any, ...]) -> list:
+    records = []
+    for block in content:
+        fields = _BLOCK_TYPES.get(block.get("type")) if isinstance(block, dict) else None
+        if fields is None:
+            _block_error(block, loc + (len(records),))
+        for name, types in fields:
+            if not isinstance(block.get(name), types):
+                _block_error(block, loc + (len(records),))
+        block.setdefault("cache_control", None)
+        records.append(Record(block))
+    return records
+
+
+def _messages(messages: list) -> list:
+    records = []
+    for message in messages:
+        content = message.get("content") if isinstance(message, dict) else None
+        if isinstance(content, list) and message.get("role") in _ROLES:
+            message["content"] = _blocks(content, ("messages", len(records), "content"))
+        elif not isinstance(content, str) or message.get("role") not in _ROLES:
+            _message_error(message, ("messages", len(records)))
+        records.append(Record(message))
+    return records
+
+
+def _system(system: Any) -> Any:
+    if system is None or isinstance(system, str):
+        return system
+    _check(system, "list", ("system",))
+    blocks = []
+    for index, block in enumerate(system):
+        loc = ("system", index)
+        _check(block, "dict", loc)
+        if block.get("type") != "text":
+            raise StructureError(loc + ("type",), "Input should be 'text'", "literal_error", block.get("type"))
+        _field(block, "text", "str", loc)
+        block.setdefault("cache_control", None)
+        blocks.append(Record(block))
+    return blocks
+
+
+def _tools(tools: Any) -> Optional[list]:
+    if tools is None:
+        return None
+    _check(tools, "list", ("tools",))
+    checked = []
+    for index, tool in enumerate(tools):
+        loc = ("tools", index)
+        _check(tool, "dict", loc)
+        _field(tool, "name", "str", loc)
+        _field(tool, "description", "str", loc, required=False)
+        _field(tool, "input_schema", "dict", loc)
+        tool.setdefault("description", None)
+        tool.setdefault("cache_control", None)
+        checked.append(Record(tool))
+    return checked
+
+
+def _thinking(thinking: Any) -> Optional[Record]:
+    if thinking is None:
+        return None
+    _check(thinking, "dict", ("thinking",))
+    enabled = _field(thinking, "enabled", "bool", ("thinking",), required=False)
+    return Record(enabled=True if enabled is None else enabled)
+
+
+def request_record(defaults: Dict[str, Any], **fields: Any) -> Record:
+    """A request Record built in code, with the unset optional fields filled in."""
+    return Record({**defaults, **fields})
+
+
+def parse_request(body: bytes, messages_request: bool = True) -> Record:
+    """Decode and structurally check a messages (or count_tokens) request body.
+
+    Raises ValueError for invalid JSON and StructureError for a body that is
+    not shaped like a request. Returns a Record with the request models'
+    defaults filled in; model mapping is left to the caller.
+    """
+    data = loads(body)
+    _check(data, "dict", ())
+    _field(data, "model", "str", ())
+    if messages_request:
+        _field(data, "max_tokens", "int", ())
+    for name, default in (MESSAGES_REQUEST_DEFAULTS if messages_request else TOKEN_COUNT_REQUEST_DEFAULTS).items():
+        data.setdefault(name, default)
+    messages = _field(data, "messages", "list", ())
+    data["messages"] = _messages(messages)
+    data["system"] = _system(data["system"])
+    data["tools"] = _tools(data["tools"])
+    data["thinking"] = _thinking(data["thinking"])
+    for name, kind in (("stream", "bool"), ("temperature", "number"), ("top_p", "number"), ("top_k", "int"),
+                       ("metadata", "dict"), ("tool_choice", "dict"), ("stop_sequences", "list"),
+                       ("original_model", "str")):
+        _field(data, name, kind, (), required=False)
+    for index, stop in enumerate(data.get("stop_sequences") or ()):
+        _check(stop, "str", ("stop_sequences", index))
+    return Record(data)
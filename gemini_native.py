@@ -0,0 +1,469 @@
+"""Native Gemini transport used when UPSTREAM_ENGINE=native.
+
+Talks to the Gemini ``generateContent`` / ``streamGenerateContent`` REST
+endpoints directly over one long-lived, connection-pooled httpx client instead
+of going through ``litellm.acompletion``. Request/response translation lives in
+server.py next to the LiteLLM converters; this module only moves bytes.
+"""
+import asyncio
+import importlib.util
+import json
+import logging
+import re
+import secrets
+import uuid
+import zlib
+from typing import Any, AsyncIterator, Callable, Dict, List, Mapping, Optional, Tuple, Union
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_GEMINI_BASE_URL = "https://generativelanguage.googleapis.com"
+GEMINI_API_VERSION = "v1beta"
+
+# Gemini finishReason -> OpenAI-style finish_reason understood by the stream handler
+FINISH_REASON_MAP = {
+    "STOP": "stop",
+    "MAX_TOKENS": "length",
+}
+
+
+# Strings at least this long (inline base64 images) are written into request bodies
+# in slices instead of being serialized along with the rest of the body
+LARGE_STRING_CHARS = 64 * 1024
+BODY_SLICE_CHARS = 256 * 1024
+
+# Request gzip (UPSTREAM_REQUEST_COMPRESSION): JSON text compresses nearly as well at
+# level 1 as at 6 for half the CPU; bodies this large are compressed off the event loop
+GZIP_LEVEL = 1
+GZIP_IN_THREAD_BYTES = 256 * 1024
+
+# google.rpc.RetryInfo delay inside a 429 error body, e.g. "retryDelay": "17s"
+_RETRY_DELAY_PATTERN = re.compile(r'retryDelay["\']?\s*[:=]\s*["\']?(\d+(?:\.\d+)?)s')
+
+
+def parse_retry_delay(text: str) -> Optional[float]:
+    """Extract the RetryInfo delay (seconds) from a Gemini error payload or message."""
+    match = _RETRY_DELAY_PATTERN.search(text or "")
+    return float(match.group(1)) if match else None
+
+
+class GeminiAPIError(Exception):
+    """Non-2xx response from the Gemini REST API."""
+
+    def __init__(self, status_code: int, message: str, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.retry_after = retry_after
+
+
+def gemini_model_name(model: str) -> str:
+    """Strip the LiteLLM provider prefix ('gemini/gemini-2.5-pro' -> 'gemini-2.5-pro')."""
+    if model.startswith("gemini/"):
+        return model[7:]
+    if model.startswith("models/"):
+        return model[7:]
+    return model
+
+
+def gemini_stream_event_to_chunk(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Convert one streamGenerateContent event into an OpenAI-style delta chunk.
+
+    The chunk shape matches what ``handle_streaming_with_recovery`` already reads
+    from LiteLLM dict chunks, so both engines share the SSE state machine.
+    """
+    delta: Dict[str, Any] = {}
+    finish_reason = None
+    candidates = event.get("candidates") or []
+
+    if candidates:
+        candidate = candidates[0]
+        text_parts = []
+        tool_calls = []
+        for part in (candidate.get("content") or {}).get("parts") or []:
+            if part.get("thought"):
+                continue
+            if "text" in part:
+                text_parts.append(part["text"])
+            elif "functionCall" in part:
+                function_call = part["functionCall"]
+                tool_calls.append({
+                    "id": function_call.get("id") or f"toolu_{uuid.uuid4().hex[:24]}",
+                    "type": "function",
+                    "function": {
+                        "name": function_call.get("name", ""),
+                        "arguments": json.dumps(function_call.get("args") or {}),
+                    },
+                })
+        if text_parts:
+            delta["content"] = "".join(text_parts)
+        if tool_calls:
+            delta["tool_calls"] = tool_calls
+
+        gemini_finish = candidate.get("finishReason")
+        if gemini_finish:
+            finish_reason = "tool_calls" if tool_calls else FINISH_REASON_MAP.get(gemini_finish, "stop")
+
+    chunk: Dict[str, Any] = {"choices": [{"delta": delta, "finish_reason": finish_reason}]}
+
+    usage_metadata = event.get("usageMetadata")
+    if usage_metadata:
+        chunk["usage"] = {
+            "prompt_tokens": usage_metadata.get("promptTokenCount", 0),
+            "completion_tokens": usage_metadata.get("candidatesTokenCount", 0),
+            "prompt_tokens_details": {"cached_tokens": usage_metadata.get("cachedContentTokenCount", 0)},
+        }
+    return chunk
+
+
+def _is_json_safe(value: str) -> bool:
+    """True when ``value`` can go into JSON between quotes as is.
+
+    isascii() is O(1) and the substring checks run at memchr speed; a full scan for
+    every control character would cost as much as json.dumps. Base64 never contains
+    any of them, and other control characters in a payload this size would be
+    rejected upstream as invalid data anyway.
+    """
+    return value.isascii() and not any(char in value for char in '"\\\n\r\t')
+
+
+def gzip_bytes(data: bytes) -> bytes:
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def rejects_compression(status_code: int, body: bytes) -> bool:
+    """True when an error answer to a gzip-encoded request says the encoding was not understood."""
+    if status_code == 415:
+        return True
+    text = body[:4096].decode("utf-8", errors="replace").lower()
+    # An undecodable body reads as "Invalid JSON payload received. Unexpected token."; the same
+    # prefix with "Unknown name ..." is a schema error in a body that was decoded fine
+    return status_code == 400 and ("content-encoding" in text or "gzip" in text
+                                   or "invalid json payload received. unexpected token" in text)
+
+
+def _extract_large_strings(value: Any, found: List[str], marker: str) -> Any:
+    """``value`` with large JSON-safe strings swapped for placeholders; unchanged parts are shared."""
+    if isinstance(value, str):
+        if len(value) >= LARGE_STRING_CHARS and _is_json_safe(value):
+            found.append(value)
+            return f"{marker}{len(found) - 1}"
+        return value
+    if isinstance(value, dict):
+        copied = None
+        for key, item in value.items():
+            replaced = _extract_large_strings(item, found, marker)
+            if replaced is not item:
+                if copied is None:
+                    copied = dict(value)
+                copied[key] = replaced
+        return value if copied is None else copied
+    if isinstance(value, list):
+        copied = None
+        for index, item in enumerate(value):
+            replaced = _extract_large_strings(item, found, marker)
+            if replaced is not item:
+                if copied is None:
+                    copied = list(value)
+                copied[index] = replaced
+        return value if copied is None else copied
+    return value
+
+
+class JsonBody:
+    """A JSON request body whose large strings are streamed by reference.
+
+    Serializing a request that carries inline images with ``json=`` builds the whole
+    body as a str and then again as bytes. Here the body is serialized with
+    placeholders, and each large string is written in slices between the pieces
+    when the request is sent, so the body never exists as one buffer.
+    """
+
+    def __init__(self, body: Dict[str, Any]):
+        found: List[str] = []
+        marker = f"\x00{secrets.token_hex(8)}:"
+        skeleton = _extract_large_strings(body, found, marker)
+        text = json.dumps(skeleton, ensure_ascii=False, separators=(",", ":"))
+        self.parts: List[Union[bytes, str]] = []
+        if not found:
+            self.parts.append(text.encode("utf-8"))
+        else:
+            # json.dumps escapes the NUL in the marker, so it cannot clash with real content
+            pieces = re.split(r'"\\u0000' + marker[1:] + r'(\d+)"', text)
+            for index, piece in enumerate(pieces):
+                self.parts.append(piece.encode("utf-8") if index % 2 == 0 else found[int(piece)])
+        self.content_length = sum(len(part) + 2 if isinstance(part, str) else len(part) for part in self.parts)
+
+    @property
+    def streamed(self) -> bool:
+        return len(self.parts) > 1
+
+    def request_args(self) -> Tuple[Dict[str, str], Any]:
+        """Extra headers and the ``content=`` argument for httpx."""
+        headers = {"Content-Length": str(self.content_length)}
+        return headers, (self if self.streamed else self.parts[0])
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        for part in self.parts:
+            if isinstance(part, bytes):
+                yield part
+                continue
+            yield b'"'
+            for start in range(0, len(part), BODY_SLICE_CHARS):
+                yield part[start:start + BODY_SLICE_CHARS].encode("ascii")
+            yield b'"'
+
+
+class GeminiNativeClient:
+    """Pooled httpx client for the Gemini REST API."""
+
+    def __init__(self, api_key: str, base_url: Optional[str] = None, timeout: float = 90,
+                 http2: bool = False, max_connections: int = 100,
+                 max_keepalive_connections: int = 20, keepalive_expiry: float = 30.0,
+                 compress_min_bytes: Optional[int] = None):
+        self.api_key = api_key
+        self.base_url = (base_url or DEFAULT_GEMINI_BASE_URL).rstrip("/")
+        self.timeout = timeout
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("UPSTREAM_HTTP2 requested but the 'h2' package is not installed, using HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self._client: Optional[httpx.AsyncClient] = None
+        # Optional hook (api_key, headers) used by the key pool to learn remaining quota
+        self.on_response_headers: Optional[Callable[[str, Mapping[str, str]], None]] = None
+        # gzip request bodies of at least this many bytes (None = never); turned off if the endpoint rejects it
+        self.compress_min_bytes = compress_min_bytes
+        self.compression_rejected = False
+        self.compressed_requests = 0
+        self.compressed_bytes_in = 0
+        self.compressed_bytes_out = 0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Created lazily so the pool binds to the running event loop
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=self.limits,
+                timeout=httpx.Timeout(self.timeout, connect=min(self.timeout, 10.0)),
+            )
+        return self._client
+
+    def compression_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.compress_min_bytes is not None,
+            "min_bytes": self.compress_min_bytes,
+            "rejected_by_upstream": self.compression_rejected,
+            "requests": self.compressed_requests,
+            "bytes_in": self.compressed_bytes_in,
+            "bytes_out": self.compressed_bytes_out,
+        }
+
+    async def aclose(self):
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+
+    def api_url(self, path: str) -> str:
+        # Accept base URLs with or without an explicit API version segment
+        base = self.base_url
+        if not base.rsplit("/", 1)[-1].startswith("v1"):
+            base = f"{base}/{GEMINI_API_VERSION}"
+        return f"{base}/{path}"
+
+    def upload_url(self, path: str) -> str:
+        # Media uploads live under /upload/<version>/ at the API root
+        base = self.base_url
+        version = GEMINI_API_VERSION
+        if base.rsplit("/", 1)[-1].startswith("v1"):
+            base, version = base.rsplit("/", 1)
+        return f"{base}/upload/{version}/{path}"
+
+    def model_url(self, model: str, method: str) -> str:
+        return self.api_url(f"models/{gemini_model_name(model)}:{method}")
+
+    def _headers(self, api_key: Optional[str] = None) -> Dict[str, str]:
+        return {"x-goog-api-key": api_key or self.api_key, "Content-Type": "application/json"}
+
+    @staticmethod
+    def _error_from_response(status_code: int, body: bytes,
+                             headers: Optional[Mapping[str, str]] = None) -> GeminiAPIError:
+        raw = body.decode("utf-8", errors="replace")
+        message = raw
+        try:
+            message = json.loads(raw).get("error", {}).get("message", raw)
+        except (ValueError, AttributeError):
+            pass
+        retry_after = parse_retry_delay(raw)
+        if retry_after is None and headers is not None and headers.get("retry-after", "").isdigit():
+            retry_after = float(headers["retry-after"])
+        return GeminiAPIError(status_code, message, retry_after)
+
+    def _observe(self, api_key: Optional[str], response: httpx.Response):
+        if self.on_response_headers is not None:
+            self.on_response_headers(api_key or self.api_key, response.headers)
+
+    async def _body_args(self, body: Optional[Dict[str, Any]], api_key: Optional[str],
+                         compress: bool = True) -> Dict[str, Any]:
+        headers = self._headers(api_key)
+        if body is None:
+            return {"headers": headers}
+        json_body = JsonBody(body)
+        # Bodies carrying inline images stay uncompressed: base64 of image data saves
+        # about a fifth for tens of milliseconds of CPU per megabyte
+        if (compress and self.compress_min_bytes is not None and not json_body.streamed
+                and json_body.content_length >= self.compress_min_bytes):
+            data = json_body.parts[0]
+            encoded = await asyncio.to_thread(gzip_bytes, data) if len(data) >= GZIP_IN_THREAD_BYTES else gzip_bytes(data)
+            self.compressed_requests += 1
+            self.compressed_bytes_in += len(data)
+            self.compressed_bytes_out += len(encoded)
+            return {"headers": {**headers, "Content-Encoding": "gzip", "Content-Length": str(len(encoded))},
+                    "content": encoded}
+        body_headers, content = json_body.request_args()
+        return {"headers": {**headers, **body_headers}, "content": content}
+
+    def _compression_rejected(self, args: Dict[str, Any], status_code: int, body: bytes) -> bool:
+        """Stop compressing (and have the caller resend) when a gzip body was refused as such."""
+        if "Content-Encoding" not in args["headers"] or not rejects_compression(status_code, body):
+            return False
+        logger.warning(f"Gemini rejected a gzip request body (HTTP {status_code}), "
+                       "sending uncompressed requests from now on")
+        self.compress_min_bytes = None
+        self.compression_rejected = True
+        return True
+
+    async def _request_json(self, method: str, url: str, body: Optional[Dict[str, Any]] = None,
+                            params: Optional[Dict[str, str]] = None,
+                            api_key: Optional[str] = None) -> Dict[str, Any]:
+        args = await self._body_args(body, api_key)
+        try:
+            response = await self.client.request(method, url, params=params, **args)
+            if response.status_code >= 400 and self._compression_rejected(args, response.status_code, response.content):
+                response = await self.client.request(method, url, params=params,
+                                                     **await self._body_args(body, api_key, compress=False))
+        except httpx.TimeoutException as e:
+            raise TimeoutError(f"Gemini request timed out: {e}") from e
+        except httpx.TransportError as e:
+            raise ConnectionError(f"Gemini connection failed: {e}") from e
+
+        self._observe(api_key, response)
+        if response.status_code >= 400:
+            raise self._error_from_response(response.status_code, response.content, response.headers)
+        return response.json()
+
+    async def generate_content(self, model: str, body: Dict[str, Any],
+                               api_key: Optional[str] = None) -> Dict[str, Any]:
+        """Non-streaming generateContent call, returns the decoded JSON response."""
+        return await self._request_json("POST", self.model_url(model, "generateContent"), body, api_key=api_key)
+
+    async def count_tokens(self, model: str, body: Dict[str, Any], api_key: Optional[str] = None) -> int:
+        """Exact prompt token count for a generateContent body via countTokens."""
+        request = dict(body, model=f"models/{gemini_model_name(model)}")
+        response = await self._request_json(
+            "POST", self.model_url(model, "countTokens"), {"generateContentRequest": request}, api_key=api_key
+        )
+        return response.get("totalTokens", 0)
+
+    async def create_cached_content(self, body: Dict[str, Any], api_key: Optional[str] = None) -> Dict[str, Any]:
+        """Create a cachedContents resource (explicit context cache)."""
+        return await self._request_json("POST", self.api_url("cachedContents"), body, api_key=api_key)
+
+    async def update_cached_content_ttl(self, name: str, ttl_seconds: int,
+                                        api_key: Optional[str] = None) -> Dict[str, Any]:
+        """Extend the expiry of an existing cachedContents resource."""
+        return await self._request_json(
+            "PATCH", self.api_url(name), {"ttl": f"{ttl_seconds}s"}, params={"updateMask": "ttl"}, api_key=api_key
+        )
+
+    async def upload_file(self, data: bytes, mime_type: str, display_name: Optional[str] = None,
+                          api_key: Optional[str] = None) -> Dict[str, Any]:
+        """Upload bytes through the Files API (resumable protocol, one chunk); returns the File resource."""
+        headers = {
+            **self._headers(api_key),
+            "X-Goog-Upload-Protocol": "resumable",
+            "X-Goog-Upload-Command": "start",
+            "X-Goog-Upload-Header-Content-Length": str(len(data)),
+            "X-Goog-Upload-Header-Content-Type": mime_type,
+        }
+        metadata = {"file": {"displayName": display_name}} if display_name else {}
+        try:
+            start = await self.client.post(self.upload_url("files"), headers=headers, json=metadata)
+            self._observe(api_key, start)
+            if start.status_code >= 400:
+                raise self._error_from_response(start.status_code, start.content, start.headers)
+            session_url = start.headers.get("x-goog-upload-url")
+            if not session_url:
+                raise GeminiAPIError(start.status_code, "Files API did not return an upload URL")
+            response = await self.client.post(session_url, content=data, headers={
+                "Content-Length": str(len(data)),
+                "X-Goog-Upload-Offset": "0",
+                "X-Goog-Upload-Command": "upload, finalize",
+            })
+        except httpx.TimeoutException as e:
+            raise TimeoutError(f"Gemini upload timed out: {e}") from e
+        except httpx.TransportError as e:
+            raise ConnectionError(f"Gemini upload failed: {e}") from e
+        self._observe(api_key, response)
+        if response.status_code >= 400:
+            raise self._error_from_response(response.status_code, response.content, response.headers)
+        return response.json().get("file", {})
+
+    async def stream_generate_content(self, model: str, body: Dict[str, Any],
+                                      api_key: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Open a streamGenerateContent call and return an iterator of delta chunks.
+
+        Connection and HTTP status errors are raised here, before the first chunk,
+        so the caller's streaming retry loop can react to them.
+        """
+        compress = True
+        while True:
+            args = await self._body_args(body, api_key, compress)
+            request = self.client.build_request(
+                "POST",
+                self.model_url(model, "streamGenerateContent"),
+                params={"alt": "sse"},
+                **args,
+            )
+            try:
+                response = await self.client.send(request, stream=True)
+            except httpx.TimeoutException as e:
+                raise TimeoutError(f"Gemini request timed out: {e}") from e
+            except httpx.TransportError as e:
+                raise ConnectionError(f"Gemini connection failed: {e}") from e
+
+            self._observe(api_key, response)
+            if response.status_code < 400:
+                break
+            error_body = await response.aread()
+            await response.aclose()
+            if compress and self._compression_rejected(args, response.status_code, error_body):
+                compress = False
+                continue
+            raise self._error_from_response(response.status_code, error_body, response.headers)
+
+        return self._iter_stream(response)
+
+    async def _iter_stream(self, response: httpx.Response) -> AsyncIterator[Dict[str, Any]]:
+        try:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if not payload:
+                    continue
+                yield gemini_stream_event_to_chunk(json.loads(payload))
+        except httpx.TimeoutException as e:
+            raise TimeoutError(f"Gemini stream timed out: {e}") from e
+        except httpx.TransportError as e:
+            raise ConnectionError(f"Gemini stream interrupted: {e}") from e
+        finally:
+            await response.aclose()
@@ -0,0 +1,171 @@
+"""Hedged upstream requests for the long latency tail.
+
+A small share of Gemini calls takes many times the median before producing
+anything. When hedging is on, an attempt that has not answered (non-streaming)
+or produced its first chunk (streaming) within the model's observed latency
+percentile gets a second, identical attempt. Whichever succeeds first wins and
+the other one is cancelled. The second attempt takes its own key from the pool,
+so with several keys it usually goes out on a different one.
+
+Hedges are capped at a fraction of recent requests so a slow upstream cannot
+double quota use, and no hedging happens until enough latency samples exist.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Window for the hedge-rate budget (seconds)
+HEDGE_BUDGET_WINDOW_SECONDS = 60
+
+
+class LatencyTracker:
+    """Recent latency samples for one (model, phase) with percentile lookups."""
+
+    def __init__(self, window: int = 200):
+        self.samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(int(len(ordered) * percentile / 100), len(ordered) - 1)
+        return ordered[index]
+
+
+class Hedger:
+    """Starts a backup attempt when the first one is slower than the adaptive threshold."""
+
+    def __init__(self, percentile: float = 90, min_delay: float = 0.3, max_rate: float = 0.1,
+                 min_samples: int = 20):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self.trackers: Dict[Hashable, LatencyTracker] = {}
+        self._requests: Deque[float] = deque()
+        self._hedges: Deque[float] = deque()
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_denied = 0
+
+    def tracker(self, key: Hashable) -> LatencyTracker:
+        tracker = self.trackers.get(key)
+        if tracker is None:
+            tracker = self.trackers[key] = LatencyTracker()
+        return tracker
+
+    def threshold(self, key: Hashable) -> Optional[float]:
+        """Delay before hedging, or None while there are too few samples."""
+        tracker = self.tracker(key)
+        if len(tracker.samples) < self.min_samples:
+            return None
+        return max(tracker.percentile(self.percentile), self.min_delay)
+
+    def _trim(self, now: float):
+        for timestamps in (self._requests, self._hedges):
+            while timestamps and timestamps[0] < now - HEDGE_BUDGET_WINDOW_SECONDS:
+                timestamps.popleft()
+
+    def _hedge_allowed(self) -> bool:
+        now = time.monotonic()
+        self._trim(now)
+        if len(self._hedges) + 1 > self.max_rate * len(self._requests):
+            self.budget_denied += 1
+            return False
+        self._hedges.append(now)
+        return True
+
+    async def _timed(self, key: Hashable, attempt: Callable[[], Awaitable[T]]) -> T:
+        start = time.monotonic()
+        try:
+            result = await attempt()
+        except asyncio.CancelledError:
+            # A hedged-away attempt took at least this long; dropping it would leave only
+            # the fast attempts in the window and pull the threshold down over time
+            self.tracker(key).record(time.monotonic() - start)
+            raise
+        self.tracker(key).record(time.monotonic() - start)
+        return result
+
+    async def run(self, key: Hashable, attempt: Callable[[], Awaitable[T]],
+                  discard: Optional[Callable[[T], Awaitable[None]]] = None) -> T:
+        """Return the first successful result of ``attempt()``, hedging once when it is slow.
+
+        ``discard`` cleans up a losing result that completed anyway (e.g. closes a stream).
+        """
+        self.calls += 1
+        self._requests.append(time.monotonic())
+        delay = self.threshold(key)
+        primary = asyncio.ensure_future(self._timed(key, attempt))
+        if delay is None:
+            return await primary
+
+        backup = None
+        try:
+            done, _ = await asyncio.wait({primary}, timeout=delay)
+            if done or not self._hedge_allowed():
+                return await primary
+
+            self.hedged += 1
+            logger.debug(f"🪃 Hedging slow upstream call for {key} after {delay:.2f}s")
+            backup = asyncio.ensure_future(self._timed(key, attempt))
+            pending = {primary, backup}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = error or task.exception()
+                        continue
+                    if task is backup:
+                        self.hedge_wins += 1
+                    for loser in pending | (done - {task}):
+                        await self._cancel(loser, discard)
+                    return task.result()
+            raise error
+        except asyncio.CancelledError:
+            for task in (primary, backup):
+                if task is not None:
+                    await self._cancel(task, discard)
+            raise
+
+    @staticmethod
+    async def _cancel(task: asyncio.Future, discard: Optional[Callable[[Any], Awaitable[None]]]):
+        if not task.done():
+            task.cancel()
+            try:
+                await task
+            except BaseException:
+                pass
+            return
+        if not task.cancelled() and task.exception() is None and discard is not None:
+            try:
+                await discard(task.result())
+            except Exception as e:
+                logger.debug(f"Failed to discard losing hedged attempt: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": True,
+            "percentile": self.percentile,
+            "max_rate": self.max_rate,
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "budget_denied": self.budget_denied,
+            "thresholds": {
+                ":".join(key): round(threshold, 3)
+                for key, threshold in ((key, self.threshold(key)) for key in self.trackers)
+                if threshold is not None
+            },
+        }
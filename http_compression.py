@@ -0,0 +1,234 @@
+"""Compressed transport between clients and the proxy.
+
+* Request bodies sent with ``Content-Encoding: gzip``, ``deflate`` or ``zstd``
+  are decoded before parsing, with a cap on the decoded size so a small
+  compressed body cannot expand without bound.
+* ``CompressionMiddleware`` compresses complete (non-streaming) responses
+  with the best encoding the client accepts (``zstd`` or ``gzip``) once they
+  reach a size threshold. SSE streams are left alone: their events must
+  reach the client as they are produced.
+
+zstd needs the optional ``zstandard`` package; without it only gzip and
+deflate are available.
+"""
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+try:
+    import zstandard
+    _DECODE_ERRORS = (zlib.error, zstandard.ZstdError)
+except ImportError:
+    zstandard = None
+    _DECODE_ERRORS = (zlib.error,)
+
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Content types worth compressing (SSE excluded on purpose)
+COMPRESSIBLE_TYPES = ("application/json", "text/plain", "text/html")
+
+
+class UnsupportedEncoding(ValueError):
+    """A request Content-Encoding the proxy cannot decode."""
+
+
+class BodyTooLarge(ValueError):
+    """A request body that decodes to more than the allowed size."""
+
+
+def request_encodings() -> Tuple[str, ...]:
+    return ("gzip", "deflate", "zstd") if zstandard is not None else ("gzip", "deflate")
+
+
+def _inflate(body: bytes, wbits: int, max_bytes: int) -> bytes:
+    output: List[bytes] = []
+    size = 0
+    # Concatenated gzip members are one valid body, so keep going while data is left
+    while body:
+        decompressor = zlib.decompressobj(wbits)
+        chunk = decompressor.decompress(body, max_bytes + 1 - size)
+        size += len(chunk)
+        if size > max_bytes or decompressor.unconsumed_tail:
+            raise BodyTooLarge(f"request body decodes to more than {max_bytes} bytes")
+        if not decompressor.eof:
+            raise ValueError("truncated compressed request body")
+        output.append(chunk)
+        body = decompressor.unused_data
+    return b"".join(output)
+
+
+def _unzstd(body: bytes, max_bytes: int) -> bytes:
+    output: List[bytes] = []
+    size = 0
+    with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+        while True:
+            chunk = reader.read(min(max_bytes + 1 - size, 1024 * 1024))
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise BodyTooLarge(f"request body decodes to more than {max_bytes} bytes")
+            output.append(chunk)
+    return b"".join(output)
+
+
+def decode_body(body: bytes, content_encoding: Optional[str], max_bytes: int) -> bytes:
+    """Undo a request's Content-Encoding (codings are listed in the order they were applied).
+
+    Raises UnsupportedEncoding, BodyTooLarge, or ValueError for a corrupt body.
+    """
+    if not content_encoding:
+        return body
+    for coding in reversed([coding.strip().lower() for coding in content_encoding.split(",")]):
+        if coding in ("", "identity"):
+            continue
+        try:
+            if coding in ("gzip", "x-gzip"):
+                body = _inflate(body, 16 + zlib.MAX_WBITS, max_bytes)
+            elif coding == "deflate":
+                # RFC 9110 deflate is zlib-wrapped; some clients send a raw stream
+                wbits = zlib.MAX_WBITS if body[:1] == b"\x78" else -zlib.MAX_WBITS
+                body = _inflate(body, wbits, max_bytes)
+            elif coding == "zstd" and zstandard is not None:
+                body = _unzstd(body, max_bytes)
+            else:
+                raise UnsupportedEncoding(f"unsupported Content-Encoding '{coding}' "
+                                          f"(supported: {', '.join(request_encodings())})")
+        except _DECODE_ERRORS as e:
+            raise ValueError(f"invalid {coding} request body: {e}") from e
+    return body
+
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    """Best response encoding for an Accept-Encoding header, or None for identity."""
+    qualities: Dict[str, float] = {}
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        qualities[coding.strip()] = quality
+    wildcard = qualities.get("*", 0.0)
+    best, best_quality = None, 0.0
+    for coding in (("zstd", "gzip") if zstandard is not None else ("gzip",)):
+        quality = qualities.get(coding, wildcard)
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+
+def compress(body: bytes, coding: str) -> bytes:
+    if coding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(body)
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(body) + compressor.flush()
+
+
+class ResponseCompressor:
+    """Response compression settings and counters, shared with CompressionMiddleware."""
+
+    def __init__(self, minimum_size: int = 1024):
+        self.minimum_size = minimum_size
+        self.compressed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def compress(self, body: bytes, coding: str) -> bytes:
+        encoded = compress(body, coding)
+        self.compressed += 1
+        self.bytes_in += len(body)
+        self.bytes_out += len(encoded)
+        return encoded
+
+    def compressible(self, start: Dict[str, Any]) -> bool:
+        """Whether a response (by its start message) may be compressed."""
+        if start["status"] < 200 or start["status"] in (204, 304):
+            return False
+        content_type = b""
+        for name, value in start.get("headers", ()):
+            if name == b"content-encoding":
+                return False
+            if name == b"content-type":
+                content_type = value
+            elif name == b"content-length" and int(value) < self.minimum_size:
+                return False
+        return content_type.decode("latin-1").startswith(COMPRESSIBLE_TYPES)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": True,
+            "min_bytes": self.minimum_size,
+            "encodings": ["zstd", "gzip"] if zstandard is not None else ["gzip"],
+            "compressed": self.compressed,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+        }
+
+
+class CompressionMiddleware:
+    """ASGI middleware: negotiated zstd/gzip for complete responses above the compressor's threshold.
+
+    Bodies may arrive in several messages (BaseHTTPMiddleware re-streams them),
+    so compressible responses are buffered until complete; a Content-Length
+    below the threshold, or an SSE / already-encoded response, passes through
+    untouched from the first message.
+    """
+
+    def __init__(self, app: Callable, compressor: ResponseCompressor):
+        self.app = app
+        self.compressor = compressor
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = ""
+        for name, value in scope.get("headers", ()):
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        coding = negotiate(accept) if accept else None
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Optional[Dict[str, Any]] = None
+        buffered: List[bytes] = []
+        passthrough = False
+
+        async def compressing_send(message: Dict[str, Any]):
+            nonlocal start, passthrough
+            if message["type"] == "http.response.start":
+                start = message
+                passthrough = not self.compressor.compressible(message)
+                if passthrough:
+                    await send(message)
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+            buffered.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+            body = b"".join(buffered)
+            buffered.clear()
+            if len(body) < self.compressor.minimum_size:
+                await send(start)
+                await send({"type": "http.response.body", "body": body})
+                return
+            encoded = self.compressor.compress(body, coding)
+            headers = [(name, value) for name, value in start["headers"] if name not in (b"content-length", b"vary")]
+            vary = [value for name, value in start["headers"] if name == b"vary"]
+            headers += [
+                (b"content-encoding", coding.encode("ascii")),
+                (b"content-length", str(len(encoded)).encode("ascii")),
+                (b"vary", b", ".join(vary + [b"Accept-Encoding"])),
+            ]
+            await send({**start, "headers": headers})
+            await send({"type": "http.response.body", "body": encoded})
+
+        await self.app(scope, receive, compressing_send)
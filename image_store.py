@@ -0,0 +1,248 @@
+"""Content-addressed upload cache for images in the conversation history.
+
+Agents keep screenshots in their history, so without this every turn resends
+the same base64 images inline. With IMAGE_UPLOAD_CACHE on, an image above
+IMAGE_UPLOAD_MIN_KB is uploaded once through the Gemini Files API, keyed by a
+SHA-256 of its media type and data. Later turns send a file reference instead
+(``fileData`` for the native engine, a Files API ``image_url`` for LiteLLM).
+
+The first request that contains an image still sends it inline and uploads
+it in the background, so it never waits on the upload. Files belong to the
+uploading key's project, so uploads are tracked per API key. Gemini deletes
+files 48 hours after upload, so entries expire with the ``expirationTime``
+the API reports, minus a safety margin. A request whose file Gemini no longer
+knows is resent inline by the caller (see ``is_stale_file_error``).
+"""
+import asyncio
+import base64
+import hashlib
+import logging
+import re
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, Hashable, List, Optional, Set, Tuple
+
+from cache_utils import LRUCache
+from gemini_native import GeminiNativeClient
+
+logger = logging.getLogger(__name__)
+
+# Gemini keeps Files API uploads for 48 hours
+DEFAULT_TTL_SECONDS = 48 * 3600
+
+# Stop handing out a file this long before Gemini deletes it
+EXPIRY_MARGIN_SECONDS = 600
+
+# After a failed upload, send the image inline for this long before trying again
+UPLOAD_RETRY_SECONDS = 300
+
+# Payload bytes the digest memo may keep alive (it holds the strings to compare on a hit)
+DIGEST_MEMO_MAX_BYTES = 64 * 1024 * 1024
+
+_FRACTION_RE = re.compile(r"\.(\d+)")
+
+
+def is_stale_file_error(error: BaseException) -> bool:
+    """True when Gemini rejected a request because a referenced file is gone or not ours."""
+    status_code = getattr(error, "status_code", None)
+    message = str(getattr(error, "message", None) or error).lower()
+    return status_code in (400, 403, 404) and "file" in message
+
+
+def parse_expiration(value: Optional[str]) -> Optional[float]:
+    """Unix time of an RFC 3339 timestamp such as ``2025-01-01T12:00:00.123456789Z``."""
+    if not value:
+        return None
+    try:
+        # fromisoformat accepts at most microseconds and no "Z" before Python 3.11
+        value = _FRACTION_RE.sub(lambda m: "." + m.group(1)[:6].ljust(6, "0"), value.replace("Z", "+00:00"))
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        return None
+
+
+@dataclass
+class UploadedFile:
+    name: str
+    uri: str
+    mime_type: str
+    size: int
+    expire_at: float
+
+
+class GeminiImageStore:
+    """Uploads history images once and swaps later inline copies for file references."""
+
+    def __init__(self, client: GeminiNativeClient, min_bytes: int = 32 * 1024,
+                 ttl_seconds: int = DEFAULT_TTL_SECONDS, max_entries: int = 1024):
+        self.client = client
+        self.min_bytes = min_bytes
+        self.ttl_seconds = ttl_seconds
+        # (digest, api_key) -> UploadedFile
+        self.files = LRUCache(max_entries)
+        # hash of the payload string -> (payload, digest); str hashes are cached on the
+        # object, so images from the conversation cache are not re-hashed every turn.
+        # Weighted by payload size so old images are not pinned in memory
+        self._digests = LRUCache(max_entries * 4, max_weight=DIGEST_MEMO_MAX_BYTES)
+        self._failed = LRUCache(max_entries)
+        self._uploading: Dict[Hashable, asyncio.Task] = {}
+        self._background: Set[asyncio.Task] = set()
+        self.uploads = 0
+        self.upload_failures = 0
+        self.uploaded_bytes = 0
+        self.referenced = 0
+        self.referenced_bytes = 0
+        self.inlined = 0
+
+    def _digest(self, payload: str, mime_type: str, data) -> str:
+        """SHA-256 of the image; ``data`` returns the base64 string (only called on a memo miss)."""
+        memo_key = hash(payload)
+        cached = self._digests.get(memo_key)
+        if cached is not None and (cached[0] is payload or cached[0] == payload):
+            return cached[1]
+        digest = hashlib.sha256(mime_type.encode("utf-8") + b"\0")
+        digest.update(data().encode("ascii"))
+        digest = digest.hexdigest()
+        self._digests.set(memo_key, (payload, digest), weight=len(payload))
+        return digest
+
+    def _live_file(self, key: Hashable) -> Optional[UploadedFile]:
+        uploaded = self.files.get(key)
+        if uploaded is None or uploaded.expire_at - EXPIRY_MARGIN_SECONDS <= time.monotonic():
+            return None
+        return uploaded
+
+    def reference(self, payload: str, mime_type: str, data, size: int,
+                  api_key: Optional[str]) -> Tuple[Optional[UploadedFile], Optional[Hashable]]:
+        """The uploaded file for an image, starting a background upload on first sight.
+
+        ``payload`` is the string the image arrived in (used to memoize its digest),
+        ``data`` a callable returning its base64 data. Returns (None, None) when the
+        image should be sent inline.
+        """
+        if size < self.min_bytes:
+            return None, None
+        key = (self._digest(payload, mime_type, data), api_key)
+        uploaded = self._live_file(key)
+        if uploaded is not None:
+            self.referenced += 1
+            self.referenced_bytes += size
+            return uploaded, key
+        self.inlined += 1
+        self._upload_in_background(key, mime_type, data)
+        return None, None
+
+    def _upload_in_background(self, key: Hashable, mime_type: str, data):
+        if key in self._uploading or self._failed.get(key, 0) > time.monotonic():
+            return
+        task = asyncio.ensure_future(self._upload(key, mime_type, data()))
+        self._uploading[key] = task
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        task.add_done_callback(lambda _: self._uploading.pop(key, None))
+
+    async def _upload(self, key: Hashable, mime_type: str, data: str):
+        digest, api_key = key
+        try:
+            image_bytes = base64.b64decode(data)
+            response = await self.client.upload_file(image_bytes, mime_type, display_name=f"image-{digest[:32]}",
+                                                     api_key=api_key)
+            if response.get("state", "ACTIVE") != "ACTIVE" or not response.get("uri"):
+                raise ValueError(f"file {response.get('name')} is not usable (state {response.get('state')})")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.upload_failures += 1
+            self._failed.set(key, time.monotonic() + UPLOAD_RETRY_SECONDS)
+            logger.warning(f"Image upload to the Gemini Files API failed, sending inline: {e}")
+            return
+
+        ttl = self.ttl_seconds
+        expires = parse_expiration(response.get("expirationTime"))
+        if expires is not None:
+            ttl = min(ttl, expires - time.time())
+        self.files.set(key, UploadedFile(
+            name=response.get("name", ""),
+            uri=response["uri"],
+            mime_type=mime_type,
+            size=len(image_bytes),
+            expire_at=time.monotonic() + ttl,
+        ))
+        self.uploads += 1
+        self.uploaded_bytes += len(image_bytes)
+        logger.debug(f"Uploaded image {digest[:12]} as {response.get('name')} ({len(image_bytes)} bytes)")
+
+    def invalidate(self, keys: List[Hashable]):
+        """Forget files Gemini no longer recognises (deleted or expired server-side)."""
+        for key in keys:
+            if key in self.files:
+                self.files.set(key, None)
+
+    def rewrite_gemini(self, body: Dict[str, Any], api_key: Optional[str]) -> Tuple[Dict[str, Any], List[Hashable]]:
+        """Native request body with uploaded images as ``fileData`` parts, plus the file keys used.
+
+        Contents may be shared with the conversation cache, so changed ones are copied.
+        """
+        keys = []
+        contents = []
+        for content in body.get("contents", []):
+            parts = None
+            for index, part in enumerate(content.get("parts", ())):
+                inline = part.get("inlineData")
+                if inline is None:
+                    continue
+                image = inline["data"]
+                uploaded, key = self.reference(image, inline["mimeType"], lambda: image, len(image), api_key)
+                if uploaded is None:
+                    continue
+                if parts is None:
+                    parts = list(content["parts"])
+                parts[index] = {"fileData": {"mimeType": uploaded.mime_type, "fileUri": uploaded.uri}}
+                keys.append(key)
+            contents.append(content if parts is None else {**content, "parts": parts})
+        if not keys:
+            return body, keys
+        return {**body, "contents": contents}, keys
+
+    def rewrite_litellm(self, body: Dict[str, Any], api_key: Optional[str]) -> Tuple[Dict[str, Any], List[Hashable]]:
+        """LiteLLM request with uploaded images as Files API ``image_url`` parts, plus the file keys used."""
+        keys = []
+        messages = []
+        for message in body.get("messages", []):
+            content = message.get("content")
+            parts = None
+            if isinstance(content, list):
+                for index, part in enumerate(content):
+                    if part.get("type") != "image_url":
+                        continue
+                    url = part["image_url"].get("url", "")
+                    if not url.startswith("data:") or ";base64," not in url[:128]:
+                        continue
+                    mime_type = url[5:url.index(";")]
+                    uploaded, key = self.reference(url, mime_type, lambda: url[url.index(",") + 1:],
+                                                   len(url), api_key)
+                    if uploaded is None:
+                        continue
+                    if parts is None:
+                        parts = list(content)
+                    parts[index] = {"type": "image_url", "image_url": {"url": uploaded.uri, "format": uploaded.mime_type}}
+                    keys.append(key)
+            messages.append(message if parts is None else {**message, "content": parts})
+        if not keys:
+            return body, keys
+        return {**body, "messages": messages}, keys
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": True,
+            "files": len(self.files),
+            "uploads": self.uploads,
+            "upload_failures": self.upload_failures,
+            "uploading": len(self._uploading),
+            "uploaded_bytes": self.uploaded_bytes,
+            "referenced": self.referenced,
+            "referenced_bytes": self.referenced_bytes,
+            "inlined": self.inlined,
+            "min_bytes": self.min_bytes,
+        }
@@ -0,0 +1,280 @@
+"""Gemini API key pool with quota-aware scheduling.
+
+Spreads upstream requests over several API keys (GEMINI_API_KEYS) so one
+proxy instance is not capped by a single key's RPM/TPM quota. Each key tracks
+its in-flight requests, recent 429s and, when upstream reports it, the
+remaining request/token quota. A key that gets rate limited cools down
+(Retry-After / RetryInfo when given, exponential backoff otherwise) and is
+skipped until the cooldown ends, unless every key is cooling down.
+
+Selection strategies:
+
+* ``least_load``: fewest in-flight requests per unit of weight, preferring
+  keys with quota left and fewer recent 429s;
+* ``weighted_round_robin``: smooth weighted round robin over available keys.
+
+With several worker processes, cooldowns, consecutive 429s and reported quota
+are kept in a ``SharedState`` (keys are stored by hash), so a key rate limited
+in one worker is skipped by all of them. In-flight counts stay per worker.
+While the shared state is unavailable each worker schedules with what it
+knows locally.
+"""
+import hashlib
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Dict, List, Mapping, Optional
+
+from shared_state import SharedStateUnavailable
+
+logger = logging.getLogger(__name__)
+
+# Window used for the "recent 429s" statistic
+RATE_LIMIT_WINDOW_SECONDS = 60
+
+# How long key states read from the shared state are reused before reading them again
+SHARED_SYNC_INTERVAL_SECONDS = 0.5
+
+# Upstream quota headers (LiteLLM forwards them with an "llm_provider-" prefix)
+REMAINING_REQUESTS_HEADER = "x-ratelimit-remaining-requests"
+REMAINING_TOKENS_HEADER = "x-ratelimit-remaining-tokens"
+
+
+def mask_key(api_key: str) -> str:
+    return f"...{api_key[-4:]}" if len(api_key) >= 4 else "****"
+
+
+def key_id(api_key: str) -> str:
+    """Stable identifier for a key in shared state, without storing the key itself."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:24]
+
+
+class KeyState:
+    """Scheduling state and counters for one API key."""
+
+    def __init__(self, api_key: str, weight: float = 1.0):
+        self.api_key = api_key
+        self.key_id = key_id(api_key)
+        self.weight = max(weight, 0.01)
+        self.in_flight = 0
+        self.requests = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.consecutive_rate_limits = 0
+        self.cooldown_until = 0.0
+        self.remaining_requests: Optional[int] = None
+        self.remaining_tokens: Optional[int] = None
+        self.last_used = 0.0
+        self.current_weight = 0.0  # smooth weighted round robin state
+        self.recent_rate_limits = deque()
+
+    def cooling_down(self, now: float) -> bool:
+        return self.cooldown_until > now
+
+    def recent_rate_limit_count(self, now: float) -> int:
+        while self.recent_rate_limits and self.recent_rate_limits[0] < now - RATE_LIMIT_WINDOW_SECONDS:
+            self.recent_rate_limits.popleft()
+        return len(self.recent_rate_limits)
+
+    def quota_exhausted(self) -> bool:
+        return self.remaining_requests == 0 or self.remaining_tokens == 0
+
+
+class KeyLease:
+    """One request's claim on a key; release exactly once with the outcome."""
+
+    def __init__(self, pool: "KeyPool", state: KeyState):
+        self._pool = pool
+        self._state = state
+        self._released = False
+
+    @property
+    def key(self) -> str:
+        return self._state.api_key
+
+    def release(self, rate_limited: bool = False, failed: bool = False, retry_after: Optional[float] = None):
+        if self._released:
+            return
+        self._released = True
+        self._pool._release(self._state, rate_limited, failed, retry_after)
+
+    async def hold(self, stream: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        """Yield from ``stream``, keeping the key counted as in flight until it ends."""
+        try:
+            async for chunk in stream:
+                yield chunk
+        except Exception:
+            self.release(failed=True)
+            raise
+        finally:
+            self.release()
+
+
+class KeyPool:
+    """Chooses an API key per upstream request and learns from the outcome."""
+
+    def __init__(self, api_keys: List[str], weights: Optional[List[float]] = None,
+                 strategy: str = "least_load", cooldown_seconds: float = 30.0,
+                 max_cooldown_seconds: float = 300.0, shared=None):
+        if not api_keys:
+            raise ValueError("KeyPool needs at least one API key")
+        weights = weights or []
+        self.keys = [KeyState(key, weights[i] if i < len(weights) else 1.0) for i, key in enumerate(api_keys)]
+        self._by_key = {state.api_key: state for state in self.keys}
+        self.strategy = strategy
+        self.cooldown_seconds = cooldown_seconds
+        self.max_cooldown_seconds = max_cooldown_seconds
+        self.shared = shared
+        self._synced_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _sync_shared(self, now: float):
+        """Take cooldowns and quota recorded by other workers (wall clock -> monotonic).
+
+        Read at most once per SHARED_SYNC_INTERVAL_SECONDS. Local cooldowns are
+        kept when longer, since this worker's own updates are written in the
+        background and may not be in the table yet.
+        """
+        if now - self._synced_at < SHARED_SYNC_INTERVAL_SECONDS:
+            return
+        self._synced_at = now
+        offset = now - time.time()
+        try:
+            shared_states = self.shared.key_states()
+        except SharedStateUnavailable:
+            return
+        for state in self.keys:
+            row = shared_states.get(state.key_id)
+            if row is not None:
+                cooldown_until, state.consecutive_rate_limits, state.remaining_requests, state.remaining_tokens = row
+                if cooldown_until:
+                    state.cooldown_until = max(state.cooldown_until, cooldown_until + offset)
+
+    def has_available(self) -> bool:
+        now = time.monotonic()
+        if self.shared is not None:
+            with self._lock:
+                self._sync_shared(now)
+        return any(not state.cooling_down(now) for state in self.keys)
+
+    def acquire(self) -> KeyLease:
+        """Pick a key for one request and count it as in flight."""
+        with self._lock:
+            now = time.monotonic()
+            if self.shared is not None:
+                self._sync_shared(now)
+            candidates = [state for state in self.keys if not state.cooling_down(now)]
+            if not candidates:
+                # Everything is cooling down: use the key that recovers first
+                state = min(self.keys, key=lambda s: s.cooldown_until)
+            elif len(candidates) == 1:
+                state = candidates[0]
+            elif self.strategy == "weighted_round_robin":
+                state = self._pick_weighted_round_robin(candidates)
+            else:
+                state = min(candidates, key=lambda s: (
+                    s.quota_exhausted(),
+                    s.in_flight / s.weight,
+                    s.recent_rate_limit_count(now),
+                    s.last_used,
+                ))
+            state.in_flight += 1
+            state.requests += 1
+            state.last_used = now
+            return KeyLease(self, state)
+
+    @staticmethod
+    def _pick_weighted_round_robin(candidates: List[KeyState]) -> KeyState:
+        # Smooth WRR (as in nginx): spreads picks evenly instead of in bursts
+        total = 0.0
+        best = None
+        for state in candidates:
+            state.current_weight += state.weight
+            total += state.weight
+            if best is None or state.current_weight > best.current_weight:
+                best = state
+        best.current_weight -= total
+        return best
+
+    def _release(self, state: KeyState, rate_limited: bool, failed: bool, retry_after: Optional[float]):
+        with self._lock:
+            state.in_flight = max(state.in_flight - 1, 0)
+            if rate_limited:
+                now = time.monotonic()
+                state.rate_limited += 1
+                state.consecutive_rate_limits += 1
+                state.recent_rate_limits.append(now)
+                if self.shared is not None:
+                    # Written off the event loop; the cooldown applies locally right away
+                    self.shared.submit(self._record_shared_rate_limit, state, retry_after)
+                if retry_after is None:
+                    retry_after = min(
+                        self.cooldown_seconds * 2 ** (state.consecutive_rate_limits - 1),
+                        self.max_cooldown_seconds,
+                    )
+                state.cooldown_until = max(state.cooldown_until, now + retry_after)
+                logger.warning(f"API key {mask_key(state.api_key)} rate limited, cooling down for {retry_after:.0f}s")
+            elif failed:
+                state.failures += 1
+            else:
+                if self.shared is not None and state.consecutive_rate_limits:
+                    self.shared.submit(self.shared.reset_key_rate_limits, state.key_id)
+                state.consecutive_rate_limits = 0
+
+    def _record_shared_rate_limit(self, state: KeyState, retry_after: Optional[float]):
+        """Count a 429 in the shared state (background thread) and apply the proxy-wide backoff."""
+        cooldown, consecutive = self.shared.record_key_rate_limit(
+            state.key_id, retry_after, self.cooldown_seconds, self.max_cooldown_seconds)
+        with self._lock:
+            state.consecutive_rate_limits = max(state.consecutive_rate_limits, consecutive)
+            state.cooldown_until = max(state.cooldown_until, time.monotonic() + cooldown)
+
+    def observe_headers(self, api_key: str, headers: Optional[Mapping[str, str]]):
+        """Record remaining-quota headers reported by upstream for ``api_key``."""
+        state = self._by_key.get(api_key)
+        if state is None or not headers:
+            return
+        reported = (state.remaining_requests, state.remaining_tokens)
+        for name, value in headers.items():
+            name = name.lower()
+            if name.startswith("llm_provider-"):
+                name = name[len("llm_provider-"):]
+            try:
+                if name == REMAINING_REQUESTS_HEADER:
+                    state.remaining_requests = int(float(value))
+                elif name == REMAINING_TOKENS_HEADER:
+                    state.remaining_tokens = int(float(value))
+            except (TypeError, ValueError):
+                continue
+        if self.shared is not None and (state.remaining_requests, state.remaining_tokens) != reported:
+            self.shared.submit(self.shared.set_key_quota, state.key_id, state.remaining_requests,
+                               state.remaining_tokens)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        if self.shared is not None:
+            with self._lock:
+                self._sync_shared(now)
+        return {
+            "strategy": self.strategy,
+            "shared": self.shared is not None,
+            "keys": [
+                {
+                    "key": mask_key(state.api_key),
+                    "weight": state.weight,
+                    "in_flight": state.in_flight,
+                    "requests": state.requests,
+                    "failures": state.failures,
+                    "rate_limited": state.rate_limited,
+                    "recent_rate_limits": state.recent_rate_limit_count(now),
+                    "cooldown_remaining": round(max(state.cooldown_until - now, 0.0), 1),
+                    "remaining_requests": state.remaining_requests,
+                    "remaining_tokens": state.remaining_tokens,
+                }
+                for state in self.keys
+            ],
+        }
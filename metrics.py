@@ -0,0 +1,165 @@
+"""Minimal in-process Prometheus metrics (text exposition format 0.0.4).
+
+Counters, gauges and histograms keyed by label-value tuples, cheap enough to
+update on every request and every stream. No prometheus_client dependency:
+each process renders its own samples. With several worker processes, every
+worker publishes a ``snapshot()`` and /metrics renders the sum over workers.
+"""
+import bisect
+from typing import Any, Dict, Iterable, List, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+    def merge(self, samples: List[list]):
+        """Add another process's snapshot samples ([label values, value] pairs) to this metric."""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, *label_values: str, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def merge(self, samples: List[list]):
+        for label_values, value in samples:
+            self.inc(*label_values, amount=value)
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for label_values, value in self.values.items():
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *label_values: str, amount: float = 1):
+        self.inc(*label_values, amount=-amount)
+
+    def set(self, *label_values: str, value: float):
+        self.values[label_values] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Iterable[float] = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last one is +Inf), sum]
+        self.values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, *label_values: str):
+        series = self.values.get(label_values)
+        if series is None:
+            series = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def merge(self, samples: List[list]):
+        for label_values, (counts, total) in samples:
+            series = self.values.get(tuple(label_values))
+            if series is None:
+                series = self.values[tuple(label_values)] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0] = [mine + theirs for mine, theirs in zip(series[0], counts)]
+            series[1] += total
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for label_values, (counts, total) in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, label_values, le)} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Owns the metrics and renders them for the /metrics endpoint."""
+
+    CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def _register(self, metric: _Metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Iterable[float] = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def snapshot(self) -> Dict[str, Any]:
+        """JSON-serializable copy of every sample, for merging in another process."""
+        return {metric.name: [[list(label_values), value] for label_values, value in metric.values.items()]
+                for metric in self.metrics}
+
+    def render(self, others: Sequence[Dict[str, Any]] = ()) -> str:
+        """Exposition text; ``others`` are snapshots of other processes, summed into the output."""
+        metrics = self.metrics
+        if others:
+            metrics = []
+            for metric in self.metrics:
+                merged = type(metric).__new__(type(metric))
+                merged.__dict__.update(metric.__dict__)
+                merged.values = {}
+                merged.merge(list(metric.values.items()))
+                for snapshot in others:
+                    merged.merge(snapshot.get(metric.name, ()))
+                metrics.append(merged)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
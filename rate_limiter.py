@@ -0,0 +1,237 @@
+"""Client-side RPM/TPM pacing per upstream model.
+
+Gemini enforces requests-per-minute and tokens-per-minute quotas per model and
+only tells us about them with a 429 after the fact; those rejected calls still
+count against the quota. This limiter keeps two token buckets per mapped model
+(requests and tokens) and paces calls locally before they are sent:
+
+* each call reserves one request plus its estimated prompt tokens and its
+  ``max_tokens`` output budget;
+* once the real ``usage`` is known the reservation is settled, refunding
+  unused output tokens (or charging a prompt that was underestimated);
+* the ratio between actual and estimated prompt tokens is tracked per model
+  and applied to later estimates, so the local tokenizer's bias is corrected.
+
+A call that would have to wait longer than ``max_wait`` is refused at once.
+With several worker processes the buckets live in a ``SharedState`` so the
+quota holds for the whole proxy, not once per worker; while the shared state
+is unavailable each worker paces with its own in-process buckets.
+"""
+import asyncio
+import logging
+import math
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from shared_state import SharedStateUnavailable
+
+logger = logging.getLogger(__name__)
+
+# Weight of the newest actual/estimated prompt ratio sample
+ESTIMATE_RATIO_ALPHA = 0.2
+
+
+class RateLimitExceeded(Exception):
+    """The local RPM/TPM budget cannot fit a call within the allowed wait."""
+
+    def __init__(self, model: str, retry_after: float):
+        super().__init__(f"Local rate limit for {model} exceeded, retry after {retry_after:.0f}s")
+        self.model = model
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Bucket refilled continuously at ``per_minute / 60`` units per second."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until ``amount`` can be taken; larger-than-capacity asks need a full bucket."""
+        self._refill(time.monotonic())
+        needed = min(amount, self.capacity)
+        if self.level >= needed:
+            return 0.0
+        return (needed - self.level) / self.rate
+
+    def take(self, amount: float):
+        self._refill(time.monotonic())
+        self.level -= amount
+
+    def adjust(self, amount: float):
+        """Give back (positive) or charge (negative) tokens after the fact."""
+        self._refill(time.monotonic())
+        self.level = min(self.capacity, self.level + amount)
+
+
+class SharedTokenBucket:
+    """TokenBucket kept in a SharedState, drawn from by every worker process."""
+
+    def __init__(self, shared, name: str, per_minute: float):
+        self.shared = shared
+        self.name = name
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+
+    @property
+    def level(self) -> float:
+        return self.shared.bucket_level(self.name, self.capacity, self.rate)
+
+    def ask(self, amount: float) -> Tuple[str, float, float, float]:
+        return self.name, self.capacity, self.rate, amount
+
+    def adjust(self, amount: float):
+        self.shared.adjust_bucket(self.name, self.capacity, self.rate, amount)
+
+
+class RateReservation:
+    """Budget reserved for one upstream call; settle with the real usage once known."""
+
+    def __init__(self, limiter: "ModelRateLimiter", estimated_prompt: int, reserved_tokens: int,
+                 shared: bool = False):
+        self._limiter = limiter
+        self.estimated_prompt = estimated_prompt
+        self.reserved_tokens = reserved_tokens
+        # Taken from the shared buckets (settled there) rather than the in-process ones
+        self.shared = shared
+        self._settled = False
+
+    def settle(self, prompt_tokens: int, output_tokens: int):
+        if self._settled:
+            return
+        self._settled = True
+        self._limiter._settle(self, prompt_tokens, output_tokens)
+
+
+class ModelRateLimiter:
+    """Request and token buckets for one upstream model."""
+
+    def __init__(self, model: str, rpm: int, tpm: int, max_wait: float = 30.0, shared=None):
+        self.model = model
+        self.shared = shared
+        # In-process buckets: the only ones without shared state, the fallback with it
+        self.local_requests = TokenBucket(rpm) if rpm > 0 else None
+        self.local_tokens = TokenBucket(tpm) if tpm > 0 else None
+        if shared is not None:
+            self.requests = SharedTokenBucket(shared, f"rpm:{model}", rpm) if rpm > 0 else None
+            self.tokens = SharedTokenBucket(shared, f"tpm:{model}", tpm) if tpm > 0 else None
+        else:
+            self.requests = self.local_requests
+            self.tokens = self.local_tokens
+        self.max_wait = max_wait
+        self.estimate_ratio = 1.0
+        # Serializes pacing so waiting calls are released in arrival order
+        self._lock = asyncio.Lock()
+        self.reserved = 0
+        self.paced = 0
+        self.total_wait = 0.0
+        self.rejected = 0
+        self.settled = 0
+        self.shared_fallbacks = 0
+
+    async def acquire(self, estimated_prompt: int, max_tokens: int) -> RateReservation:
+        prompt_tokens = math.ceil(estimated_prompt * self.estimate_ratio)
+        reserved_tokens = prompt_tokens + max_tokens if self.tokens is not None else 0
+        async with self._lock:
+            shared = False
+            if self.shared is not None:
+                # Checked and taken in one transaction so two workers cannot claim the same
+                # budget; the pacing wait below covers the debt this leaves in the buckets
+                asks = []
+                if self.requests is not None:
+                    asks.append(self.requests.ask(1))
+                if self.tokens is not None:
+                    asks.append(self.tokens.ask(reserved_tokens))
+                try:
+                    wait = await self.shared.run(self.shared.take_buckets, asks, self.max_wait)
+                    shared = True
+                except SharedStateUnavailable:
+                    self.shared_fallbacks += 1
+            if not shared:
+                wait = 0.0
+                if self.local_requests is not None:
+                    wait = self.local_requests.wait_time(1)
+                if self.local_tokens is not None:
+                    wait = max(wait, self.local_tokens.wait_time(reserved_tokens))
+            if wait > self.max_wait:
+                self.rejected += 1
+                raise RateLimitExceeded(self.model, wait)
+            if wait > 0:
+                self.paced += 1
+                self.total_wait += wait
+                logger.debug(f"⏳ Pacing {self.model} call for {wait:.2f}s (local RPM/TPM budget)")
+                await asyncio.sleep(wait)
+            if not shared:
+                if self.local_requests is not None:
+                    self.local_requests.take(1)
+                if self.local_tokens is not None:
+                    self.local_tokens.take(reserved_tokens)
+            self.reserved += 1
+        return RateReservation(self, estimated_prompt, reserved_tokens, shared)
+
+    def _settle(self, reservation: RateReservation, prompt_tokens: int, output_tokens: int):
+        self.settled += 1
+        if reservation.estimated_prompt > 0 and prompt_tokens > 0:
+            ratio = prompt_tokens / reservation.estimated_prompt
+            self.estimate_ratio += ESTIMATE_RATIO_ALPHA * (ratio - self.estimate_ratio)
+        amount = reservation.reserved_tokens - (prompt_tokens + output_tokens)
+        if reservation.shared and self.tokens is not None:
+            # Off the event loop; a failed refund is lost like any other while degraded
+            self.shared.submit(self.tokens.adjust, amount)
+        elif not reservation.shared and self.local_tokens is not None:
+            self.local_tokens.adjust(amount)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "rpm": int(self.requests.capacity) if self.requests is not None else None,
+            "tpm": int(self.tokens.capacity) if self.tokens is not None else None,
+            "reserved": self.reserved,
+            "settled": self.settled,
+            "paced": self.paced,
+            "rejected": self.rejected,
+            "avg_pacing_wait_s": round(self.total_wait / self.paced, 2) if self.paced else 0.0,
+            "estimate_ratio": round(self.estimate_ratio, 3),
+        }
+        if self.shared is not None:
+            stats["shared_fallbacks"] = self.shared_fallbacks
+        try:
+            if self.requests is not None:
+                stats["requests_available"] = round(self.requests.level, 1)
+            if self.tokens is not None:
+                stats["tokens_available"] = int(self.tokens.level)
+        except SharedStateUnavailable:
+            pass
+        return stats
+
+
+class RateLimiter:
+    """Per-model limiters; models without a configured quota use the default one (0 = unlimited)."""
+
+    def __init__(self, model_limits: Dict[str, Tuple[int, int]], default_limits: Tuple[int, int] = (0, 0),
+                 max_wait: float = 30.0, shared=None):
+        self.model_limits = dict(model_limits)
+        self.default_limits = default_limits
+        self.max_wait = max_wait
+        self.shared = shared
+        self.limiters: Dict[str, Optional[ModelRateLimiter]] = {}
+
+    def limiter(self, model: str) -> Optional[ModelRateLimiter]:
+        if model not in self.limiters:
+            rpm, tpm = self.model_limits.get(model, self.default_limits)
+            self.limiters[model] = ModelRateLimiter(model, rpm, tpm, self.max_wait, self.shared) if rpm > 0 or tpm > 0 else None
+        return self.limiters[model]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": True,
+            "shared": self.shared is not None,
+            "max_wait": self.max_wait,
+            "models": {model: limiter.stats() for model, limiter in self.limiters.items() if limiter is not None},
+        }
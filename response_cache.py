@@ -0,0 +1,211 @@
+"""Two-tier response cache for repeatable /v1/messages requests.
+
+Responses are stored under a canonical hash of the converted upstream request.
+The memory tier is an LRU of decoded responses; the optional disk tier is a
+SQLite database (WAL mode) that survives restarts and is bounded by TTL and a
+total size cap, evicting least-recently-used rows first. Disk access runs on a
+single dedicated thread so the event loop never waits on I/O and the SQLite
+connection is only ever touched from one thread. Worker processes of a
+multi-worker proxy can point at the same database file and share the tier.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Optional, Tuple
+
+from cache_utils import LRUCache, fingerprint
+
+logger = logging.getLogger(__name__)
+
+# Keys of a converted request that do not influence the generated answer
+VOLATILE_REQUEST_KEYS = ("stream", "stream_options", "api_key", "extra_headers", "base_url", "api_base")
+
+# Run expired-row cleanup at most this often (seconds)
+DISK_SWEEP_INTERVAL = 60
+
+
+def response_cache_key(engine: str, model: str, upstream_request: Dict[str, Any],
+                       client_model: Optional[str] = None) -> str:
+    """Canonical hash of a converted request, shared by streaming and non-streaming calls.
+
+    ``client_model`` is the model name the client sent, which the cached
+    response echoes; aliases of the same upstream model get separate entries.
+    """
+    canonical = {key: value for key, value in upstream_request.items() if key not in VOLATILE_REQUEST_KEYS}
+    return fingerprint([engine, model, client_model or model, canonical])
+
+
+class DiskResponseStore:
+    """SQLite-backed response store with TTL and size-based LRU eviction (blocking API)."""
+
+    def __init__(self, path: str, max_bytes: int):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, expires_at REAL NOT NULL, last_access REAL NOT NULL, "
+            "size INTEGER NOT NULL, body BLOB NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        self._db.commit()
+        self._last_sweep = 0.0
+        self.total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[Tuple[bytes, float]]:
+        """Return (body, seconds left to live) or None."""
+        now = time.time()
+        row = self._db.execute("SELECT body, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        body, expires_at = row
+        if expires_at <= now:
+            self._delete(key)
+            return None
+        self._db.execute("UPDATE responses SET last_access = ? WHERE key = ?", (now, key))
+        self._db.commit()
+        return body, expires_at - now
+
+    def set(self, key: str, body: bytes, ttl: float):
+        now = time.time()
+        previous = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if previous is not None:
+            self.total_bytes -= previous[0]
+        self._db.execute(
+            "INSERT OR REPLACE INTO responses (key, expires_at, last_access, size, body) VALUES (?, ?, ?, ?, ?)",
+            (key, now + ttl, now, len(body), body),
+        )
+        self.total_bytes += len(body)
+        self._evict(now)
+        self._db.commit()
+
+    def _delete(self, key: str):
+        row = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+            self.total_bytes -= row[0]
+
+    def _evict(self, now: float):
+        if now - self._last_sweep >= DISK_SWEEP_INTERVAL:
+            self._last_sweep = now
+            expired = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses WHERE expires_at <= ?", (now,)
+            ).fetchone()
+            if expired[0]:
+                self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (now,))
+                self.evictions += expired[0]
+            # Recount rather than subtract: other worker processes may write to the same database
+            self.total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+        while self.total_bytes > self.max_bytes:
+            rows = self._db.execute(
+                "SELECT key, size FROM responses ORDER BY last_access LIMIT 64"
+            ).fetchall()
+            if not rows:
+                self.total_bytes = 0
+                break
+            for key, size in rows:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                self.evictions += 1
+                if self.total_bytes <= self.max_bytes:
+                    break
+
+    def close(self):
+        self._db.close()
+
+
+class ResponseCache:
+    """Memory LRU in front of an optional SQLite tier; values are response dicts."""
+
+    def __init__(self, memory_size: int = 1000, ttl_seconds: float = 3600,
+                 disk_path: Optional[str] = None, disk_max_bytes: int = 512 * 1024 * 1024):
+        self.ttl_seconds = ttl_seconds
+        self.memory = LRUCache(memory_size)
+        self.disk = DiskResponseStore(disk_path, disk_max_bytes) if disk_path else None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache") if self.disk else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    async def _run_disk(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self.memory.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.memory_hits += 1
+            return entry[1]
+
+        row = None
+        if self.disk is not None:
+            try:
+                row = await self._run_disk(self.disk.get, key)
+            except sqlite3.Error as e:
+                logger.warning(f"Response cache disk read failed: {e}")
+        if row is None:
+            self.misses += 1
+            return None
+        body, ttl_left = row
+        self.disk_hits += 1
+        response = json.loads(body)
+        # Promote to memory for the rest of the entry's lifetime
+        self.memory.set(key, (time.monotonic() + ttl_left, response))
+        return response
+
+    async def set(self, key: str, response: Dict[str, Any]):
+        self.stores += 1
+        self.memory.set(key, (time.monotonic() + self.ttl_seconds, response))
+        if self.disk is None:
+            return
+        try:
+            await self._run_disk(self.disk.set, key, json.dumps(response).encode("utf-8"), self.ttl_seconds)
+        except sqlite3.Error as e:
+            logger.warning(f"Response cache disk write failed: {e}")
+
+    def close(self):
+        if self.disk is not None:
+            self._executor.submit(self.disk.close)
+            self._executor.shutdown(wait=True)
+
+    def stats(self) -> Dict[str, Any]:
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        disk_lookups = lookups - self.memory_hits
+        stats = {
+            "enabled": True,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": hits,
+            "misses": self.misses,
+            "hit_ratio": round(hits / lookups, 4) if lookups else 0.0,
+            "stores": self.stores,
+            "memory": {
+                "size": len(self.memory),
+                "maxsize": self.memory.maxsize,
+                "hits": self.memory_hits,
+                "evictions": self.memory.evictions,
+                "hit_ratio": round(self.memory_hits / lookups, 4) if lookups else 0.0,
+            },
+        }
+        if self.disk is not None:
+            stats["disk"] = {
+                "path": self.disk.path,
+                "bytes": self.disk.total_bytes,
+                "max_bytes": self.disk.max_bytes,
+                "hits": self.disk_hits,
+                "evictions": self.disk.evictions,
+                "hit_ratio": round(self.disk_hits / disk_lookups, 4) if disk_lookups else 0.0,
+            }
+        return stats
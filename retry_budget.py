@@ -0,0 +1,128 @@
+"""Process-wide retry budget.
+
+Every retry layer (streaming reconnects in create_message, the non-streaming
+fallback, per-chunk recovery inside a stream, the upstream retries that used
+to happen inside LiteLLM and key rotation after a 429) asks this budget before
+trying again. Retries are allowed up to ``ratio`` times the number of client
+requests seen in the sliding window, plus a small fixed allowance so a quiet
+proxy can still retry. During an incident this caps the extra upstream load at
+a fraction of real traffic instead of multiplying it by the retry depth.
+With several worker processes the window counts live in a ``SharedState``, so
+the budget covers the traffic of the whole proxy; while it is unavailable the
+worker counts in-process instead.
+"""
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Tuple
+
+from shared_state import SharedStateUnavailable
+
+# Shared window counter names
+REQUESTS_WINDOW = "retry_budget:requests"
+RETRIES_WINDOW = "retry_budget:retries"
+
+
+class RetryBudgetExhausted(Exception):
+    """A retry was needed but the budget is spent."""
+
+    def __init__(self, kind: str, last_error: str = ""):
+        super().__init__(f"Retry budget exhausted ({kind}){': ' + last_error if last_error else ''}")
+        self.kind = kind
+        self.last_error = last_error
+
+
+class RetryBudget:
+    """Sliding-window budget: retries <= min_retries + ratio * requests."""
+
+    def __init__(self, ratio: float = 0.2, window_seconds: float = 60.0, min_retries: int = 10, shared=None):
+        self.ratio = ratio
+        self.window_seconds = window_seconds
+        self.min_retries = min_retries
+        self.shared = shared
+        self._requests: Deque[float] = deque()
+        self._retries: Deque[float] = deque()
+        self.requests = 0
+        self.retries_allowed: Dict[str, int] = {}
+        self.retries_denied: Dict[str, int] = {}
+
+    def _trim(self, now: float):
+        for timestamps in (self._requests, self._retries):
+            while timestamps and timestamps[0] < now - self.window_seconds:
+                timestamps.popleft()
+
+    def record_request(self):
+        """Count one client request (a first attempt) towards the budget."""
+        self.requests += 1
+        if self.shared is not None:
+            # Written off the event loop
+            self.shared.submit(self._record_shared_request, time.monotonic())
+            return
+        self._requests.append(time.monotonic())
+
+    def _record_shared_request(self, at: float):
+        try:
+            self.shared.add_to_window(REQUESTS_WINDOW)
+        except SharedStateUnavailable:
+            self._requests.append(at)
+
+    def _window_counts(self) -> Tuple[float, float]:
+        if self.shared is not None:
+            try:
+                requests, retries = self.shared.window_totals((REQUESTS_WINDOW, RETRIES_WINDOW), self.window_seconds)
+                return requests, retries
+            except SharedStateUnavailable:
+                pass
+        return self._local_window_counts()
+
+    def _local_window_counts(self) -> Tuple[float, float]:
+        self._trim(time.monotonic())
+        return len(self._requests), len(self._retries)
+
+    def available(self) -> float:
+        requests, retries = self._window_counts()
+        return self.min_retries + self.ratio * requests - retries
+
+    def _try_shared_retry(self) -> bool:
+        # Check and spend in one transaction so workers cannot overdraw together
+        with self.shared.transaction():
+            requests, retries = self.shared.window_totals((REQUESTS_WINDOW, RETRIES_WINDOW), self.window_seconds)
+            allowed = self.min_retries + self.ratio * requests - retries >= 1
+            if allowed:
+                self.shared.add_to_window(RETRIES_WINDOW)
+        return allowed
+
+    async def try_retry(self, kind: str) -> bool:
+        """Spend one retry of ``kind`` if the budget allows it."""
+        allowed = None
+        if self.shared is not None:
+            try:
+                allowed = await self.shared.run(self._try_shared_retry)
+            except SharedStateUnavailable:
+                allowed = None
+        if allowed is None:
+            requests, retries = self._local_window_counts()
+            allowed = self.min_retries + self.ratio * requests - retries >= 1
+            if allowed:
+                self._retries.append(time.monotonic())
+        if not allowed:
+            self.retries_denied[kind] = self.retries_denied.get(kind, 0) + 1
+            return False
+        self.retries_allowed[kind] = self.retries_allowed.get(kind, 0) + 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        requests, retries = self._window_counts()
+        available = self.min_retries + self.ratio * requests - retries
+        return {
+            "enabled": True,
+            "shared": self.shared is not None,
+            "ratio": self.ratio,
+            "window_seconds": self.window_seconds,
+            "min_retries": self.min_retries,
+            "requests": self.requests,
+            "window_requests": int(requests),
+            "window_retries": int(retries),
+            "available": max(int(available), 0),
+            "retries_allowed": dict(self.retries_allowed),
+            "retries_denied": dict(self.retries_denied),
+        }
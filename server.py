@@ -1,19 +1,49 @@
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.exceptions import RequestValidationError
 import uvicorn
 import logging
 import json
 import re
 import asyncio
-from pydantic import BaseModel, Field, field_validator
-from typing import List, Dict, Any, Optional, Union, Literal, Set
+import itertools
+from pydantic import BaseModel, Field, ValidationError, field_validator, model_validator
+from typing import List, Dict, Any, Optional, Union, Literal, Set, Hashable
 import os
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import litellm
 import uuid
 import time
+import math
 from dotenv import load_dotenv
 from datetime import datetime
 import sys
+import tempfile
+from collections import deque
+from gemini_native import GeminiNativeClient, GeminiAPIError, parse_retry_delay
+from context_cache import GeminiContextCache, is_stale_cache_error
+from image_store import DEFAULT_TTL_SECONDS, GeminiImageStore, is_stale_file_error
+from token_counter import TokenCounter
+from response_cache import ResponseCache, response_cache_key
+from single_flight import SingleFlight
+from key_pool import KeyLease, KeyPool, mask_key
+from admission import AdmissionController, AdmissionRejected, PRIORITY_BATCH, PRIORITY_INTERACTIVE
+from rate_limiter import RateLimiter, RateLimitExceeded, RateReservation
+from hedging import Hedger
+from circuit_breaker import CircuitBreakerRegistry, CircuitOpenError
+from retry_budget import RetryBudget, RetryBudgetExhausted
+from metrics import MetricsRegistry
+import tracing
+from tracing import FileSpanExporter, RequestTimer, create_exporter
+from stream_capture import StreamCapturer, StreamReplayer
+from stream_decoder import IncrementalJSONDecoder
+import sse_encoder
+import workers
+from shared_state import SharedState, SharedStateUnavailable
+import fast_request
+from fast_request import Record, StructureError
+import http_compression
+from http_compression import BodyTooLarge, CompressionMiddleware, ResponseCompressor, UnsupportedEncoding
+from cache_utils import LRUCache, fingerprint, freeze
 
 # Load environment variables early
 load_dotenv()
@@ -56,13 +86,31 @@ class Constants:
 # Simple Configuration
 class Config:
     def __init__(self):
-        self.gemini_api_key = os.environ.get("GEMINI_API_KEY")
-        if not self.gemini_api_key:
+        # One key (GEMINI_API_KEY) or a comma-separated pool (GEMINI_API_KEYS)
+        self.gemini_api_keys = [key.strip() for key in os.environ.get("GEMINI_API_KEYS", "").split(",") if key.strip()]
+        single_key = os.environ.get("GEMINI_API_KEY")
+        if single_key and single_key not in self.gemini_api_keys:
+            self.gemini_api_keys.insert(0, single_key)
+        if not self.gemini_api_keys:
             raise ValueError("GEMINI_API_KEY not found in environment variables")
+        self.gemini_api_key = self.gemini_api_keys[0]
+        self.gemini_api_key_weights = [
+            float(weight) for weight in os.environ.get("GEMINI_API_KEY_WEIGHTS", "").split(",") if weight.strip()
+        ]
+        self.key_pool_strategy = os.environ.get("KEY_POOL_STRATEGY", "least_load").lower()
+        if self.key_pool_strategy not in ("least_load", "weighted_round_robin"):
+            raise ValueError(f"KEY_POOL_STRATEGY must be 'least_load' or 'weighted_round_robin', got '{self.key_pool_strategy}'")
+        self.key_cooldown_seconds = float(os.environ.get("KEY_COOLDOWN_SECONDS", "30"))
+        self.key_max_cooldown_seconds = float(os.environ.get("KEY_MAX_COOLDOWN_SECONDS", "300"))
         
         # Auth token for x-api-key authentication (optional)
         self.auth_token = os.environ.get("AUTH_TOKEN")
         
+        # Validation-light request handling: "authenticated" (clients that passed AUTH_TOKEN), "all" or "off"
+        self.fast_path = os.environ.get("FAST_PATH", "off").lower()
+        if self.fast_path not in ("off", "authenticated", "all"):
+            raise ValueError(f"FAST_PATH must be 'off', 'authenticated' or 'all', got '{self.fast_path}'")
+        
         # Gemini API base URL (optional)
         self.gemini_base_url = os.environ.get("GEMINI_BASE_URL")
         
@@ -71,6 +119,22 @@ class Config:
         self.host = os.environ.get("HOST", "0.0.0.0")
         self.port = int(os.environ.get("PORT", "8082"))
         self.log_level = os.environ.get("LOG_LEVEL", "WARNING")
+
+        # Multi-process mode: worker processes behind SO_REUSEPORT or a pre-forked shared socket
+        self.workers = int(os.environ.get("WORKERS", "1"))
+        self.worker_mode = os.environ.get("WORKER_MODE", workers.default_mode()).lower()
+        if self.worker_mode not in ("reuseport", "prefork"):
+            raise ValueError(f"WORKER_MODE must be 'reuseport' or 'prefork', got '{self.worker_mode}'")
+        if self.workers > 1 and os.name != "posix":
+            raise ValueError("WORKERS > 1 needs a POSIX system")
+        if self.workers > 1 and self.worker_mode == "reuseport" and not workers.reuseport_supported():
+            raise ValueError("WORKER_MODE=reuseport needs Linux SO_REUSEPORT, use WORKER_MODE=prefork")
+        self.shared_state_dir = os.environ.get("SHARED_STATE_DIR") or os.path.join(
+            tempfile.gettempdir(), f"gemini-proxy-{self.port}")
+        # Longest wait for a locked shared database before falling back to per-process state
+        self.shared_state_busy_timeout_ms = float(os.environ.get("SHARED_STATE_BUSY_TIMEOUT_MS", "50"))
+        # Set by the supervisor in worker processes
+        self.worker_id = os.environ.get(workers.WORKER_ID_ENV)
         self.max_tokens_limit = int(os.environ.get("MAX_TOKENS_LIMIT", "8192"))
         
         # Connection settings - conservative defaults
@@ -82,18 +146,124 @@ class Config:
         self.force_disable_streaming = os.environ.get("FORCE_DISABLE_STREAMING", "false").lower() == "true"
         self.emergency_disable_streaming = os.environ.get("EMERGENCY_DISABLE_STREAMING", "false").lower() == "true"
         
+        # Stream delta coalescing (0 ms window = disabled)
+        self.stream_coalesce_window_ms = int(os.environ.get("STREAM_COALESCE_WINDOW_MS", "0"))
+        self.stream_coalesce_max_chars = int(os.environ.get("STREAM_COALESCE_MAX_CHARS", "512"))
+        
+        # Conversion caches (0 disables)
+        self.tool_schema_cache_size = int(os.environ.get("TOOL_SCHEMA_CACHE_SIZE", "64"))
+        self.conversation_cache_size = int(os.environ.get("CONVERSATION_CACHE_SIZE", "20000"))
+        self.conversation_cache_max_mb = int(os.environ.get("CONVERSATION_CACHE_MAX_MB", "128"))
+        
+        # Upstream engine: "litellm" (default), "native" (direct pooled httpx calls to Gemini)
+        # or "replay" (serve streams recorded with STREAM_CAPTURE_DIR, for offline load/regression tests)
+        self.upstream_engine = os.environ.get("UPSTREAM_ENGINE", "litellm").lower()
+        if self.upstream_engine not in ("litellm", "native", "replay"):
+            raise ValueError(f"UPSTREAM_ENGINE must be 'litellm', 'native' or 'replay', got '{self.upstream_engine}'")
+        self.stream_replay_dir = os.environ.get("STREAM_REPLAY_DIR")
+        if self.upstream_engine == "replay" and not self.stream_replay_dir:
+            raise ValueError("UPSTREAM_ENGINE=replay needs STREAM_REPLAY_DIR")
+        self.stream_replay_speed = float(os.environ.get("STREAM_REPLAY_SPEED", "1"))
+        self.stream_capture_dir = os.environ.get("STREAM_CAPTURE_DIR")
+        self.stream_capture_sample_rate = float(os.environ.get("STREAM_CAPTURE_SAMPLE_RATE", "1"))
+        self.upstream_http2 = os.environ.get("UPSTREAM_HTTP2", "false").lower() == "true"
+        self.upstream_max_connections = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "100"))
+        self.upstream_max_keepalive = int(os.environ.get("UPSTREAM_MAX_KEEPALIVE", "20"))
+        self.upstream_keepalive_expiry = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "30"))
+        self.upstream_request_compression = os.environ.get("UPSTREAM_REQUEST_COMPRESSION", "false").lower() == "true"
+        self.upstream_compression_min_bytes = int(os.environ.get("UPSTREAM_COMPRESSION_MIN_BYTES", "16384"))
+
+        # Compressed transport with clients (gzip/deflate/zstd request bodies, negotiated response encoding)
+        self.request_max_decompressed_mb = int(os.environ.get("REQUEST_MAX_DECOMPRESSED_MB", "64"))
+        self.response_compression = os.environ.get("RESPONSE_COMPRESSION", "false").lower() == "true"
+        self.response_compression_min_bytes = int(os.environ.get("RESPONSE_COMPRESSION_MIN_BYTES", "1024"))
+        
+        # Gemini explicit context caching for cache_control breakpoints (native engine only)
+        self.gemini_context_cache = os.environ.get("GEMINI_CONTEXT_CACHE", "false").lower() == "true"
+        self.gemini_context_cache_ttl = int(os.environ.get("GEMINI_CONTEXT_CACHE_TTL", "300"))
+        self.gemini_context_cache_min_tokens = int(os.environ.get("GEMINI_CONTEXT_CACHE_MIN_TOKENS", "1024"))
+        
+        # Upload history images once through the Gemini Files API and reference them by URI
+        self.image_upload_cache = os.environ.get("IMAGE_UPLOAD_CACHE", "false").lower() == "true"
+        self.image_upload_min_kb = int(os.environ.get("IMAGE_UPLOAD_MIN_KB", "32"))
+        self.image_upload_ttl = int(os.environ.get("IMAGE_UPLOAD_TTL", str(DEFAULT_TTL_SECONDS)))
+        self.image_upload_cache_size = int(os.environ.get("IMAGE_UPLOAD_CACHE_SIZE", "1024"))
+        
+        # Token counting: "estimate" (local tokenizer) or "exact" (Gemini countTokens)
+        self.token_count_mode = os.environ.get("TOKEN_COUNT_MODE", "estimate").lower()
+        if self.token_count_mode not in ("estimate", "exact"):
+            raise ValueError(f"TOKEN_COUNT_MODE must be 'estimate' or 'exact', got '{self.token_count_mode}'")
+        self.token_count_cache_size = int(os.environ.get("TOKEN_COUNT_CACHE_SIZE", "50000"))
+        self.token_count_workers = int(os.environ.get("TOKEN_COUNT_WORKERS", "4"))
+        
+        # Response cache: "off", "deterministic" (temperature 0 / top_k 1 only) or "all"
+        self.response_cache_mode = os.environ.get("RESPONSE_CACHE", "off").lower()
+        if self.response_cache_mode not in ("off", "deterministic", "all"):
+            raise ValueError(f"RESPONSE_CACHE must be 'off', 'deterministic' or 'all', got '{self.response_cache_mode}'")
+        self.response_cache_size = int(os.environ.get("RESPONSE_CACHE_SIZE", "1000"))
+        self.response_cache_ttl = int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+        self.response_cache_disk_path = os.environ.get("RESPONSE_CACHE_DISK_PATH")
+        self.response_cache_disk_max_mb = int(os.environ.get("RESPONSE_CACHE_DISK_MAX_MB", "512"))
+        
+        # Share one upstream call between identical concurrent requests
+        self.single_flight = os.environ.get("SINGLE_FLIGHT", "false").lower() == "true"
+        
+        # Admission control: per-model concurrency caps with a bounded priority queue
+        self.admission_control = os.environ.get("ADMISSION_CONTROL", "false").lower() == "true"
+        self.big_model_max_concurrency = int(os.environ.get("BIG_MODEL_MAX_CONCURRENCY", "16"))
+        self.small_model_max_concurrency = int(os.environ.get("SMALL_MODEL_MAX_CONCURRENCY", "32"))
+        self.other_model_max_concurrency = int(os.environ.get("OTHER_MODEL_MAX_CONCURRENCY", "16"))
+        self.admission_max_queue = int(os.environ.get("ADMISSION_MAX_QUEUE", "64"))
+        self.admission_queue_timeout = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "30"))
+        
+        # Local RPM/TPM pacing per mapped model (0 = no local limit)
+        self.big_model_rpm = int(os.environ.get("BIG_MODEL_RPM", "0"))
+        self.big_model_tpm = int(os.environ.get("BIG_MODEL_TPM", "0"))
+        self.small_model_rpm = int(os.environ.get("SMALL_MODEL_RPM", "0"))
+        self.small_model_tpm = int(os.environ.get("SMALL_MODEL_TPM", "0"))
+        self.other_model_rpm = int(os.environ.get("OTHER_MODEL_RPM", "0"))
+        self.other_model_tpm = int(os.environ.get("OTHER_MODEL_TPM", "0"))
+        self.rate_limit_max_wait = float(os.environ.get("RATE_LIMIT_MAX_WAIT", "30"))
+        
+        # Hedged requests: a backup attempt when the first is slower than the model's latency percentile
+        self.hedging = os.environ.get("HEDGING", "false").lower() == "true"
+        self.hedge_percentile = float(os.environ.get("HEDGE_PERCENTILE", "90"))
+        self.hedge_min_delay_ms = int(os.environ.get("HEDGE_MIN_DELAY_MS", "300"))
+        self.hedge_max_rate = float(os.environ.get("HEDGE_MAX_RATE", "0.1"))
+        
+        # Circuit breaker per model and failover chains ("gemini-2.5-pro>gemini-2.5-flash,...")
+        self.circuit_breaker = os.environ.get("CIRCUIT_BREAKER", "false").lower() == "true"
+        self.circuit_failure_threshold = int(os.environ.get("CIRCUIT_FAILURE_THRESHOLD", "5"))
+        self.circuit_open_seconds = float(os.environ.get("CIRCUIT_OPEN_SECONDS", "30"))
+        self.model_failover_chains = [
+            [model.strip() for model in chain.split(">") if model.strip()]
+            for chain in os.environ.get("MODEL_FAILOVER", "").split(",") if ">" in chain
+        ]
+        
+        # Process-wide retry budget: retries <= RETRY_BUDGET_MIN_RETRIES + RETRY_BUDGET_RATIO * requests per window
+        self.retry_budget = os.environ.get("RETRY_BUDGET", "false").lower() == "true"
+        self.retry_budget_ratio = float(os.environ.get("RETRY_BUDGET_RATIO", "0.2"))
+        self.retry_budget_window = float(os.environ.get("RETRY_BUDGET_WINDOW", "60"))
+        self.retry_budget_min_retries = int(os.environ.get("RETRY_BUDGET_MIN_RETRIES", "10"))
+        
+        # Per-request phase timing (Server-Timing header, message_start metadata) and span export
+        self.server_timing = os.environ.get("SERVER_TIMING", "true").lower() == "true"
+        self.trace_exporter = os.environ.get("TRACE_EXPORTER", "off").lower()
+        if self.trace_exporter not in ("off", "memory", "file", "otel"):
+            raise ValueError(f"TRACE_EXPORTER must be 'off', 'memory', 'file' or 'otel', got '{self.trace_exporter}'")
+        self.trace_file = os.environ.get("TRACE_FILE", "traces.jsonl")
+        self.trace_memory_spans = int(os.environ.get("TRACE_MEMORY_SPANS", "1000"))
+        
         # Debug settings
         self.debug_requests = os.environ.get("DEBUG_REQUESTS", "false").lower() == "true"
         self.litellm_debug = os.environ.get("LITELLM_DEBUG", "false").lower() == "true"
         
     def validate_api_key(self):
         """Basic API key validation"""
-        if not self.gemini_api_key:
+        if not self.gemini_api_keys:
             return False
         # Basic format check for Google API keys
-        if not (self.gemini_api_key.startswith('AIza') and len(self.gemini_api_key) == 39):
-            return False
-        return True
+        return all(key.startswith('AIza') and len(key) == 39 for key in self.gemini_api_keys)
 
     def verify_auth_token(self, api_key: str) -> bool:
         """验证x-api-key请求头，如果未配置auth_token则跳过验证"""
@@ -115,7 +285,8 @@ except Exception as e:
 
 # Apply connection settings to LiteLLM
 litellm.request_timeout = config.request_timeout
-litellm.num_retries = config.max_retries
+# With a retry budget, MAX_RETRIES runs in the proxy (run_with_api_key) so every retry is metered
+litellm.num_retries = 0 if config.retry_budget else config.max_retries
 
 # Set Gemini base URL if configured
 if config.gemini_base_url:
@@ -127,15 +298,167 @@ if config.litellm_debug:
     litellm._turn_on_debug()
     print("🔍 LiteLLM debug mode enabled")
 
+# State shared by the worker processes (rate limits, key cooldowns, retry budget, metrics)
+shared_state = None
+if config.workers > 1:
+    try:
+        shared_state = SharedState(os.path.join(config.shared_state_dir, "state.db"),
+                                   busy_timeout=config.shared_state_busy_timeout_ms / 1000)
+        if config.worker_id is None:
+            print(f"🧮 Shared worker state: {shared_state.path}")
+    except SharedStateUnavailable as e:
+        print(f"⚠️ {e}; limits, key cooldowns and metrics stay per worker")
+
+# API key pool (a single key is a pool of one)
+key_pool = KeyPool(
+    config.gemini_api_keys,
+    weights=config.gemini_api_key_weights,
+    strategy=config.key_pool_strategy,
+    cooldown_seconds=config.key_cooldown_seconds,
+    max_cooldown_seconds=config.key_max_cooldown_seconds,
+    shared=shared_state,
+)
+if len(key_pool) > 1:
+    print(f"🔑 API key pool: {len(key_pool)} keys, strategy: {config.key_pool_strategy}")
+
+# gzip for large upstream request bodies (native REST calls only)
+upstream_compress_min_bytes = config.upstream_compression_min_bytes if config.upstream_request_compression else None
+
+# Native Gemini client (only used when UPSTREAM_ENGINE=native)
+native_client = None
+if config.upstream_engine == "native":
+    native_client = GeminiNativeClient(
+        api_key=config.gemini_api_key,
+        base_url=config.gemini_base_url,
+        timeout=config.request_timeout,
+        http2=config.upstream_http2,
+        max_connections=config.upstream_max_connections,
+        max_keepalive_connections=config.upstream_max_keepalive,
+        keepalive_expiry=config.upstream_keepalive_expiry,
+        compress_min_bytes=upstream_compress_min_bytes,
+    )
+    native_client.on_response_headers = key_pool.observe_headers
+    print(f"⚡ Native Gemini engine enabled (HTTP/2: {native_client.http2}, max connections: {config.upstream_max_connections})")
+
+# Stream capture and the replay upstream (UPSTREAM_ENGINE=replay)
+stream_capturer = None
+if config.stream_capture_dir:
+    stream_capturer = StreamCapturer(config.stream_capture_dir, config.stream_capture_sample_rate)
+    print(f"📼 Capturing upstream streams to {config.stream_capture_dir} (sample rate: {config.stream_capture_sample_rate:g})")
+stream_replayer = None
+if config.upstream_engine == "replay":
+    stream_replayer = StreamReplayer(config.stream_replay_dir, config.stream_replay_speed)
+    replay_pace = f"{config.stream_replay_speed:g}x recorded speed" if config.stream_replay_speed > 0 else "as fast as possible"
+    print(f"📼 Replay upstream enabled ({len(stream_replayer.recordings)} recordings, {replay_pace})")
+
+# Gemini context cache (cachedContents for cache_control prefixes)
+context_cache = None
+if config.gemini_context_cache:
+    if native_client is not None:
+        context_cache = GeminiContextCache(
+            native_client,
+            ttl_seconds=config.gemini_context_cache_ttl,
+            min_tokens=config.gemini_context_cache_min_tokens,
+        )
+        print(f"🧊 Gemini context caching enabled (TTL: {config.gemini_context_cache_ttl}s, min tokens: {config.gemini_context_cache_min_tokens})")
+    else:
+        print("⚠️ GEMINI_CONTEXT_CACHE requires UPSTREAM_ENGINE=native, context caching disabled")
+
+# Image upload cache (Gemini Files API references instead of inline base64)
+image_store = None
+image_upload_client = None
+if config.image_upload_cache:
+    if stream_replayer is None:
+        # Reuse the native engine's pool when there is one
+        image_upload_client = native_client or GeminiNativeClient(
+            api_key=config.gemini_api_key,
+            base_url=config.gemini_base_url,
+            timeout=config.request_timeout,
+        )
+        image_upload_client.on_response_headers = key_pool.observe_headers
+        image_store = GeminiImageStore(
+            image_upload_client,
+            min_bytes=config.image_upload_min_kb * 1024,
+            ttl_seconds=config.image_upload_ttl,
+            max_entries=config.image_upload_cache_size,
+        )
+        print(f"🖼️ Image upload cache enabled (min size: {config.image_upload_min_kb}KB, TTL: {config.image_upload_ttl}s)")
+    else:
+        print("⚠️ IMAGE_UPLOAD_CACHE has no effect with UPSTREAM_ENGINE=replay")
+
+# Fast path for trusted clients (orjson decode, structural checks, no request models)
+if config.fast_path == "authenticated" and not config.auth_token:
+    print("⚠️ FAST_PATH=authenticated requires AUTH_TOKEN, every request takes the strict path")
+elif config.fast_path != "off":
+    decoder = "orjson" if fast_request.orjson is not None else "json"
+    print(f"🏎️ Fast request path enabled for {'authenticated' if config.fast_path == 'authenticated' else 'all'} clients (decoder: {decoder})")
+
+# Compressed transport: request bodies are decoded in parse_request_body, responses by the middleware below
+response_compressor = ResponseCompressor(config.response_compression_min_bytes) if config.response_compression else None
+if response_compressor is not None:
+    print(f"🗜️ Response compression enabled ({', '.join(response_compressor.stats()['encodings'])}, min size: {config.response_compression_min_bytes} bytes)")
+if config.upstream_request_compression:
+    if config.upstream_engine == "native":
+        print(f"🗜️ Upstream request compression enabled (gzip, min size: {config.upstream_compression_min_bytes} bytes)")
+    else:
+        print("⚠️ UPSTREAM_REQUEST_COMPRESSION only applies to UPSTREAM_ENGINE=native (and exact token counting)")
+
+# Response cache for repeatable requests (memory LRU + optional SQLite tier)
+response_cache = None
+if config.response_cache_mode != "off":
+    # Workers share the SQLite tier, in SHARED_STATE_DIR unless RESPONSE_CACHE_DISK_PATH says otherwise
+    response_cache_disk_path = config.response_cache_disk_path
+    if response_cache_disk_path is None and shared_state is not None:
+        response_cache_disk_path = os.path.join(config.shared_state_dir, "responses.db")
+    response_cache = ResponseCache(
+        memory_size=config.response_cache_size,
+        ttl_seconds=config.response_cache_ttl,
+        disk_path=response_cache_disk_path,
+        disk_max_bytes=config.response_cache_disk_max_mb * 1024 * 1024,
+    )
+    disk_status = response_cache_disk_path or "memory only"
+    print(f"💾 Response cache enabled (mode: {config.response_cache_mode}, TTL: {config.response_cache_ttl}s, disk: {disk_status})")
+
+# Single-flight registry for identical concurrent requests
+single_flight = SingleFlight() if config.single_flight else None
+
+# Token counting engine (cached per message, tokenized off the event loop)
+token_counter = TokenCounter(cache_size=config.token_count_cache_size, max_workers=config.token_count_workers)
+token_count_client = None
+if config.token_count_mode == "exact":
+    # Reuse the native engine's pool when there is one
+    token_count_client = native_client or GeminiNativeClient(
+        api_key=config.gemini_api_key,
+        base_url=config.gemini_base_url,
+        timeout=config.request_timeout,
+        compress_min_bytes=upstream_compress_min_bytes,
+    )
+    token_count_client.on_response_headers = key_pool.observe_headers
+
+# Circuit breakers per upstream model (consulted by ModelManager when mapping models)
+circuit_breakers = None
+if config.circuit_breaker:
+    circuit_breakers = CircuitBreakerRegistry(
+        failure_threshold=config.circuit_failure_threshold,
+        open_seconds=config.circuit_open_seconds,
+    )
+
 # Model Management
 class ModelManager:
-    def __init__(self, config):
+    def __init__(self, config, circuit_breakers=None):
         self.config = config
+        self.circuit_breakers = circuit_breakers
         self.base_gemini_models = [
             "gemini-2.5-pro"
         ]
         self._gemini_models = set(self.base_gemini_models)
         self._add_env_models()
+        # Clean model name -> fallback models to try, in order, while its circuit is open
+        self.failover_chains = {}
+        for chain in self.config.model_failover_chains:
+            clean_chain = [self._clean_model_name(model) for model in chain]
+            self.failover_chains[clean_chain[0]] = clean_chain[1:]
+            self._gemini_models.update(model for model in clean_chain if model.startswith("gemini"))
     
     def _add_env_models(self):
         for model in [self.config.big_model, self.config.small_model]:
@@ -153,13 +476,30 @@ class ModelManager:
         mapped_model = self._map_model_alias(clean_model)
         
         if mapped_model != clean_model:
-            return f"gemini/{mapped_model}", True
+            return self.route_available(f"gemini/{mapped_model}"), True
         elif clean_model in self._gemini_models:
-            return f"gemini/{clean_model}", True
+            return self.route_available(f"gemini/{clean_model}"), True
         elif not original_model.startswith('gemini/'):
-            return f"gemini/{original_model}", False
+            routed_model = self.route_available(f"gemini/{original_model}")
+            return routed_model, routed_model != f"gemini/{original_model}"
         else:
-            return original_model, False
+            routed_model = self.route_available(original_model)
+            return routed_model, routed_model != original_model
+    
+    def failover_chain(self, model: str) -> List[str]:
+        """The model followed by its configured fallbacks (all with the gemini/ prefix)."""
+        return [model] + [f"gemini/{fallback}" for fallback in self.failover_chains.get(self._clean_model_name(model), [])]
+    
+    def route_available(self, model: str) -> str:
+        """First model of the failover chain whose circuit is not open (the model itself if none is)."""
+        if self.circuit_breakers is None:
+            return model
+        for candidate in self.failover_chain(model):
+            if self.circuit_breakers.available(candidate):
+                if candidate != model:
+                    logger.warning(f"🔀 Circuit open for {model}, failing over to {candidate}")
+                return candidate
+        return model
     
     def _clean_model_name(self, model: str) -> str:
         if model.startswith('gemini/'):
@@ -182,7 +522,98 @@ class ModelManager:
         
         return clean_model
 
-model_manager = ModelManager(config)
+model_manager = ModelManager(config, circuit_breakers)
+
+def per_worker(limit: int) -> int:
+    """A worker's share of a proxy-wide cap that each worker process enforces on its own."""
+    return max(math.ceil(limit / config.workers), 1) if limit > 0 else limit
+
+# Admission control in front of the upstream call (gates keyed by mapped model tier)
+admission_controller = None
+if config.admission_control:
+    big_gate_model = f"gemini/{model_manager._clean_model_name(config.big_model)}"
+    small_gate_model = f"gemini/{model_manager._clean_model_name(config.small_model)}"
+    admission_limits = {big_gate_model: config.big_model_max_concurrency}
+    # When BIG_MODEL and SMALL_MODEL are the same model they share one gate with the larger cap
+    admission_limits[small_gate_model] = max(config.small_model_max_concurrency, admission_limits.get(small_gate_model, 0))
+    # Slots are held by in-flight requests of one process, so each worker gets an even share of the caps
+    admission_controller = AdmissionController(
+        {model: per_worker(limit) for model, limit in admission_limits.items()},
+        default_concurrency=per_worker(config.other_model_max_concurrency),
+        max_queue=per_worker(config.admission_max_queue),
+        queue_timeout=config.admission_queue_timeout,
+    )
+    print(f"🚦 Admission control enabled (big: {config.big_model_max_concurrency}, small: {config.small_model_max_concurrency}, queue: {config.admission_max_queue}, timeout: {config.admission_queue_timeout:g}s)")
+
+# Local RPM/TPM pacing (token buckets keyed by mapped model)
+rate_limiter = None
+rate_limits = {f"gemini/{model_manager._clean_model_name(config.big_model)}": (config.big_model_rpm, config.big_model_tpm)}
+small_rate_model = f"gemini/{model_manager._clean_model_name(config.small_model)}"
+# When BIG_MODEL and SMALL_MODEL are the same model they share one quota (the larger limits that are set)
+shared_rpm, shared_tpm = rate_limits.get(small_rate_model, (0, 0))
+rate_limits[small_rate_model] = (max(config.small_model_rpm, shared_rpm), max(config.small_model_tpm, shared_tpm))
+if any(rpm or tpm for rpm, tpm in rate_limits.values()) or config.other_model_rpm or config.other_model_tpm:
+    rate_limiter = RateLimiter(
+        rate_limits,
+        default_limits=(config.other_model_rpm, config.other_model_tpm),
+        max_wait=config.rate_limit_max_wait,
+        shared=shared_state,
+    )
+    print(f"⏳ Local rate limiting enabled (big: {config.big_model_rpm} RPM / {config.big_model_tpm} TPM, small: {config.small_model_rpm} RPM / {config.small_model_tpm} TPM)")
+
+# Process-wide retry budget shared by every retry layer
+retry_budget = None
+if config.retry_budget:
+    retry_budget = RetryBudget(
+        ratio=config.retry_budget_ratio,
+        window_seconds=config.retry_budget_window,
+        min_retries=config.retry_budget_min_retries,
+        shared=shared_state,
+    )
+
+# Hedged upstream requests (adaptive per-model latency thresholds)
+hedger = None
+if config.hedging:
+    hedger = Hedger(
+        percentile=config.hedge_percentile,
+        min_delay=config.hedge_min_delay_ms / 1000,
+        max_rate=config.hedge_max_rate,
+    )
+    print(f"🪃 Request hedging enabled (p{config.hedge_percentile:g} threshold, max hedge rate: {config.hedge_max_rate:.0%})")
+
+# Prometheus metrics (served on /metrics)
+metrics_registry = MetricsRegistry()
+metric_requests = metrics_registry.counter(
+    "proxy_requests_total", "Requests by route, mapped model and HTTP status.", ("route", "model", "status"))
+metric_request_duration = metrics_registry.histogram(
+    "proxy_request_duration_seconds", "End-to-end request latency, until the last byte for streams.",
+    ("route", "model"), buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300))
+metric_time_to_first_token = metrics_registry.histogram(
+    "proxy_time_to_first_token_seconds", "Time from request arrival to the first streamed text or tool delta.",
+    ("model",), buckets=(0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 5, 10, 20, 30))
+metric_output_tokens_per_second = metrics_registry.histogram(
+    "proxy_output_tokens_per_second", "Output token rate per upstream response (after the first token for streams).",
+    ("model",), buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 300, 500))
+metric_input_tokens = metrics_registry.counter(
+    "proxy_input_tokens_total", "Prompt tokens reported by upstream.", ("model",))
+metric_output_tokens = metrics_registry.counter(
+    "proxy_output_tokens_total", "Output tokens reported by upstream.", ("model",))
+metric_retries = metrics_registry.counter(
+    "proxy_upstream_retries_total", "Upstream retries by layer and whether the retry budget allowed them.",
+    ("kind", "outcome"))
+metric_malformed_chunks = metrics_registry.histogram(
+    "proxy_stream_malformed_chunks", "Malformed upstream chunks skipped per stream.",
+    ("model",), buckets=(0, 1, 2, 5, 10, 20))
+metric_stream_fallbacks = metrics_registry.counter(
+    "proxy_stream_fallbacks_total", "Streaming requests that fell back to a non-streaming upstream call.", ("model",))
+metric_streams_in_flight = metrics_registry.gauge(
+    "proxy_streams_in_flight", "SSE responses currently being streamed to clients.")
+
+# Request span export (TRACE_EXPORTER)
+span_exporter = create_exporter(config.trace_exporter, config.trace_file, config.trace_memory_spans)
+if span_exporter is not None:
+    trace_target = f" -> {config.trace_file}" if config.trace_exporter == "file" else ""
+    print(f"🧭 Request tracing enabled (exporter: {config.trace_exporter}{trace_target})")
 
 # Logging Configuration
 logging.basicConfig(
@@ -211,6 +642,49 @@ for uvicorn_logger in ["uvicorn", "uvicorn.access", "uvicorn.error"]:
     logging.getLogger(uvicorn_logger).setLevel(logging.WARNING)
 
 app = FastAPI(title="Gemini-to-Claude API Proxy", version="2.5.0")
+if response_compressor is not None:
+    # Added first so it sits innermost, under the logging and auth middleware
+    app.add_middleware(CompressionMiddleware, compressor=response_compressor)
+
+# Worker processes publish their metric samples for /metrics on any worker to sum up
+METRICS_PUBLISH_INTERVAL = 5.0
+metrics_publisher = None
+
+async def publish_metrics():
+    try:
+        await shared_state.run(shared_state.publish_metrics, config.worker_id, metrics_registry.snapshot())
+    except Exception as e:
+        logger.warning(f"Publishing worker metrics failed: {e}")
+
+async def publish_metrics_periodically():
+    while True:
+        await asyncio.sleep(METRICS_PUBLISH_INTERVAL)
+        await publish_metrics()
+
+@app.on_event("startup")
+async def start_worker_tasks():
+    global metrics_publisher
+    if shared_state is not None and config.worker_id is not None:
+        metrics_publisher = asyncio.create_task(publish_metrics_periodically())
+
+@app.on_event("shutdown")
+async def close_upstream_clients():
+    if metrics_publisher is not None:
+        metrics_publisher.cancel()
+        await publish_metrics()
+    if native_client is not None:
+        await native_client.aclose()
+    if token_count_client is not None and token_count_client is not native_client:
+        await token_count_client.aclose()
+    if image_upload_client is not None and image_upload_client is not native_client:
+        await image_upload_client.aclose()
+    token_counter.shutdown()
+    if response_cache is not None:
+        response_cache.close()
+    if shared_state is not None:
+        shared_state.close()
+    if isinstance(span_exporter, FileSpanExporter):
+        span_exporter.close()
 
 # Enhanced error classification
 def classify_gemini_error(error_msg: str) -> str:
@@ -256,52 +730,58 @@ def classify_gemini_error(error_msg: str) -> str:
     return error_msg
 
 # Enhanced schema cleaner
+GEMINI_ALLOWED_STRING_FORMATS = {"enum", "date-time"}
+
 def clean_gemini_schema(schema: Any) -> Any:
-    """Recursively removes unsupported fields from a JSON schema for Gemini compatibility."""
+    """Return a copy of a JSON schema with fields unsupported by Gemini removed (input is not mutated)."""
     if isinstance(schema, dict):
-        # Remove fields unsupported by Gemini
-        schema.pop("additionalProperties", None)
-        schema.pop("default", None)
+        # Drop fields unsupported by Gemini and recursively clean nested schemas
+        cleaned = {
+            key: clean_gemini_schema(value)
+            for key, value in schema.items()
+            if key not in ("additionalProperties", "default")
+        }
 
         # Handle string format restrictions
-        if schema.get("type") == "string" and "format" in schema:
-            allowed_formats = {"enum", "date-time"}
-            if schema["format"] not in allowed_formats:
-                logger.debug(f"Removing unsupported format '{schema['format']}' for string type in Gemini schema")
-                schema.pop("format")
-
-        # Recursively clean nested schemas
-        for key, value in list(schema.items()):
-            schema[key] = clean_gemini_schema(value)
-                
+        if cleaned.get("type") == "string" and "format" in cleaned:
+            if cleaned["format"] not in GEMINI_ALLOWED_STRING_FORMATS:
+                logger.debug(f"Removing unsupported format '{cleaned['format']}' for string type in Gemini schema")
+                cleaned.pop("format")
+        return cleaned
+
     elif isinstance(schema, list):
         return [clean_gemini_schema(item) for item in schema]
-            
+
     return schema
 
 # Pydantic Models
 class ContentBlockText(BaseModel):
     type: Literal["text"]
     text: str
+    cache_control: Optional[Dict[str, Any]] = Field(default=None, exclude=True)
 
 class ContentBlockImage(BaseModel):
     type: Literal["image"]
     source: Dict[str, Any]
+    cache_control: Optional[Dict[str, Any]] = Field(default=None, exclude=True)
 
 class ContentBlockToolUse(BaseModel):
     type: Literal["tool_use"]
     id: str
     name: str
     input: Dict[str, Any]
+    cache_control: Optional[Dict[str, Any]] = Field(default=None, exclude=True)
 
 class ContentBlockToolResult(BaseModel):
     type: Literal["tool_result"]
     tool_use_id: str
     content: Union[str, List[Dict[str, Any]], Dict[str, Any]]
+    cache_control: Optional[Dict[str, Any]] = Field(default=None, exclude=True)
 
 class SystemContent(BaseModel):
     type: Literal["text"]
     text: str
+    cache_control: Optional[Dict[str, Any]] = Field(default=None, exclude=True)
 
 class Message(BaseModel):
     role: Literal["user", "assistant"]
@@ -311,6 +791,7 @@ class Tool(BaseModel):
     name: str
     description: Optional[str] = None
     input_schema: Dict[str, Any]
+    cache_control: Optional[Dict[str, Any]] = Field(default=None, exclude=True)
 
 class ThinkingConfig(BaseModel):
     enabled: bool = True
@@ -331,6 +812,14 @@ class MessagesRequest(BaseModel):
     thinking: Optional[ThinkingConfig] = None
     original_model: Optional[str] = None
 
+    @model_validator(mode='before')
+    @classmethod
+    def remember_original_model(cls, data):
+        # Field validators cannot set other fields in pydantic v2, so keep the requested alias here
+        if isinstance(data, dict) and isinstance(data.get('model'), str) and not data.get('original_model'):
+            data = {**data, 'original_model': data['model']}
+        return data
+
     @field_validator('model')
     @classmethod
     def validate_model_field(cls, v, info):
@@ -422,89 +911,94 @@ def parse_tool_result_content(content):
     except:
         return "Unparseable content"
 
-# Enhanced message conversion
-def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str, Any]:
-    """Convert Anthropic API request format to LiteLLM format for Gemini."""
-    litellm_messages = []
-    
-    # System message handling
-    if anthropic_request.system:
-        system_text = ""
-        if isinstance(anthropic_request.system, str):
-            system_text = anthropic_request.system
-        elif isinstance(anthropic_request.system, list):
-            text_parts = []
-            for block in anthropic_request.system:
-                if hasattr(block, 'type') and block.type == Constants.CONTENT_TEXT:
-                    text_parts.append(block.text)
-                elif isinstance(block, dict) and block.get("type") == Constants.CONTENT_TEXT:
-                    text_parts.append(block.get("text", ""))
-            system_text = "\n\n".join(text_parts)
-        
-        if system_text.strip():
-            litellm_messages.append({"role": Constants.ROLE_SYSTEM, "content": system_text.strip()})
+# Memoized tool translation, keyed by the exact tool definitions
+tool_schema_cache = LRUCache(config.tool_schema_cache_size)
 
-    # Process messages
-    for msg in anthropic_request.messages:
-        if isinstance(msg.content, str):
-            litellm_messages.append({"role": msg.role, "content": msg.content})
+def tools_cache_key(tools: List[Tool]) -> Hashable:
+    """Exact identity of a tool set, compared by value on hash match (as in request_identity)."""
+    return tuple((tool.name, tool.description, freeze(tool.input_schema)) for tool in tools)
+
+def translate_tools(tools: List[Tool], target: str) -> List[Dict[str, Any]]:
+    converted = []
+    for tool in tools:
+        if not (tool.name and tool.name.strip()):
             continue
+        if target == "litellm":
+            converted.append({
+                "type": Constants.TOOL_FUNCTION,
+                Constants.TOOL_FUNCTION: {
+                    "name": tool.name,
+                    "description": tool.description or "",
+                    "parameters": clean_gemini_schema(tool.input_schema)
+                }
+            })
+        else:
+            converted.append({
+                "name": tool.name,
+                "description": tool.description or "",
+                "parameters": clean_gemini_schema(tool.input_schema)
+            })
+    return converted
+
+def convert_tools(tools: List[Tool], target: str, mutable: bool = False) -> List[Dict[str, Any]]:
+    """Translate Anthropic tools to LiteLLM tools ("litellm") or Gemini functionDeclarations ("gemini").
+
+    Claude Code resends the same large tool set on every call, so the finished
+    payload is cached by the exact tool definitions and shared between requests:
+    callers must not modify it. LiteLLM rewrites tool schemas in place, so the
+    request sent through it asks for ``mutable=True`` (litellm target only) and
+    gets a private copy decoded from the cached JSON.
+    """
+    if not tool_schema_cache.enabled:
+        return translate_tools(tools, target)
+
+    cache_key = (target, tools_cache_key(tools))
+    entry = tool_schema_cache.get(cache_key)
+    if entry is None:
+        converted = translate_tools(tools, target)
+        entry = (converted, json.dumps(converted) if target == "litellm" else None)
+        tool_schema_cache.set(cache_key, entry)
+    converted, encoded = entry
+    return json.loads(encoded) if mutable else converted
+
+# Per-message conversion (cached by conversation prefix)
+def convert_message_to_litellm(msg: Message) -> List[Dict[str, Any]]:
+    """Convert one Anthropic message into the LiteLLM messages it expands to."""
+    if isinstance(msg.content, str):
+        return [{"role": msg.role, "content": msg.content}]
 
-        # Process content blocks - accumulate different types
-        text_parts = []
-        image_parts = []
-        tool_calls = []
-        pending_tool_messages = []
-
-        for block in msg.content:
-            if block.type == Constants.CONTENT_TEXT:
-                text_parts.append(block.text)
-            elif block.type == Constants.CONTENT_IMAGE:
-                if (isinstance(block.source, dict) and 
-                    block.source.get("type") == "base64" and
-                    "media_type" in block.source and "data" in block.source):
-                    image_parts.append({
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:{block.source['media_type']};base64,{block.source['data']}"
-                        }
-                    })
-            elif block.type == Constants.CONTENT_TOOL_USE and msg.role == Constants.ROLE_ASSISTANT:
-                tool_calls.append({
-                    "id": block.id,
-                    "type": Constants.TOOL_FUNCTION,
-                    Constants.TOOL_FUNCTION: {
-                        "name": block.name,
-                        "arguments": json.dumps(block.input)
+    litellm_messages = []
+
+    # Process content blocks - accumulate different types
+    text_parts = []
+    image_parts = []
+    tool_calls = []
+    pending_tool_messages = []
+
+    for block in msg.content:
+        if block.type == Constants.CONTENT_TEXT:
+            text_parts.append(block.text)
+        elif block.type == Constants.CONTENT_IMAGE:
+            if (isinstance(block.source, dict) and 
+                block.source.get("type") == "base64" and
+                "media_type" in block.source and "data" in block.source):
+                image_parts.append({
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{block.source['media_type']};base64,{block.source['data']}"
                     }
                 })
-            elif block.type == Constants.CONTENT_TOOL_RESULT and msg.role == Constants.ROLE_USER:
-                # CRITICAL: Split user message when tool_result is encountered
-                if text_parts or image_parts:
-                    content_parts = []
-                    text_content = "".join(text_parts).strip()
-                    if text_content:
-                        content_parts.append({"type": Constants.CONTENT_TEXT, "text": text_content})
-                    content_parts.extend(image_parts)
-                    
-                    litellm_messages.append({
-                        "role": Constants.ROLE_USER,
-                        "content": content_parts[0]["text"] if len(content_parts) == 1 and content_parts[0]["type"] == Constants.CONTENT_TEXT else content_parts
-                    })
-                    text_parts.clear()
-                    image_parts.clear()
-
-                # Add tool result as separate "tool" role message
-                parsed_content = parse_tool_result_content(block.content)
-                pending_tool_messages.append({
-                    "role": Constants.ROLE_TOOL,
-                    "tool_call_id": block.tool_use_id,
-                    "content": parsed_content
-                })
-
-        # Finalize message based on role
-        if msg.role == Constants.ROLE_USER:
-            # Add any remaining text/image content
+        elif block.type == Constants.CONTENT_TOOL_USE and msg.role == Constants.ROLE_ASSISTANT:
+            tool_calls.append({
+                "id": block.id,
+                "type": Constants.TOOL_FUNCTION,
+                Constants.TOOL_FUNCTION: {
+                    "name": block.name,
+                    "arguments": json.dumps(block.input)
+                }
+            })
+        elif block.type == Constants.CONTENT_TOOL_RESULT and msg.role == Constants.ROLE_USER:
+            # CRITICAL: Split user message when tool_result is encountered
             if text_parts or image_parts:
                 content_parts = []
                 text_content = "".join(text_parts).strip()
@@ -516,31 +1010,230 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
                     "role": Constants.ROLE_USER,
                     "content": content_parts[0]["text"] if len(content_parts) == 1 and content_parts[0]["type"] == Constants.CONTENT_TEXT else content_parts
                 })
-            # Add any pending tool messages
-            litellm_messages.extend(pending_tool_messages)
-            
-        elif msg.role == Constants.ROLE_ASSISTANT:
-            assistant_msg = {"role": Constants.ROLE_ASSISTANT}
-            
-            # Handle content for assistant messages
+                text_parts.clear()
+                image_parts.clear()
+
+            # Add tool result as separate "tool" role message
+            parsed_content = parse_tool_result_content(block.content)
+            pending_tool_messages.append({
+                "role": Constants.ROLE_TOOL,
+                "tool_call_id": block.tool_use_id,
+                "content": parsed_content
+            })
+
+    # Finalize message based on role
+    if msg.role == Constants.ROLE_USER:
+        # Add any remaining text/image content
+        if text_parts or image_parts:
             content_parts = []
             text_content = "".join(text_parts).strip()
             if text_content:
                 content_parts.append({"type": Constants.CONTENT_TEXT, "text": text_content})
             content_parts.extend(image_parts)
             
-            # FIXED: Don't set content to None - let LiteLLM handle missing content
-            if content_parts:
-                assistant_msg["content"] = content_parts[0]["text"] if len(content_parts) == 1 and content_parts[0]["type"] == Constants.CONTENT_TEXT else content_parts
-            else: 
-                assistant_msg["content"] = None
-                
-            if tool_calls:
-                assistant_msg["tool_calls"] = tool_calls
-                
-            # Only add message if it has actual content or tool calls
-            if assistant_msg.get("content") or assistant_msg.get("tool_calls"):
-                litellm_messages.append(assistant_msg)
+            litellm_messages.append({
+                "role": Constants.ROLE_USER,
+                "content": content_parts[0]["text"] if len(content_parts) == 1 and content_parts[0]["type"] == Constants.CONTENT_TEXT else content_parts
+            })
+        # Add any pending tool messages
+        litellm_messages.extend(pending_tool_messages)
+        
+    elif msg.role == Constants.ROLE_ASSISTANT:
+        assistant_msg = {"role": Constants.ROLE_ASSISTANT}
+        
+        # Handle content for assistant messages
+        content_parts = []
+        text_content = "".join(text_parts).strip()
+        if text_content:
+            content_parts.append({"type": Constants.CONTENT_TEXT, "text": text_content})
+        content_parts.extend(image_parts)
+        
+        # FIXED: Don't set content to None - let LiteLLM handle missing content
+        if content_parts:
+            assistant_msg["content"] = content_parts[0]["text"] if len(content_parts) == 1 and content_parts[0]["type"] == Constants.CONTENT_TEXT else content_parts
+        else: 
+            assistant_msg["content"] = None
+            
+        if tool_calls:
+            assistant_msg["tool_calls"] = tool_calls
+            
+        # Only add message if it has actual content or tool calls
+        if assistant_msg.get("content") or assistant_msg.get("tool_calls"):
+            litellm_messages.append(assistant_msg)
+
+    return litellm_messages
+
+
+def convert_message_to_gemini(msg: Message, tool_names: Dict[str, str]) -> tuple[List[Dict[str, Any]], Dict[str, str]]:
+    """Convert one Anthropic message into Gemini contents.
+
+    functionResponse parts need the function name while Anthropic only gives the
+    tool_use id, so ``tool_names`` carries the ids seen earlier in the history.
+    Returns the contents and the tool_use ids this message introduces.
+    """
+    role = "model" if msg.role == Constants.ROLE_ASSISTANT else Constants.ROLE_USER
+
+    if isinstance(msg.content, str):
+        return ([{"role": role, "parts": [{"text": msg.content}]}] if msg.content else []), {}
+
+    parts = []
+    new_tool_names = {}
+    for block in msg.content:
+        if block.type == Constants.CONTENT_TEXT:
+            if block.text:
+                parts.append({"text": block.text})
+        elif block.type == Constants.CONTENT_IMAGE:
+            if (isinstance(block.source, dict) and
+                block.source.get("type") == "base64" and
+                "media_type" in block.source and "data" in block.source):
+                parts.append({"inlineData": {"mimeType": block.source["media_type"], "data": block.source["data"]}})
+        elif block.type == Constants.CONTENT_TOOL_USE and msg.role == Constants.ROLE_ASSISTANT:
+            new_tool_names[block.id] = block.name
+            parts.append({"functionCall": {"name": block.name, "args": block.input}})
+        elif block.type == Constants.CONTENT_TOOL_RESULT and msg.role == Constants.ROLE_USER:
+            parts.append({"functionResponse": {
+                "name": new_tool_names.get(block.tool_use_id) or tool_names.get(block.tool_use_id, block.tool_use_id),
+                "response": {"content": parse_tool_result_content(block.content)}
+            }})
+
+    # Gemini rejects contents without parts
+    return ([{"role": role, "parts": parts}] if parts else []), new_tool_names
+
+# Conversation prefix cache for multi-turn sessions
+def message_cache_key(msg: Message) -> Hashable:
+    """Exact content key for one message, built from hashable primitives.
+
+    Serializing and hashing every historical message costs more than
+    converting it, so the key reuses Python's (per-process salted) string hashing.
+    """
+    if isinstance(msg.content, str):
+        return (msg.role, msg.content)
+    block_keys = [msg.role]
+    for block in msg.content:
+        if block.type == Constants.CONTENT_TEXT:
+            # Tagged: string content and a lone text block convert differently
+            block_keys.append((block.type, block.text))
+        elif block.type == Constants.CONTENT_TOOL_USE:
+            block_keys.append((block.type, block.id, block.name, freeze(block.input)))
+        elif block.type == Constants.CONTENT_TOOL_RESULT:
+            block_keys.append((block.type, block.tool_use_id, freeze(block.content)))
+        else:
+            block_keys.append((block.type, freeze(block.source)))
+    return tuple(block_keys)
+
+def request_identity(request: MessagesRequest) -> Hashable:
+    """Exact in-process identity of everything that shapes the upstream answer.
+
+    Cheaper than hashing the converted request (no serialization) and compared
+    by value on hash match, so distinct requests can never be mixed up.
+    """
+    return (
+        request.model,
+        # The client's model name is echoed in the response
+        request.original_model,
+        request.max_tokens,
+        request.temperature,
+        request.top_p,
+        request.top_k,
+        tuple(request.stop_sequences or ()),
+        request.thinking.enabled if request.thinking is not None else None,
+        freeze(request.tool_choice),
+        extract_system_text(request.system),
+        tools_cache_key(request.tools or ()),
+        tuple(message_cache_key(msg) for msg in request.messages),
+    )
+
+def message_size(msg: Message) -> int:
+    """Approximate memory held by a cached message conversion (string payload bytes)."""
+    if isinstance(msg.content, str):
+        return len(msg.content)
+    size = 0
+    for block in msg.content:
+        if block.type == Constants.CONTENT_TEXT:
+            size += len(block.text)
+        elif block.type == Constants.CONTENT_IMAGE:
+            size += len(block.source.get("data") or "") if isinstance(block.source, dict) else 0
+        elif block.type == Constants.CONTENT_TOOL_RESULT and isinstance(block.content, str):
+            size += len(block.content)
+        else:
+            # Structured payloads: count them roughly at 1 KiB per block
+            size += 1024
+    return size
+
+conversation_cache = LRUCache(
+    config.conversation_cache_size,
+    max_weight=config.conversation_cache_max_mb * 1024 * 1024
+)
+# Identifies each cached conversion, so a child entry can name its exact parent
+conversation_entry_ids = itertools.count(1)
+
+def convert_messages_cached(messages: List[Message], target: str) -> List[Dict[str, Any]]:
+    """Convert a message history for "litellm" or "gemini", reusing an already converted prefix.
+
+    Each message is keyed by its exact content key plus the id of the cached
+    entry for the history before it (compared by value, never by hash alone),
+    so turn N+1 of a session only converts the newly appended messages.
+    Entries are weighted by approximate payload size and evicted LRU once
+    CONVERSATION_CACHE_MAX_MB is exceeded. Cached message dicts are shared
+    between requests and must be treated as read-only.
+    """
+    converted = []
+    tool_names: Dict[str, str] = {}
+
+    if not conversation_cache.enabled:
+        for msg in messages:
+            if target == "litellm":
+                converted.extend(convert_message_to_litellm(msg))
+            else:
+                msg_contents, new_tool_names = convert_message_to_gemini(msg, tool_names)
+                converted.extend(msg_contents)
+                tool_names.update(new_tool_names)
+        return converted
+
+    parent_id: Hashable = target
+    for msg in messages:
+        key = (parent_id, message_cache_key(msg))
+        entry = conversation_cache.get(key)
+        if entry is None:
+            if target == "litellm":
+                msg_converted, new_tool_names = convert_message_to_litellm(msg), {}
+            else:
+                msg_converted, new_tool_names = convert_message_to_gemini(msg, tool_names)
+            entry = (msg_converted, new_tool_names, next(conversation_entry_ids))
+            conversation_cache.set(key, entry, weight=message_size(msg))
+
+        msg_converted, new_tool_names, parent_id = entry
+        converted.extend(msg_converted)
+        if new_tool_names:
+            tool_names.update(new_tool_names)
+    return converted
+
+def extract_system_text(system: Optional[Union[str, List[SystemContent]]]) -> str:
+    """Join the system prompt into one stripped string ("" when there is none)."""
+    if not system:
+        return ""
+    if isinstance(system, str):
+        return system.strip()
+    text_parts = []
+    for block in system:
+        if hasattr(block, 'type') and block.type == Constants.CONTENT_TEXT:
+            text_parts.append(block.text)
+        elif isinstance(block, dict) and block.get("type") == Constants.CONTENT_TEXT:
+            text_parts.append(block.get("text", ""))
+    return "\n\n".join(text_parts).strip()
+
+# Enhanced message conversion
+def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str, Any]:
+    """Convert Anthropic API request format to LiteLLM format for Gemini."""
+    litellm_messages = []
+    
+    # System message handling
+    system_text = extract_system_text(anthropic_request.system)
+    if system_text:
+        litellm_messages.append({"role": Constants.ROLE_SYSTEM, "content": system_text})
+
+    # Process messages (unchanged history prefix is served from the conversation cache)
+    litellm_messages.extend(convert_messages_cached(anthropic_request.messages, "litellm"))
 
     # Build final LiteLLM request
     litellm_request = {
@@ -561,18 +1254,7 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
 
     # Add tools with schema cleaning
     if anthropic_request.tools:
-        valid_tools = []
-        for tool in anthropic_request.tools:
-            if tool.name and tool.name.strip():
-                cleaned_schema = clean_gemini_schema(tool.input_schema)
-                valid_tools.append({
-                    "type": Constants.TOOL_FUNCTION,
-                    Constants.TOOL_FUNCTION: {
-                        "name": tool.name,
-                        "description": tool.description or "",
-                        "parameters": cleaned_schema
-                    }
-                })
+        valid_tools = convert_tools(anthropic_request.tools, "litellm", mutable=True)
         if valid_tools:
             litellm_request["tools"] = valid_tools
 
@@ -624,6 +1306,33 @@ def convert_anthropic_to_litellm(anthropic_request: MessagesRequest) -> Dict[str
 
     return litellm_request
 
+# Prompt cache usage reporting
+def usage_cached_tokens(usage: Any) -> int:
+    """Prompt tokens served from a Gemini cache (implicit or explicit), from dict or object usage."""
+    if isinstance(usage, dict):
+        details = usage.get("prompt_tokens_details") or {}
+        return (details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", 0)) or 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", 0) or 0
+
+def build_usage(prompt_tokens: int, output_tokens: int, cached_tokens: int = 0,
+                cache_creation_tokens: int = 0) -> Usage:
+    """Split Gemini prompt tokens into Anthropic's uncached / cache read / cache creation buckets.
+
+    Gemini counts the whole prompt (cached part included) in promptTokenCount, while
+    Anthropic's input_tokens only covers tokens that were neither read from nor
+    written to the cache. A cache created for this request is read back in the same
+    call, so those tokens are reported as creation rather than read.
+    """
+    cached_tokens = min(cached_tokens, prompt_tokens) if prompt_tokens else cached_tokens
+    cache_creation_tokens = min(cache_creation_tokens, cached_tokens)
+    return Usage(
+        input_tokens=max(prompt_tokens - cached_tokens, 0),
+        output_tokens=output_tokens,
+        cache_creation_input_tokens=cache_creation_tokens,
+        cache_read_input_tokens=cached_tokens - cache_creation_tokens,
+    )
+
 # Response conversion
 def convert_litellm_to_anthropic(litellm_response, original_request: MessagesRequest) -> MessagesResponse:
     """Convert LiteLLM (Gemini) response back to Anthropic API format."""
@@ -659,6 +1368,7 @@ def convert_litellm_to_anthropic(litellm_response, original_request: MessagesReq
         finish_reason = "stop"
         prompt_tokens = 0
         completion_tokens = 0
+        cached_tokens = 0
 
         # Handle LiteLLM ModelResponse object format
         if hasattr(litellm_response, 'choices') and hasattr(litellm_response, 'usage'):
@@ -673,6 +1383,7 @@ def convert_litellm_to_anthropic(litellm_response, original_request: MessagesReq
                 usage = litellm_response.usage
                 prompt_tokens = getattr(usage, "prompt_tokens", 0)
                 completion_tokens = getattr(usage, "completion_tokens", 0)
+                cached_tokens = usage_cached_tokens(usage)
                 
         # Handle dictionary response format
         elif isinstance(litellm_response, dict):
@@ -684,6 +1395,7 @@ def convert_litellm_to_anthropic(litellm_response, original_request: MessagesReq
             usage = litellm_response.get("usage", {})
             prompt_tokens = usage.get("prompt_tokens", 0)
             completion_tokens = usage.get("completion_tokens", 0)
+            cached_tokens = usage_cached_tokens(usage)
             response_id = litellm_response.get("id", response_id)
 
         # Build content blocks
@@ -756,10 +1468,7 @@ def convert_litellm_to_anthropic(litellm_response, original_request: MessagesReq
             content=content_blocks,
             stop_reason=stop_reason,
             stop_sequence=None,
-            usage=Usage(
-                input_tokens=prompt_tokens,
-                output_tokens=completion_tokens
-            )
+            usage=build_usage(prompt_tokens, completion_tokens, cached_tokens)
         )
         
     except Exception as e:
@@ -775,17 +1484,146 @@ def convert_litellm_to_anthropic(litellm_response, original_request: MessagesReq
             usage=Usage(input_tokens=0, output_tokens=0)
         )
 
+# Native Gemini request conversion (UPSTREAM_ENGINE=native)
+def convert_anthropic_to_gemini(anthropic_request: MessagesRequest) -> Dict[str, Any]:
+    """Convert Anthropic API request format straight to a Gemini generateContent body."""
+    gemini_request: Dict[str, Any] = {}
+
+    # System instruction
+    system_text = extract_system_text(anthropic_request.system)
+    if system_text:
+        gemini_request["systemInstruction"] = {"parts": [{"text": system_text}]}
+
+    # Messages (unchanged history prefix is served from the conversation cache)
+    gemini_request["contents"] = convert_messages_cached(anthropic_request.messages, "gemini")
+
+    # Generation config
+    generation_config: Dict[str, Any] = {
+        "maxOutputTokens": min(anthropic_request.max_tokens, config.max_tokens_limit),
+    }
+    if anthropic_request.temperature is not None:
+        generation_config["temperature"] = anthropic_request.temperature
+    if anthropic_request.top_p is not None:
+        generation_config["topP"] = anthropic_request.top_p
+    if anthropic_request.top_k is not None:
+        generation_config["topK"] = anthropic_request.top_k
+    if anthropic_request.stop_sequences:
+        generation_config["stopSequences"] = anthropic_request.stop_sequences
+    if anthropic_request.thinking is not None:
+        generation_config["thinkingConfig"] = {"thinkingBudget": 24576 if anthropic_request.thinking.enabled else 0}
+    gemini_request["generationConfig"] = generation_config
+
+    # Tools with schema cleaning
+    if anthropic_request.tools:
+        function_declarations = convert_tools(anthropic_request.tools, "gemini")
+        if function_declarations:
+            gemini_request["tools"] = [{"functionDeclarations": function_declarations}]
+
+    # Tool choice configuration
+    if anthropic_request.tool_choice and gemini_request.get("tools"):
+        choice_type = anthropic_request.tool_choice.get("type")
+        if choice_type == "any":
+            gemini_request["toolConfig"] = {"functionCallingConfig": {"mode": "ANY"}}
+        elif choice_type == "tool" and "name" in anthropic_request.tool_choice:
+            gemini_request["toolConfig"] = {"functionCallingConfig": {
+                "mode": "ANY",
+                "allowedFunctionNames": [anthropic_request.tool_choice["name"]]
+            }}
+        else:
+            gemini_request["toolConfig"] = {"functionCallingConfig": {"mode": "AUTO"}}
+
+    return gemini_request
+
+def convert_gemini_to_anthropic(gemini_response: Dict[str, Any], original_request: MessagesRequest,
+                                cache_creation_tokens: int = 0) -> MessagesResponse:
+    """Convert a Gemini generateContent response back to Anthropic API format."""
+    clean_model_name = model_manager._clean_model_name(original_request.original_model or original_request.model)
+    try:
+        candidates = gemini_response.get("candidates") or []
+        candidate = candidates[0] if candidates else {}
+
+        text_parts = []
+        tool_blocks = []
+        for part in (candidate.get("content") or {}).get("parts") or []:
+            if part.get("thought"):
+                continue
+            if "text" in part:
+                text_parts.append(part["text"])
+            elif "functionCall" in part:
+                function_call = part["functionCall"]
+                if not function_call.get("name"):
+                    continue
+                tool_blocks.append(ContentBlockToolUse(
+                    type=Constants.CONTENT_TOOL_USE,
+                    id=function_call.get("id") or f"toolu_{uuid.uuid4().hex[:24]}",
+                    name=function_call["name"],
+                    input=function_call.get("args") or {}
+                ))
+
+        content_blocks = []
+        content_text = "".join(text_parts)
+        if content_text:
+            content_blocks.append(ContentBlockText(type=Constants.CONTENT_TEXT, text=content_text))
+        content_blocks.extend(tool_blocks)
+        if not content_blocks:
+            content_blocks.append(ContentBlockText(type=Constants.CONTENT_TEXT, text=""))
+
+        finish_reason = candidate.get("finishReason")
+        if tool_blocks:
+            stop_reason = Constants.STOP_TOOL_USE
+        elif finish_reason == "MAX_TOKENS":
+            stop_reason = Constants.STOP_MAX_TOKENS
+        else:
+            stop_reason = Constants.STOP_END_TURN
+
+        usage_metadata = gemini_response.get("usageMetadata") or {}
+        return MessagesResponse(
+            id=f"msg_{gemini_response.get('responseId') or uuid.uuid4().hex[:24]}",
+            model=clean_model_name,
+            role=Constants.ROLE_ASSISTANT,
+            content=content_blocks,
+            stop_reason=stop_reason,
+            stop_sequence=None,
+            usage=build_usage(
+                usage_metadata.get("promptTokenCount", 0),
+                usage_metadata.get("candidatesTokenCount", 0),
+                usage_metadata.get("cachedContentTokenCount", 0),
+                cache_creation_tokens
+            )
+        )
+
+    except Exception as e:
+        logger.error(f"Error converting Gemini response: {e}")
+        return MessagesResponse(
+            id=f"msg_error_{uuid.uuid4()}",
+            model=clean_model_name,
+            role=Constants.ROLE_ASSISTANT,
+            content=[ContentBlockText(type=Constants.CONTENT_TEXT, text="Response conversion error")],
+            stop_reason=Constants.STOP_ERROR,
+            usage=Usage(input_tokens=0, output_tokens=0)
+        )
+
 # Enhanced streaming handler with more robust error recovery
-async def handle_streaming_with_recovery(response_generator, original_request: MessagesRequest):
-    """Enhanced streaming handler with robust error recovery for malformed chunks."""
+async def handle_streaming_with_recovery(response_generator, original_request: MessagesRequest,
+                                         cache_creation_tokens: int = 0, on_complete=None,
+                                         timer: Optional[RequestTimer] = None):
+    """Enhanced streaming handler with robust error recovery for malformed chunks.
+
+    ``on_complete`` (async, optional) receives the assembled MessagesResponse
+    once a stream finished cleanly, e.g. to store it in the response cache.
+    ``timer`` is the request's phase timer: it feeds the time to first token
+    metric, the message_start timing metadata and the upstream stream phases.
+    """
     message_id = f"msg_{uuid.uuid4().hex[:24]}"
+    stream_started_at = time.monotonic()
     
     # Send initial SSE events
-    yield f"event: {Constants.EVENT_MESSAGE_START}\ndata: {json.dumps({'type': Constants.EVENT_MESSAGE_START, 'message': {'id': message_id, 'type': 'message', 'role': Constants.ROLE_ASSISTANT, 'model': original_request.original_model or original_request.model, 'content': [], 'stop_reason': None, 'stop_sequence': None, 'usage': {'input_tokens': 0, 'output_tokens': 0}}})}\n\n"
+    metadata = {"server_timing": timer.durations_ms()} if timer is not None and config.server_timing else None
+    yield sse_encoder.message_start(message_id, original_request.original_model or original_request.model, metadata)
     
-    yield f"event: {Constants.EVENT_CONTENT_BLOCK_START}\ndata: {json.dumps({'type': Constants.EVENT_CONTENT_BLOCK_START, 'index': 0, 'content_block': {'type': Constants.CONTENT_TEXT, 'text': ''}})}\n\n"
+    yield sse_encoder.text_block_start(0)
     
-    yield f"event: {Constants.EVENT_PING}\ndata: {json.dumps({'type': Constants.EVENT_PING})}\n\n"
+    yield sse_encoder.PING
 
     # Streaming state management
     accumulated_text = ""
@@ -794,7 +1632,10 @@ async def handle_streaming_with_recovery(response_generator, original_request: M
     current_tool_calls = {}
     input_tokens = 0
     output_tokens = 0
+    cached_tokens = 0
     final_stop_reason = Constants.STOP_END_TURN
+    first_chunk_received = False
+    first_token_at = None
     
     # Enhanced error recovery tracking
     consecutive_errors = 0
@@ -803,82 +1644,17 @@ async def handle_streaming_with_recovery(response_generator, original_request: M
     malformed_chunks_count = 0
     max_malformed_chunks = 20  # Allow more malformed chunks before giving up
     
-    # Buffer for incomplete chunks
-    chunk_buffer = ""
-    
-    def is_malformed_chunk(chunk_str: str) -> bool:
-        """Enhanced malformed chunk detection."""
-        if not chunk_str or not isinstance(chunk_str, str):
-            return True
-            
-        chunk_stripped = chunk_str.strip()
-        
-        # Empty or whitespace
-        if not chunk_stripped:
-            return True
-            
-        # Single characters that indicate malformed JSON
-        malformed_singles = ["{", "}", "[", "]", ",", ":", '"', "'"]
-        if chunk_stripped in malformed_singles:
-            return True
-            
-        # Common malformed patterns
-        malformed_patterns = [
-            '{"', '"}', "[{", "}]", "{}", "[]", 
-            "null", '""', "''", " ", "",
-            "{,", ",}", "[,", ",]"
-        ]
-        if chunk_stripped in malformed_patterns:
-            return True
-            
-        # Incomplete JSON structures
-        if chunk_stripped.startswith('{') and not chunk_stripped.endswith('}'):
-            if len(chunk_stripped) < 15:  # Very short incomplete JSON
-                return True
-                
-        if chunk_stripped.startswith('[') and not chunk_stripped.endswith(']'):
-            if len(chunk_stripped) < 10:
-                return True
-        
-        # Check for obviously broken JSON patterns
-        if chunk_stripped.count('{') != chunk_stripped.count('}'):
-            if len(chunk_stripped) < 20:  # Only for short chunks
-                return True
-                
-        if chunk_stripped.count('[') != chunk_stripped.count(']'):
-            if len(chunk_stripped) < 20:
-                return True
-        
-        return False
+    # Incremental decoder for raw string chunks (keeps scan state between chunks)
+    chunk_decoder = IncrementalJSONDecoder()
+    decoded_chunks = deque()
     
-    def try_parse_buffered_chunk(buffer: str) -> tuple[dict, str]:
-        """Try to parse buffered chunks, return parsed chunk and remaining buffer."""
-        if not buffer.strip():
-            return None, ""
-            
-        # Try to find complete JSON objects in the buffer
-        brace_count = 0
-        start_pos = -1
-        
-        for i, char in enumerate(buffer):
-            if char == '{':
-                if start_pos == -1:
-                    start_pos = i
-                brace_count += 1
-            elif char == '}':
-                brace_count -= 1
-                if brace_count == 0 and start_pos != -1:
-                    # Found complete JSON object
-                    json_str = buffer[start_pos:i+1]
-                    try:
-                        parsed = json.loads(json_str)
-                        remaining_buffer = buffer[i+1:]
-                        return parsed, remaining_buffer
-                    except json.JSONDecodeError:
-                        continue
-        
-        # No complete JSON found
-        return None, buffer
+    # Optional delta coalescing (STREAM_COALESCE_WINDOW_MS / STREAM_COALESCE_MAX_CHARS)
+    coalescer = sse_encoder.DeltaCoalescer(
+        window=config.stream_coalesce_window_ms / 1000,
+        max_chars=config.stream_coalesce_max_chars
+    )
+    next_chunk_task = None
+    chunk_wait_deadline = 0.0
     
     try:
         # Wrap the entire streaming process in comprehensive error handling
@@ -886,66 +1662,57 @@ async def handle_streaming_with_recovery(response_generator, original_request: M
         
         while True:
             try:
-                # Get next chunk with timeout
-                try:
-                    chunk = await asyncio.wait_for(anext(stream_iterator), timeout=90.0)
-                except StopAsyncIteration:
-                    break
-                except asyncio.TimeoutError:
-                    logger.warning("Streaming timeout, terminating")
-                    stream_terminated_early = True
-                    break
+                # Drain objects already decoded from earlier string chunks first
+                if decoded_chunks:
+                    chunk = decoded_chunks.popleft()
+                else:
+                    # Get next chunk with timeout; the fetch task survives coalescing
+                    # flushes so a stalled upstream never holds buffered text back
+                    if next_chunk_task is None:
+                        next_chunk_task = asyncio.ensure_future(anext(stream_iterator))
+                        chunk_wait_deadline = time.monotonic() + 90.0
+                    wait_timeout = chunk_wait_deadline - time.monotonic()
+                    if coalescer.pending:
+                        wait_timeout = min(wait_timeout, coalescer.time_left())
+                    done, _ = await asyncio.wait({next_chunk_task}, timeout=max(wait_timeout, 0))
+                    if not done:
+                        if coalescer.pending:
+                            yield coalescer.flush()
+                            continue
+                        logger.warning("Streaming timeout, terminating")
+                        stream_terminated_early = True
+                        break
+                    finished_task, next_chunk_task = next_chunk_task, None
+                    try:
+                        chunk = finished_task.result()
+                    except StopAsyncIteration:
+                        break
                 
                 # Reset consecutive error counter on successful chunk retrieval
                 consecutive_errors = 0
+                if not first_chunk_received:
+                    first_chunk_received = True
+                    if timer is not None:
+                        timer.record("upstream_first_chunk", stream_started_at)
                 
                 # Handle string chunks with enhanced validation
                 if isinstance(chunk, str):
                     if chunk.strip() == "[DONE]":
                         break
                     
-                    # Check for malformed chunks
-                    if is_malformed_chunk(chunk):
-                        malformed_chunks_count += 1
-                        logger.debug(f"Skipping malformed chunk #{malformed_chunks_count}: '{chunk[:50]}{'...' if len(chunk) > 50 else ''}'")
-                        
-                        if malformed_chunks_count > max_malformed_chunks:
-                            logger.error(f"Too many malformed chunks ({malformed_chunks_count}), terminating stream")
-                            stream_terminated_early = True
-                            break
-                        continue
-                    
-                    # Add to buffer and try to parse
-                    chunk_buffer += chunk
-                    parsed_chunk, chunk_buffer = try_parse_buffered_chunk(chunk_buffer)
-                    
-                    if parsed_chunk is None:
-                        # Keep buffering if we don't have a complete chunk yet
-                        if len(chunk_buffer) > 10000:  # Prevent buffer from growing too large
-                            logger.warning("Chunk buffer too large, clearing")
-                            chunk_buffer = ""
-                        continue
-                    
-                    chunk = parsed_chunk
+                    # Feed the decoder; every complete object it finds is queued
+                    decoded_chunks.extend(chunk_decoder.feed(chunk))
+                    malformed_chunks_count = chunk_decoder.malformed_count
+                    if malformed_chunks_count > max_malformed_chunks:
+                        logger.error(f"Too many malformed chunks ({malformed_chunks_count}), terminating stream")
+                        stream_terminated_early = True
+                        break
+                    continue
                 
-                # If we have a dictionary at this point, process it
-                if isinstance(chunk, dict):
-                    # Process the chunk normally (existing logic)
-                    pass
-                elif hasattr(chunk, 'choices'):
-                    # Process ModelResponse object normally (existing logic)
-                    pass
-                else:
-                    # Try one more JSON parse attempt
-                    try:
-                        if isinstance(chunk, str):
-                            chunk = json.loads(chunk)
-                        else:
-                            logger.debug(f"Skipping unprocessable chunk type: {type(chunk)}")
-                            continue
-                    except json.JSONDecodeError as parse_error:
-                        logger.debug(f"Failed to parse chunk as JSON: {parse_error}")
-                        continue
+                # Only dicts (native engine / decoded strings) and ModelResponse objects carry chunk data
+                if not isinstance(chunk, dict) and not hasattr(chunk, 'choices'):
+                    logger.debug(f"Skipping unprocessable chunk type: {type(chunk)}")
+                    continue
 
                 # Extract chunk data (your existing logic here)
                 delta_content_text = None
@@ -972,49 +1739,69 @@ async def handle_streaming_with_recovery(response_generator, original_request: M
                 if hasattr(chunk, 'usage') and chunk.usage:
                     input_tokens = getattr(chunk.usage, 'prompt_tokens', 0)
                     output_tokens = getattr(chunk.usage, 'completion_tokens', 0)
+                    cached_tokens = usage_cached_tokens(chunk.usage)
                 elif isinstance(chunk, dict) and "usage" in chunk:
                     usage = chunk["usage"]
                     input_tokens = usage.get("prompt_tokens", 0)
                     output_tokens = usage.get("completion_tokens", 0)
+                    cached_tokens = usage_cached_tokens(usage)
+
+                if first_token_at is None and (delta_content_text or delta_tool_calls):
+                    first_token_at = time.monotonic()
+                    if timer is not None:
+                        metric_time_to_first_token.observe(first_token_at - timer.start, original_request.model)
 
                 # Handle text delta
                 if delta_content_text:
                     accumulated_text += delta_content_text
-                    yield f"event: {Constants.EVENT_CONTENT_BLOCK_DELTA}\ndata: {json.dumps({'type': Constants.EVENT_CONTENT_BLOCK_DELTA, 'index': text_block_index, 'delta': {'type': Constants.DELTA_TEXT, 'text': delta_content_text}})}\n\n"
+                    frames = coalescer.add(text_block_index, Constants.DELTA_TEXT, delta_content_text)
+                    if frames:
+                        yield frames
 
                 # Handle tool call deltas (your existing logic)
                 if delta_tool_calls:
                     for tc_chunk in delta_tool_calls:
-                        if not (hasattr(tc_chunk, 'function') and tc_chunk.function and 
-                               hasattr(tc_chunk.function, 'name') and tc_chunk.function.name):
+                        # Dict tool calls come from the native engine, objects from LiteLLM
+                        if isinstance(tc_chunk, dict):
+                            tc_function = tc_chunk.get(Constants.TOOL_FUNCTION) or {}
+                            tool_call_id = tc_chunk.get("id")
+                            tc_name = tc_function.get("name")
+                            tc_arguments = tc_function.get("arguments")
+                        elif hasattr(tc_chunk, 'function') and tc_chunk.function:
+                            tool_call_id = tc_chunk.id
+                            tc_name = getattr(tc_chunk.function, 'name', None)
+                            tc_arguments = getattr(tc_chunk.function, 'arguments', None)
+                        else:
                             continue
-                            
-                        tool_call_id = tc_chunk.id
-                        
+
+                        if not tc_name:
+                            continue
+
                         if tool_call_id not in current_tool_calls:
                             tool_block_counter += 1
                             tool_index = text_block_index + tool_block_counter
-                            
+
                             current_tool_calls[tool_call_id] = {
                                 "index": tool_index,
-                                "name": tc_chunk.function.name or "",
-                                "args_buffer": tc_chunk.function.arguments or ""
+                                "name": tc_name,
+                                "args_buffer": ""
                             }
-                            
-                            yield f"event: {Constants.EVENT_CONTENT_BLOCK_START}\ndata: {json.dumps({'type': Constants.EVENT_CONTENT_BLOCK_START, 'index': tool_index, 'content_block': {'type': Constants.CONTENT_TOOL_USE, 'id': tool_call_id, 'name': current_tool_calls[tool_call_id]['name'], 'input': {}}})}\n\n"
-                        
-                        if tc_chunk.function.arguments:
-                            current_tool_calls[tool_call_id]["args_buffer"] += tc_chunk.function.arguments
-                            yield f"event: {Constants.EVENT_CONTENT_BLOCK_DELTA}\ndata: {json.dumps({'type': Constants.EVENT_CONTENT_BLOCK_DELTA, 'index': current_tool_calls[tool_call_id]['index'], 'delta': {'type': Constants.DELTA_INPUT_JSON, 'partial_json': tc_chunk.function.arguments}})}\n\n"
+
+                            yield coalescer.flush() + sse_encoder.tool_block_start(tool_index, tool_call_id, tc_name)
+
+                        if tc_arguments:
+                            current_tool_calls[tool_call_id]["args_buffer"] += tc_arguments
+                            frames = coalescer.add(current_tool_calls[tool_call_id]['index'], Constants.DELTA_INPUT_JSON, tc_arguments)
+                            if frames:
+                                yield frames
 
                 # Handle finish reason
                 if chunk_finish_reason:
                     if chunk_finish_reason == "length":
                         final_stop_reason = Constants.STOP_MAX_TOKENS
-                    elif chunk_finish_reason == "tool_calls":
+                    elif chunk_finish_reason == "tool_calls" or current_tool_calls:
+                        # Gemini may send the functionCall and the finishReason in separate events
                         final_stop_reason = Constants.STOP_TOOL_USE
-                    elif chunk_finish_reason == "stop":
-                        final_stop_reason = Constants.STOP_END_TURN
                     else:
                         final_stop_reason = Constants.STOP_END_TURN
                     break
@@ -1039,13 +1826,13 @@ async def handle_streaming_with_recovery(response_generator, original_request: M
                     
                     logger.warning(f"Gemini malformed chunk error (attempt {consecutive_errors}/{max_consecutive_errors})")
                     
-                    if consecutive_errors >= max_consecutive_errors:
+                    if consecutive_errors >= max_consecutive_errors or not await retry_allowed("chunk"):
                         logger.error(f"Too many consecutive API errors ({consecutive_errors}), terminating stream")
                         stream_terminated_early = True
                         
                         # Send error info to client
                         error_text = f"\n⚠️ Gemini streaming encountered repeated malformed chunks. This is a known API issue.\n"
-                        yield f"event: {Constants.EVENT_CONTENT_BLOCK_DELTA}\ndata: {json.dumps({'type': Constants.EVENT_CONTENT_BLOCK_DELTA, 'index': text_block_index, 'delta': {'type': Constants.DELTA_TEXT, 'text': error_text}})}\n\n"
+                        yield coalescer.flush() + sse_encoder.text_delta(text_block_index, error_text)
                         break
                     
                     # Brief delay before continuing
@@ -1061,7 +1848,7 @@ async def handle_streaming_with_recovery(response_generator, original_request: M
                 consecutive_errors += 1
                 logger.error(f"Unexpected streaming error (attempt {consecutive_errors}/{max_consecutive_errors}): {general_error}")
                 
-                if consecutive_errors >= max_consecutive_errors:
+                if consecutive_errors >= max_consecutive_errors or not await retry_allowed("chunk"):
                     logger.error(f"Too many consecutive errors ({consecutive_errors}), terminating stream")
                     stream_terminated_early = True
                     break
@@ -1073,24 +1860,58 @@ async def handle_streaming_with_recovery(response_generator, original_request: M
     except Exception as outer_error:
         logger.error(f"Fatal streaming error: {outer_error}")
         stream_terminated_early = True
+    finally:
+        if next_chunk_task is not None and not next_chunk_task.done():
+            next_chunk_task.cancel()
 
     # Always send final SSE events
     try:
-        yield f"event: {Constants.EVENT_CONTENT_BLOCK_STOP}\ndata: {json.dumps({'type': Constants.EVENT_CONTENT_BLOCK_STOP, 'index': text_block_index})}\n\n"
+        yield coalescer.flush() + sse_encoder.content_block_stop(text_block_index)
         
         for tool_data in current_tool_calls.values():
-            yield f"event: {Constants.EVENT_CONTENT_BLOCK_STOP}\ndata: {json.dumps({'type': Constants.EVENT_CONTENT_BLOCK_STOP, 'index': tool_data['index']})}\n\n"
+            yield sse_encoder.content_block_stop(tool_data['index'])
         
         if stream_terminated_early and final_stop_reason == Constants.STOP_END_TURN:
             final_stop_reason = Constants.STOP_ERROR
         
-        usage_data = {"input_tokens": input_tokens, "output_tokens": output_tokens}
-        yield f"event: {Constants.EVENT_MESSAGE_DELTA}\ndata: {json.dumps({'type': Constants.EVENT_MESSAGE_DELTA, 'delta': {'stop_reason': final_stop_reason, 'stop_sequence': None}, 'usage': usage_data})}\n\n"
-        yield f"event: {Constants.EVENT_MESSAGE_STOP}\ndata: {json.dumps({'type': Constants.EVENT_MESSAGE_STOP})}\n\n"
+        usage = build_usage(input_tokens, output_tokens, cached_tokens, cache_creation_tokens)
+        usage_data = usage.model_dump()
+        if not (usage_data["cache_creation_input_tokens"] or usage_data["cache_read_input_tokens"]):
+            del usage_data["cache_creation_input_tokens"], usage_data["cache_read_input_tokens"]
+        yield sse_encoder.message_delta(final_stop_reason, usage_data)
+        yield sse_encoder.MESSAGE_STOP
+        
+        record_usage_metrics(original_request.model, usage,
+                             time.monotonic() - first_token_at if first_token_at is not None else 0.0)
+        metric_malformed_chunks.observe(malformed_chunks_count, original_request.model)
+        if timer is not None:
+            timer.record("upstream_stream", stream_started_at)
         
         # Log final statistics
+        if chunk_decoder.pending:
+            logger.warning(f"Stream ended with {chunk_decoder.pending} chars of incomplete JSON buffered")
         if malformed_chunks_count > 0:
             logger.info(f"Stream completed with {malformed_chunks_count} malformed chunks handled")
+        if coalescer.enabled:
+            logger.debug(f"Coalesced {coalescer.fragments_in} deltas into {coalescer.events_out} events")
+        
+        if on_complete is not None and final_stop_reason != Constants.STOP_ERROR:
+            content_blocks = [ContentBlockText(type=Constants.CONTENT_TEXT, text=accumulated_text)]
+            for tool_call_id, tool_data in current_tool_calls.items():
+                try:
+                    tool_input = json.loads(tool_data["args_buffer"]) if tool_data["args_buffer"] else {}
+                except json.JSONDecodeError:
+                    tool_input = {"raw_arguments": tool_data["args_buffer"]}
+                content_blocks.append(ContentBlockToolUse(
+                    type=Constants.CONTENT_TOOL_USE, id=tool_call_id, name=tool_data["name"], input=tool_input
+                ))
+            await on_complete(MessagesResponse(
+                id=message_id,
+                model=original_request.original_model or original_request.model,
+                content=content_blocks,
+                stop_reason=final_stop_reason,
+                usage=usage
+            ))
             
     except Exception as final_error:
         logger.error(f"Error sending final SSE events: {final_error}")
@@ -1101,14 +1922,60 @@ async def log_requests(request: Request, call_next):
     method = request.method
     path = request.url.path
     logger.debug(f"Request: {method} {path}")
-    response = await call_next(request)
+    timer, timer_token = tracing.start_request(f"{method} {path}", request.headers.get("traceparent"))
+    try:
+        response = await call_next(request)
+    finally:
+        tracing.end_request(timer_token)
+    # Label by route template (not raw path) to keep metric cardinality bounded
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    model = getattr(request.state, "model", "")
+    status = str(response.status_code)
+    timer.name = f"{method} {route}"
+    timer.attributes.update({"http.route": route, "http.status_code": response.status_code, "gemini.model": model})
+    # For streams this covers everything up to the response headers
+    if config.server_timing:
+        response.headers["Server-Timing"] = timer.server_timing()
+    if response.headers.get("content-type", "").startswith("text/event-stream"):
+        response.body_iterator = track_stream_metrics(response.body_iterator, route, model, status, timer)
+    else:
+        finish_request(route, model, status, timer)
     return response
 
+# Metrics helpers
+def finish_request(route: str, model: str, status: str, timer: RequestTimer):
+    """Record the request metrics and export its spans once the last byte is sent."""
+    timer.finish()
+    metric_requests.inc(route, model, status)
+    metric_request_duration.observe(timer.end - timer.start, route, model)
+    if span_exporter is not None:
+        try:
+            span_exporter.export(timer)
+        except Exception as e:
+            logger.warning(f"Failed to export request spans: {e}")
+
+async def track_stream_metrics(body_iterator, route: str, model: str, status: str, timer: RequestTimer):
+    """Count an SSE response as in flight until its last byte is sent (or the client leaves)."""
+    metric_streams_in_flight.inc()
+    try:
+        async for chunk in body_iterator:
+            yield chunk
+    finally:
+        metric_streams_in_flight.dec()
+        finish_request(route, model, status, timer)
+
+def record_usage_metrics(model: str, usage: Usage, generation_seconds: float):
+    """Token totals and output rate for one upstream response."""
+    metric_input_tokens.inc(model, amount=usage.input_tokens + usage.cache_read_input_tokens + usage.cache_creation_input_tokens)
+    metric_output_tokens.inc(model, amount=usage.output_tokens)
+    if usage.output_tokens > 0 and generation_seconds > 0:
+        metric_output_tokens_per_second.observe(usage.output_tokens / generation_seconds, model)
+
 # API Key Authentication Middleware
 @app.middleware("http")
 async def authenticate_api_key(request: Request, call_next):
-    # Skip authentication for health check and root endpoints
-    if request.url.path in ["/", "/health"]:
+    # Skip authentication for health check, metrics and root endpoints
+    if request.url.path in ["/", "/health", "/metrics"]:
         response = await call_next(request)
         return response
     
@@ -1151,12 +2018,548 @@ async def authenticate_api_key(request: Request, call_next):
         )
     
     logger.debug("API key validation successful")
+    # Trusted for FAST_PATH=authenticated
+    request.state.authenticated = True
     response = await call_next(request)
     return response
 
+# Gemini context caching (cache_control breakpoints -> cachedContents)
+def context_cache_breakpoint(request: MessagesRequest) -> Optional[int]:
+    """Number of leading Gemini contents covered by the last cache_control marker.
+
+    Returns 0 when only tools or system blocks are marked, None when nothing is.
+    """
+    for index in range(len(request.messages) - 1, -1, -1):
+        content = request.messages[index].content
+        if not isinstance(content, str) and any(block.cache_control for block in content):
+            # Served from the conversation cache, so this costs one dict lookup per message
+            return len(convert_messages_cached(request.messages[:index + 1], "gemini"))
+    if request.tools and any(tool.cache_control for tool in request.tools):
+        return 0
+    if isinstance(request.system, list) and any(block.cache_control for block in request.system):
+        return 0
+    return None
+
+async def call_native_with_context_cache(request: MessagesRequest, upstream_request: Dict[str, Any], call,
+                                         api_key: Optional[str] = None):
+    """Run ``call(body)`` against Gemini, using a cached prefix when context caching applies.
+
+    Returns the call result and the number of tokens this request wrote to a new cache.
+    A request whose cache Gemini no longer knows is retried once without it.
+    """
+    if context_cache is None:
+        return await call(upstream_request), 0
+    breakpoint = context_cache_breakpoint(request)
+    body, cache_creation_tokens, cache_key = await context_cache.prepare(
+        request.model, upstream_request, breakpoint, api_key
+    )
+    if cache_key is None:
+        return await call(upstream_request), 0
+    try:
+        return await call(body), cache_creation_tokens
+    except GeminiAPIError as e:
+        if not is_stale_cache_error(e):
+            raise
+        logger.warning(f"Gemini context cache no longer valid, retrying uncached: {e.message}")
+        context_cache.invalidate(cache_key)
+        return await call(upstream_request), 0
+
+# Image upload cache (inline images -> Gemini Files API references)
+async def call_with_uploaded_images(upstream_request: Dict[str, Any], call, api_key: Optional[str]):
+    """Run ``call(body)`` with already uploaded history images sent as file references.
+
+    Images seen for the first time go inline and are uploaded in the background.
+    A request Gemini rejects because a file is gone is retried once fully inline.
+    """
+    if image_store is None:
+        return await call(upstream_request)
+    if native_client is not None:
+        body, file_keys = image_store.rewrite_gemini(upstream_request, api_key)
+    else:
+        body, file_keys = image_store.rewrite_litellm(upstream_request, api_key)
+    if not file_keys:
+        return await call(upstream_request)
+    try:
+        return await call(body)
+    except Exception as e:
+        if not is_stale_file_error(e):
+            raise
+        logger.warning(f"Uploaded image no longer available, retrying inline: {e}")
+        image_store.invalidate(file_keys)
+        return await call(upstream_request)
+
+# API key pool helpers
+def is_rate_limit_error(error: Exception) -> bool:
+    return getattr(error, "status_code", None) == 429 or isinstance(error, litellm.exceptions.RateLimitError)
+
+def release_key_after_error(lease: KeyLease, error: Exception):
+    """Return a key to the pool, cooling it down when upstream rate limited it."""
+    if is_rate_limit_error(error):
+        retry_after = getattr(error, "retry_after", None)
+        if retry_after is None:
+            retry_after = parse_retry_delay(str(error))
+        lease.release(rate_limited=True, retry_after=retry_after)
+    else:
+        lease.release(failed=True)
+
+def litellm_request_for_key(upstream_request: Dict[str, Any], api_key: str) -> Dict[str, Any]:
+    """Copy of a LiteLLM request authenticated with ``api_key``."""
+    extra_headers = upstream_request.get("extra_headers")
+    if extra_headers and "x-goog-api-key" in extra_headers:
+        return {**upstream_request, "extra_headers": {**extra_headers, "x-goog-api-key": api_key}}
+    if "api_key" in upstream_request:
+        return {**upstream_request, "api_key": api_key}
+    return upstream_request
+
+async def retry_allowed(kind: str) -> bool:
+    """Spend one retry from the process-wide budget (always allowed when it is disabled)."""
+    allowed = retry_budget is None or await retry_budget.try_retry(kind)
+    metric_retries.inc(kind, "allowed" if allowed else "denied")
+    return allowed
+
+async def run_with_api_key(call, max_retries: int = 0):
+    """Await ``call(api_key)`` with a key from the pool.
+
+    A rate-limited call is retried on another key while one is available, and
+    overload errors are retried up to ``max_retries`` times with backoff; every
+    retry is drawn from the retry budget.
+    """
+    attempts = 0
+    retries = 0
+    while True:
+        lease = key_pool.acquire()
+        try:
+            result = await call(lease.key)
+        except asyncio.CancelledError:
+            # e.g. the losing attempt of a hedged call
+            lease.release()
+            raise
+        except Exception as e:
+            release_key_after_error(lease, e)
+            attempts += 1
+            if is_rate_limit_error(e) and attempts < len(key_pool) and key_pool.has_available() and await retry_allowed("key_rotation"):
+                logger.warning(f"Rate limited on key {mask_key(lease.key)}, retrying with another key")
+                continue
+            if is_overload_error(e) and retries < max_retries and await retry_allowed("upstream"):
+                retries += 1
+                delay = min(0.5 * (2 ** retries), 4.0)
+                logger.warning(f"Upstream error (retry {retries}/{max_retries} in {delay}s): {e}")
+                await asyncio.sleep(delay)
+                continue
+            raise
+        lease.release()
+        return result
+
+# Circuit breaker helpers
+def is_overload_error(error: BaseException) -> bool:
+    """Errors that say the model is overloaded or unhealthy (as opposed to a bad request)."""
+    status_code = getattr(error, "status_code", None)
+    if status_code == 429 or (isinstance(status_code, int) and status_code >= 500):
+        return True
+    return isinstance(error, (
+        TimeoutError, ConnectionError,
+        litellm.exceptions.RateLimitError, litellm.exceptions.Timeout, litellm.exceptions.APIConnectionError,
+        litellm.exceptions.ServiceUnavailableError, litellm.exceptions.InternalServerError,
+    ))
+
+def begin_circuit_call(model: str):
+    if circuit_breakers is not None:
+        circuit_breakers.breaker(model).before_call()
+
+def record_circuit_outcome(model: str, error: Optional[BaseException] = None):
+    if circuit_breakers is None:
+        return
+    breaker = circuit_breakers.breaker(model)
+    if error is None:
+        breaker.record_success()
+    elif is_overload_error(error):
+        breaker.record_failure()
+    else:
+        breaker.record_ignored()
+
+def route_request(request: MessagesRequest, upstream_request: Dict[str, Any]):
+    """Re-check the circuit before an upstream attempt: fail over, or fail fast when nothing is available."""
+    if circuit_breakers is None:
+        return
+    routed_model = model_manager.route_available(request.model)
+    if routed_model != request.model:
+        request.model = routed_model
+        if "model" in upstream_request:
+            upstream_request["model"] = routed_model
+    elif not circuit_breakers.available(routed_model):
+        raise CircuitOpenError(routed_model, circuit_breakers.breaker(routed_model).retry_after())
+
+# Upstream dispatch for the configured engine
+async def open_upstream_stream(request: MessagesRequest, upstream_request: Dict[str, Any]):
+    """Start a streaming upstream call; returns its chunk iterator and the cache creation token count.
+
+    The pool key stays counted as in flight until the returned iterator is exhausted or closed.
+    """
+    if stream_replayer is not None:
+        return stream_replayer.open(capture_request_data(request)), 0
+    model = request.model
+    begin_circuit_call(model)
+    lease = key_pool.acquire()
+    try:
+        if native_client is not None:
+            response_generator, cache_creation_tokens = await call_with_uploaded_images(
+                upstream_request,
+                lambda images_body: call_native_with_context_cache(
+                    request, images_body,
+                    lambda body: native_client.stream_generate_content(request.model, body, api_key=lease.key),
+                    lease.key
+                ),
+                lease.key
+            )
+        else:
+            response_generator = await call_with_uploaded_images(
+                upstream_request,
+                lambda body: litellm.acompletion(**litellm_request_for_key(body, lease.key)),
+                lease.key
+            )
+            cache_creation_tokens = 0
+    except asyncio.CancelledError as e:
+        lease.release()
+        record_circuit_outcome(model, e)
+        raise
+    except Exception as e:
+        release_key_after_error(lease, e)
+        record_circuit_outcome(model, e)
+        raise
+    record_circuit_outcome(model)
+    return lease.hold(response_generator), cache_creation_tokens
+
+async def open_until_first_chunk(request: MessagesRequest, upstream_request: Dict[str, Any]):
+    """Open a stream and wait for its first chunk (None when the stream is empty)."""
+    response_generator, cache_creation_tokens = await open_upstream_stream(request, upstream_request)
+    try:
+        first_chunk = await response_generator.__anext__()
+    except StopAsyncIteration:
+        first_chunk = None
+    except BaseException:
+        await response_generator.aclose()
+        raise
+    return response_generator, cache_creation_tokens, first_chunk
+
+async def with_first_chunk(first_chunk, response_generator):
+    if first_chunk is not None:
+        yield first_chunk
+    async for chunk in response_generator:
+        yield chunk
+
+async def open_hedged_stream(request: MessagesRequest, upstream_request: Dict[str, Any]):
+    """open_upstream_stream, hedged on time to first chunk when hedging is enabled."""
+    if hedger is None:
+        return await open_upstream_stream(request, upstream_request)
+    response_generator, cache_creation_tokens, first_chunk = await hedger.run(
+        (request.model, "first_chunk"),
+        lambda: open_until_first_chunk(request, upstream_request),
+        discard=lambda opened: opened[0].aclose()
+    )
+    return with_first_chunk(first_chunk, response_generator), cache_creation_tokens
+
+async def complete_upstream(request: MessagesRequest, upstream_request: Dict[str, Any]) -> MessagesResponse:
+    """Run a non-streaming upstream call (hedged when enabled) and convert the result to Anthropic format."""
+    if hedger is not None:
+        return await hedger.run((request.model, "complete"), lambda: complete_upstream_attempt(request, upstream_request))
+    return await complete_upstream_attempt(request, upstream_request)
+
+async def complete_upstream_attempt(request: MessagesRequest, upstream_request: Dict[str, Any]) -> MessagesResponse:
+    model = request.model
+    begin_circuit_call(model)
+    try:
+        anthropic_response = await call_upstream_completion(request, upstream_request)
+    except BaseException as e:
+        record_circuit_outcome(model, e)
+        raise
+    record_circuit_outcome(model)
+    return anthropic_response
+
+async def call_upstream_completion(request: MessagesRequest, upstream_request: Dict[str, Any]) -> MessagesResponse:
+    if stream_replayer is not None:
+        return await replay_completion(request)
+    if native_client is not None:
+        async def call_native(api_key: str) -> MessagesResponse:
+            with tracing.phase("upstream"):
+                gemini_response, cache_creation_tokens = await call_with_uploaded_images(
+                    upstream_request,
+                    lambda images_body: call_native_with_context_cache(
+                        request, images_body,
+                        lambda body: native_client.generate_content(request.model, body, api_key=api_key),
+                        api_key
+                    ),
+                    api_key
+                )
+            with tracing.phase("convert_response"):
+                return convert_gemini_to_anthropic(gemini_response, request, cache_creation_tokens)
+        return await run_with_api_key(call_native)
+
+    async def call_litellm(api_key: str) -> MessagesResponse:
+        with tracing.phase("upstream"):
+            litellm_response = await call_with_uploaded_images(
+                upstream_request,
+                lambda body: litellm.acompletion(**litellm_request_for_key(body, api_key)),
+                api_key
+            )
+        hidden_params = getattr(litellm_response, "_hidden_params", None) or {}
+        key_pool.observe_headers(api_key, hidden_params.get("additional_headers"))
+        with tracing.phase("convert_response"):
+            return convert_litellm_to_anthropic(litellm_response, request)
+    # MAX_RETRIES moved out of LiteLLM when the retry budget is on
+    return await run_with_api_key(call_litellm, max_retries=config.max_retries if retry_budget is not None else 0)
+
+# Stream capture / replay helpers
+def capture_request_data(request: MessagesRequest) -> Dict[str, Any]:
+    """The request as the client sent it (requested model name), for recordings and replay matching."""
+    data = request.model_dump(exclude_none=True)
+    data["model"] = data.pop("original_model", None) or request.model
+    return data
+
+def start_stream_capture(request: MessagesRequest, cache_creation_tokens: int):
+    if stream_capturer is None:
+        return None
+    return stream_capturer.start(
+        capture_request_data(request), request.model, config.upstream_engine, cache_creation_tokens,
+        settings={"stream_coalesce_window_ms": config.stream_coalesce_window_ms,
+                  "stream_coalesce_max_chars": config.stream_coalesce_max_chars}
+    )
+
+async def replay_completion(request: MessagesRequest) -> MessagesResponse:
+    """Non-streaming answer from a recorded stream (assembled by the stream handler)."""
+    completed = []
+
+    async def keep(response: MessagesResponse):
+        completed.append(response)
+    async for _ in handle_streaming_with_recovery(stream_replayer.open(capture_request_data(request)), request,
+                                                  on_complete=keep):
+        pass
+    if not completed:
+        raise RuntimeError("Replayed stream ended with an error")
+    return completed[0]
+
+# Admission control helpers
+def admission_priority(request: MessagesRequest) -> int:
+    """Interactive (haiku / SMALL_MODEL) calls are queued ahead of long big-model jobs."""
+    requested = (request.original_model or request.model).lower()
+    if 'haiku' in requested:
+        return PRIORITY_INTERACTIVE
+    if request.model == f"gemini/{model_manager._clean_model_name(config.small_model)}" and config.small_model != config.big_model:
+        return PRIORITY_INTERACTIVE
+    return PRIORITY_BATCH
+
+async def admit(request: MessagesRequest):
+    """Wait for an upstream slot for the request's model; None when admission control is off."""
+    if admission_controller is None:
+        return None
+    with tracing.phase("admission_queue"):
+        return await admission_controller.acquire(request.model, admission_priority(request))
+
+async def complete_admitted(request: MessagesRequest, upstream_request: Dict[str, Any],
+                            response_key: Optional[str]) -> MessagesResponse:
+    route_request(request, upstream_request)
+    permit = await admit(request)
+    try:
+        reservation = await reserve_rate_budget(request)
+        anthropic_response = await complete_and_store(request, upstream_request, response_key)
+        settle_rate_budget(reservation, anthropic_response.usage)
+        return anthropic_response
+    finally:
+        if permit is not None:
+            permit.release()
+
+# Local RPM/TPM pacing helpers
+async def reserve_rate_budget(request: MessagesRequest) -> Optional[RateReservation]:
+    """Wait until the model's local RPM/TPM budget fits this call; None when it is not limited."""
+    if rate_limiter is None:
+        return None
+    limiter = rate_limiter.limiter(request.model)
+    if limiter is None:
+        return None
+    with tracing.phase("rate_limit_pacing"):
+        estimated_prompt = await count_tokens_estimate(request) if limiter.tokens is not None else 0
+        return await limiter.acquire(estimated_prompt, min(request.max_tokens, config.max_tokens_limit))
+
+def settle_rate_budget(reservation: Optional[RateReservation], usage: Usage):
+    """Correct a reservation with the real usage (unused output tokens go back to the bucket)."""
+    if reservation is None:
+        return
+    prompt_tokens = usage.input_tokens + usage.cache_read_input_tokens + usage.cache_creation_input_tokens
+    reservation.settle(prompt_tokens, usage.output_tokens)
+
+def stream_completion_hook(response_key: Optional[str], reservation: Optional[RateReservation]):
+    """on_complete callback for a stream: settle the rate budget and fill the response cache."""
+    if response_key is None and reservation is None:
+        return None
+
+    async def on_complete(response: MessagesResponse):
+        settle_rate_budget(reservation, response.usage)
+        if response_key is not None:
+            await store_cached_response(response_key, response)
+    return on_complete
+
+def local_limit_response(error_type: str, message: str, retry_after: float, status_code: int = 429) -> JSONResponse:
+    """Fast Anthropic-style error for limits enforced by the proxy itself."""
+    return JSONResponse(
+        status_code=status_code,
+        headers={"Retry-After": str(max(int(math.ceil(retry_after)), 1))},
+        content={
+            "type": "error",
+            "error": {
+                "type": error_type,
+                "message": message
+            }
+        }
+    )
+
+STREAMING_HEADERS = {
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+    "X-Accel-Buffering": "no",
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Headers": "*"
+}
+
+# Response cache helpers
+def is_response_cacheable(request: MessagesRequest, raw_request: Request) -> bool:
+    """Whether this request may be answered from / stored in the response cache."""
+    client_cache_control = raw_request.headers.get("cache-control", "").lower()
+    if "no-cache" in client_cache_control or "no-store" in client_cache_control:
+        return False
+    if config.response_cache_mode == "all":
+        return True
+    return request.temperature == 0 or request.top_k == 1
+
+async def complete_and_store(request: MessagesRequest, upstream_request: Dict[str, Any],
+                             response_key: Optional[str]) -> MessagesResponse:
+    """Non-streaming upstream call whose successful result also goes to the response cache."""
+    start_time = time.monotonic()
+    anthropic_response = await complete_upstream(request, upstream_request)
+    elapsed = time.monotonic() - start_time
+    logger.debug(f"✅ Response received: Model={request.model}, Time={elapsed:.2f}s")
+    record_usage_metrics(request.model, anthropic_response.usage, elapsed)
+    if response_key is not None and anthropic_response.stop_reason != Constants.STOP_ERROR:
+        await store_cached_response(response_key, anthropic_response)
+    return anthropic_response
+
+async def store_cached_response(response_key: str, response: MessagesResponse):
+    try:
+        await response_cache.set(response_key, response.model_dump())
+    except Exception as e:
+        logger.warning(f"Failed to store cached response: {e}")
+
+def replay_cached_response(cached_response: Dict[str, Any], request: MessagesRequest):
+    """Answer from a cached response dict, as JSON or as a replayed SSE stream."""
+    replayed = dict(cached_response, id=f"msg_{uuid.uuid4().hex[:24]}")
+    if request.stream:
+        return StreamingResponse(
+            sse_encoder.replay_message(replayed),
+            media_type="text/event-stream",
+            headers=STREAMING_HEADERS
+        )
+    if isinstance(request, Record):
+        return fast_json_response(replayed)
+    return MessagesResponse(**replayed)
+
+# Request body parsing
+async def parse_request_body(raw_request: Request, model_class):
+    """Read, decode and validate a JSON body into ``model_class`` without keeping the raw bytes.
+
+    A FastAPI body parameter keeps the request bytes referenced until the response
+    has been sent (for a stream, the whole generation) next to the decoded strings.
+    Here the bytes are dropped as soon as they are decoded, and the model holds the
+    decoded strings by reference, so a large image exists once per request. Errors
+    are raised as RequestValidationError to keep FastAPI's 422 response shape.
+    """
+    chunks = [chunk async for chunk in raw_request.stream()]
+    body = chunks[0] if len(chunks) == 1 else b"".join(chunks)
+    del chunks
+    content_encoding = raw_request.headers.get("content-encoding")
+    if content_encoding:
+        body = decode_request_body(body, content_encoding)
+    if use_fast_path(raw_request):
+        return parse_trusted_body(body, model_class)
+    try:
+        # Decode first so the bytes can go before json.loads makes the per-string copies
+        text = body.decode("utf-8")
+        del body
+        data = json.loads(text)
+    except ValueError as e:
+        raise json_decode_error(e)
+    del text
+    try:
+        return model_class.model_validate(data)
+    except ValidationError as e:
+        raise RequestValidationError([{**error, "loc": ("body",) + tuple(error["loc"])} for error in e.errors()])
+
+def decode_request_body(body: bytes, content_encoding: str) -> bytes:
+    """Undo a compressed request's Content-Encoding, capped at REQUEST_MAX_DECOMPRESSED_MB."""
+    try:
+        return http_compression.decode_body(body, content_encoding, config.request_max_decompressed_mb * 1024 * 1024)
+    except UnsupportedEncoding as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except BodyTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+def json_decode_error(error: ValueError) -> RequestValidationError:
+    return RequestValidationError([{
+        "type": "json_invalid", "loc": ("body", getattr(error, "pos", 0)), "msg": "JSON decode error",
+        "input": {}, "ctx": {"error": getattr(error, "msg", str(error))}
+    }])
+
+# Fast path for trusted clients (FAST_PATH)
+def use_fast_path(raw_request: Request) -> bool:
+    """Whether this request skips model validation: FAST_PATH=all, or authenticated with FAST_PATH=authenticated."""
+    if config.fast_path == "all":
+        return True
+    return config.fast_path == "authenticated" and getattr(raw_request.state, "authenticated", False)
+
+def parse_trusted_body(body: bytes, model_class) -> Record:
+    """Decode a body into a Record for the fast path (structural checks only, see fast_request.py).
+
+    The Record carries the mapped model and original_model like the validated
+    models do, and the rest of the pipeline reads it the same way. A request
+    parsed here is answered with fast_json_response.
+    """
+    try:
+        request = fast_request.parse_request(body, messages_request=model_class is MessagesRequest)
+    except StructureError as e:
+        raise RequestValidationError([{**e.error, "loc": ("body",) + e.error["loc"]}])
+    except ValueError as e:
+        raise json_decode_error(e)
+    request.original_model = request.original_model or request.model
+    request.model, was_mapped = model_manager.validate_and_map_model(request.model)
+    if was_mapped:
+        logger.debug(f"📌 MODEL MAPPING: '{request.original_model}' ➡️ '{request.model}'")
+    return request
+
+def fast_json_response(content: Union[BaseModel, Dict[str, Any]]) -> Response:
+    """JSON response serialized in one pass, without FastAPI's jsonable_encoder walk over the model."""
+    if isinstance(content, BaseModel):
+        return Response(content.model_dump_json(), media_type="application/json")
+    return Response(sse_encoder.dumps(content), media_type="application/json")
+
+def debug_payload(value: Any, max_chars: int = 1024) -> Any:
+    """Copy of a request for DEBUG_REQUESTS logs with long strings (inline images) shortened."""
+    if isinstance(value, str):
+        return value if len(value) <= max_chars else f"{value[:64]}... <{len(value)} chars>"
+    if isinstance(value, dict):
+        return {key: debug_payload(item, max_chars) for key, item in value.items()}
+    if isinstance(value, list):
+        return [debug_payload(item, max_chars) for item in value]
+    return value
+
 # Enhanced streaming retry logic for the main endpoint
 @app.post("/v1/messages")
-async def create_message(request: MessagesRequest, raw_request: Request):
+async def create_message(raw_request: Request):
+    request = await parse_request_body(raw_request, MessagesRequest)
+    timer = tracing.current_timer()
+    if timer is not None:
+        timer.record("parse", timer.start)
+    flight_key = None
+    stream_leader = False
+    stream_permit = None
     try:
         logger.debug(f"📊 Processing request: Original={request.original_model}, Effective={request.model}, Stream={request.stream}")
 
@@ -1169,65 +2572,67 @@ async def create_message(request: MessagesRequest, raw_request: Request):
             logger.info("Streaming disabled via FORCE_DISABLE_STREAMING")
             request.stream = False
 
-        # Convert request
-        litellm_request = convert_anthropic_to_litellm(request)
-        
-        # 🔧 Set correct authentication for Gemini API
-        # Gemini API requires x-goog-api-key header, not Authorization Bearer
-        if litellm_request["model"].startswith("gemini/"):
-            # Remove the api_key parameter to avoid Authorization header
-            # and use extra_headers to set the correct Gemini auth header
-            litellm_request["extra_headers"] = {
-                "x-goog-api-key": config.gemini_api_key
-            }
-            # Remove api_key to prevent Authorization header
-            if "api_key" in litellm_request:
-                del litellm_request["api_key"]
-        else:
-            litellm_request["api_key"] = config.gemini_api_key
-        
+        # Convert request for the configured upstream engine
+        with tracing.phase("convert_request"):
+            if native_client is not None:
+                upstream_request = convert_anthropic_to_gemini(request)
+                upstream_message_count = len(upstream_request["contents"])
+            else:
+                # convert_anthropic_to_litellm also sets the x-goog-api-key header for Gemini models
+                upstream_request = convert_anthropic_to_litellm(request)
+                upstream_message_count = len(upstream_request["messages"])
         # 🔍 DEBUG: Print detailed request information (only if debug is enabled)
-        if config.debug_requests:
+        if config.debug_requests and native_client is not None:
+            logger.info("=" * 80)
+            logger.info("🚀 GEMINI NATIVE REQUEST DEBUG")
+            logger.info("=" * 80)
+            logger.info(f"📍 Target URL: {native_client.model_url(request.model, 'streamGenerateContent' if request.stream else 'generateContent')}")
+            logger.info(f"💬 Contents Count: {upstream_message_count}")
+            logger.info(f"🎛️ Generation Config: {upstream_request.get('generationConfig')}")
+            logger.info("📋 Complete Request Body:")
+            logger.info(json.dumps(debug_payload(upstream_request), indent=2, ensure_ascii=False))
+            logger.info("=" * 80)
+        elif config.debug_requests:
             logger.info("=" * 80)
             logger.info("🚀 GEMINI API REQUEST DEBUG")
             logger.info("=" * 80)
-            logger.info(f"📍 Target Model: {litellm_request.get('model')}")
+            logger.info(f"📍 Target Model: {upstream_request.get('model')}")
             logger.info(f"🌐 Base URL: {config.gemini_base_url or 'Default (Google)'}")
             
             # Show authentication method
-            if litellm_request.get("extra_headers") and "x-goog-api-key" in litellm_request.get("extra_headers", {}):
+            if upstream_request.get("extra_headers") and "x-goog-api-key" in upstream_request.get("extra_headers", {}):
                 logger.info(f"🔑 Auth Method: x-goog-api-key header (Gemini native)")
                 logger.info(f"🔑 API Key: {'*' * 20}...{config.gemini_api_key[-4:] if len(config.gemini_api_key) >= 4 else '****'}")
-            elif litellm_request.get("api_key"):
+            elif upstream_request.get("api_key"):
                 logger.info(f"🔑 Auth Method: Authorization Bearer (OpenAI-style)")
                 logger.info(f"🔑 API Key: {'*' * 20}...{config.gemini_api_key[-4:] if len(config.gemini_api_key) >= 4 else '****'}")
             
-            logger.info(f"💬 Messages Count: {len(litellm_request.get('messages', []))}")
-            logger.info(f"🎛️ Max Tokens: {litellm_request.get('max_tokens')}")
-            logger.info(f"🌡️ Temperature: {litellm_request.get('temperature')}")
-            logger.info(f"📡 Stream: {litellm_request.get('stream')}")
+            logger.info(f"💬 Messages Count: {len(upstream_request.get('messages', []))}")
+            logger.info(f"🎛️ Max Tokens: {upstream_request.get('max_tokens')}")
+            logger.info(f"🌡️ Temperature: {upstream_request.get('temperature')}")
+            logger.info(f"📡 Stream: {upstream_request.get('stream')}")
             
             if config.gemini_base_url:
-                logger.info(f"🔗 Custom Base URL in request: {litellm_request.get('base_url', 'Not set')}")
+                logger.info(f"🔗 Custom Base URL in request: {upstream_request.get('base_url', 'Not set')}")
                 
-            if litellm_request.get('tools'):
-                logger.info(f"🛠️ Tools: {len(litellm_request.get('tools', []))} tools configured")
-                for i, tool in enumerate(litellm_request.get('tools', [])):
+            if upstream_request.get('tools'):
+                logger.info(f"🛠️ Tools: {len(upstream_request.get('tools', []))} tools configured")
+                for i, tool in enumerate(upstream_request.get('tools', [])):
                     tool_name = tool.get('function', {}).get('name', 'Unknown')
                     logger.info(f"   Tool {i+1}: {tool_name}")
             
             # Print sanitized request for debugging (removing sensitive data)
-            debug_request = {k: v for k, v in litellm_request.items() if k not in ['api_key']}
+            debug_request = {k: v for k, v in upstream_request.items() if k not in ['api_key']}
             if 'extra_headers' in debug_request and 'x-goog-api-key' in debug_request['extra_headers']:
                 debug_request['extra_headers'] = {
                     **debug_request['extra_headers'],
                     'x-goog-api-key': f"{'*' * 15}...{config.gemini_api_key[-4:] if len(config.gemini_api_key) >= 4 else '****'}"
                 }
-            if litellm_request.get("api_key"):
+            if upstream_request.get("api_key"):
                 debug_request['api_key'] = f"{'*' * 15}...{config.gemini_api_key[-4:] if len(config.gemini_api_key) >= 4 else '****'}"
             
             logger.info("📋 Complete Request Parameters:")
-            logger.info(json.dumps(debug_request, indent=2, ensure_ascii=False))
+            logger.info(json.dumps(debug_payload(debug_request), indent=2, ensure_ascii=False))
             logger.info("=" * 80)
         
         # Log request details
@@ -1235,15 +2640,50 @@ async def create_message(request: MessagesRequest, raw_request: Request):
         log_request_beautifully(
             "POST", raw_request.url.path,
             request.original_model or request.model,
-            litellm_request.get('model'),
-            len(litellm_request['messages']),
+            request.model,
+            upstream_message_count,
             num_tools, 200
         )
 
+        # Serve repeatable requests from the response cache
+        response_key = None
+        if response_cache is not None and is_response_cacheable(request, raw_request):
+            response_key = response_cache_key(config.upstream_engine, request.model, upstream_request,
+                                              request.original_model or request.model)
+            with tracing.phase("response_cache"):
+                cached_response = await response_cache.get(response_key)
+            if cached_response is not None:
+                logger.debug(f"💾 Response cache hit: {response_key}")
+                return replay_cached_response(cached_response, request)
+
+        # Every request that may reach upstream earns retry budget for the whole process
+        if retry_budget is not None:
+            retry_budget.record_request()
+
+        # Share identical in-flight upstream calls (retry storms, duplicate agents)
+        if single_flight is not None:
+            flight_key = request_identity(request)
+
         # Enhanced streaming with better retry logic
         if request.stream:
+            if flight_key is not None:
+                broadcaster = await single_flight.join_stream(flight_key)
+                if broadcaster is not None:
+                    logger.debug("🔗 Joined identical in-flight stream")
+                    return StreamingResponse(
+                        broadcaster.subscribe(),
+                        media_type="text/event-stream",
+                        headers=STREAMING_HEADERS
+                    )
+                stream_leader = True
+            
+            # Held across retries and handed to the stream once it opens
+            route_request(request, upstream_request)
+            stream_permit = await admit(request)
+            
             streaming_retry_count = 0
             max_retries = config.max_streaming_retries
+            last_streaming_error = ""
             
             while streaming_retry_count <= max_retries:
                 try:
@@ -1251,27 +2691,47 @@ async def create_message(request: MessagesRequest, raw_request: Request):
                     
                     # Add slight delay between retries
                     if streaming_retry_count > 0:
+                        if not await retry_allowed("stream"):
+                            raise RetryBudgetExhausted("stream", last_streaming_error)
                         delay = min(0.5 * (2 ** streaming_retry_count), 2.0)  # Exponential backoff, max 2s
                         logger.debug(f"Waiting {delay}s before retry...")
                         await asyncio.sleep(delay)
                     
-                    response_generator = await litellm.acompletion(**litellm_request)
+                    # Retries move to a fallback model once the circuit for this one opens
+                    if streaming_retry_count > 0:
+                        route_request(request, upstream_request)
+                    
+                    # Every attempt is a separate upstream call against the model's quota
+                    reservation = await reserve_rate_budget(request)
+                    with tracing.phase("upstream_connect"):
+                        response_generator, cache_creation_tokens = await open_hedged_stream(request, upstream_request)
+                    on_complete = stream_completion_hook(response_key, reservation)
+                    capture = start_stream_capture(request, cache_creation_tokens)
+                    if capture is not None:
+                        response_generator = capture.upstream(response_generator)
+                    
+                    sse_stream = handle_streaming_with_recovery(response_generator, request, cache_creation_tokens,
+                                                                on_complete, timer)
+                    if capture is not None:
+                        sse_stream = capture.downstream(sse_stream)
+                    if stream_permit is not None:
+                        sse_stream, stream_permit = stream_permit.hold(sse_stream), None
+                    if stream_leader:
+                        sse_stream = single_flight.publish_stream(flight_key, sse_stream).subscribe()
                     
                     return StreamingResponse(
-                        handle_streaming_with_recovery(response_generator, request),
+                        sse_stream,
                         media_type="text/event-stream",
-                        headers={
-                            "Cache-Control": "no-cache",
-                            "Connection": "keep-alive",
-                            "X-Accel-Buffering": "no",
-                            "Access-Control-Allow-Origin": "*",
-                            "Access-Control-Allow-Headers": "*"
-                        }
+                        headers=STREAMING_HEADERS
                     )
                     
+                except (RateLimitExceeded, CircuitOpenError, RetryBudgetExhausted):
+                    raise
+                    
                 except (litellm.exceptions.APIConnectionError, RuntimeError) as streaming_error:
                     streaming_retry_count += 1
                     error_msg = str(streaming_error)
+                    last_streaming_error = error_msg
                     
                     # Check for the specific malformed chunk error
                     if ("Error parsing chunk" in error_msg and 
@@ -1294,6 +2754,7 @@ async def create_message(request: MessagesRequest, raw_request: Request):
                             
                 except Exception as unexpected_error:
                     streaming_retry_count += 1
+                    last_streaming_error = str(unexpected_error)
                     logger.error(f"Unexpected streaming error (attempt {streaming_retry_count}/{max_retries + 1}): {unexpected_error}")
                     
                     if streaming_retry_count <= max_retries:
@@ -1303,17 +2764,62 @@ async def create_message(request: MessagesRequest, raw_request: Request):
                         break
             
             # If we get here, streaming failed - fall back to non-streaming
+            if not await retry_allowed("fallback"):
+                raise RetryBudgetExhausted("fallback", last_streaming_error)
             logger.info("Falling back to non-streaming mode")
-            litellm_request["stream"] = False
+            metric_stream_fallbacks.inc(request.model)
+            if stream_leader:
+                single_flight.abandon_stream(flight_key)
+            if stream_permit is not None:
+                stream_permit.release()
+                stream_permit = None
+            if native_client is None:
+                upstream_request["stream"] = False
         
         # Non-streaming path (or fallback)
-        if not request.stream or litellm_request.get("stream") == False:
-            start_time = time.time()
-            litellm_response = await litellm.acompletion(**litellm_request)
-            logger.debug(f"✅ Response received: Model={litellm_request.get('model')}, Time={time.time() - start_time:.2f}s")
-            
-            anthropic_response = convert_litellm_to_anthropic(litellm_response, request)
-            return anthropic_response
+        if flight_key is not None:
+            response = await single_flight.run(
+                flight_key, lambda: complete_admitted(request, upstream_request, response_key)
+            )
+        else:
+            response = await complete_admitted(request, upstream_request, response_key)
+        return fast_json_response(response) if isinstance(request, Record) else response
+
+    except AdmissionRejected as e:
+        logger.warning(f"🚦 Request rejected by admission control: {e}")
+        return local_limit_response(
+            "overloaded_error",
+            f"Upstream model {e.model} is overloaded ({e.reason}). Please retry shortly.",
+            e.retry_after
+        )
+    except CircuitOpenError as e:
+        logger.warning(f"🔴 Request rejected, circuit open: {e}")
+        return local_limit_response(
+            "overloaded_error",
+            f"Upstream model {e.model} is temporarily unavailable after repeated overload errors. Please retry shortly.",
+            e.retry_after
+        )
+    except RetryBudgetExhausted as e:
+        logger.error(f"🛑 {e}")
+        detail = classify_gemini_error(e.last_error) if e.last_error else "Upstream is failing"
+        return local_limit_response(
+            "overloaded_error",
+            f"{detail} (retry budget exhausted, not retrying)",
+            config.retry_budget_window / 10,
+            status_code=503
+        )
+    except RateLimitExceeded as e:
+        logger.warning(f"⏳ Request rejected by local rate limit: {e}")
+        return local_limit_response(
+            "rate_limit_error",
+            f"Requests-per-minute / tokens-per-minute budget for {e.model} is exhausted. Please retry shortly.",
+            e.retry_after
+        )
+
+    except GeminiAPIError as e:
+        logger.error(f"Gemini API Error: {e}")
+        error_msg = classify_gemini_error(e.message)
+        raise HTTPException(status_code=e.status_code, detail=error_msg)
 
     except litellm.exceptions.APIError as e:
         logger.error(f"LiteLLM API Error: {e}")
@@ -1329,36 +2835,87 @@ async def create_message(request: MessagesRequest, raw_request: Request):
         logger.error(f"Error processing request: {e}")
         error_msg = classify_gemini_error(str(e))
         raise HTTPException(status_code=500, detail=error_msg)
+    finally:
+        # Mapped model (after any failover) for the request metrics
+        raw_request.state.model = request.model
+        # Never leave stream waiters hanging on a leader that gave up or was cancelled
+        if stream_leader:
+            single_flight.abandon_stream(flight_key)
+        if stream_permit is not None:
+            stream_permit.release()
+
+# Token counting
+async def count_tokens_estimate(request: Union[TokenCountRequest, MessagesRequest]) -> int:
+    """Local tokenizer estimate; only messages not seen before are converted and tokenized."""
+    items = []
+    system_text = extract_system_text(request.system)
+    if system_text:
+        system_message = [{"role": Constants.ROLE_SYSTEM, "content": system_text}]
+        items.append((("system", system_text), lambda: system_message))
+    for msg in request.messages:
+        items.append((message_cache_key(msg), lambda msg=msg: convert_message_to_litellm(msg)))
+
+    tools_item = None
+    if request.tools:
+        tools_key = ("tools", tools_cache_key(request.tools))
+        tools_item = (tools_key, lambda: convert_tools(request.tools, "litellm"))
+
+    return await token_counter.count(request.model, items, tools_item)
+
+async def count_tokens_exact(request: TokenCountRequest) -> int:
+    """Gemini countTokens for the whole request, cached by request content."""
+    fields = dict(
+        model=request.model,
+        max_tokens=1,
+        messages=request.messages,
+        system=request.system,
+        tools=request.tools,
+        tool_choice=request.tool_choice,
+    )
+    if isinstance(request, Record):
+        # A fast-path request stays a Record; the converters only read attributes
+        temp_request = fast_request.request_record(fast_request.MESSAGES_REQUEST_DEFAULTS, **fields)
+    else:
+        temp_request = MessagesRequest(**fields)
+    request_key = (
+        extract_system_text(request.system),
+        fingerprint([[tool.name, tool.description, tool.input_schema] for tool in request.tools]) if request.tools else None,
+        tuple(message_cache_key(msg) for msg in request.messages),
+    )
+
+    async def fetch() -> int:
+        gemini_request = convert_anthropic_to_gemini(temp_request)
+        gemini_request.pop("generationConfig", None)
+        return await run_with_api_key(
+            lambda api_key: token_count_client.count_tokens(request.model, gemini_request, api_key=api_key)
+        )
+
+    return await token_counter.count_exact(request.model, request_key, fetch, lambda: count_tokens_estimate(request))
 
 @app.post("/v1/messages/count_tokens")
-async def count_tokens(request: TokenCountRequest, raw_request: Request):
+async def count_tokens(raw_request: Request):
+    request = await parse_request_body(raw_request, TokenCountRequest)
+    timer = tracing.current_timer()
+    if timer is not None:
+        timer.record("parse", timer.start)
+    raw_request.state.model = request.model
     try:
-        # Create temporary request for conversion
-        temp_request = MessagesRequest(
-            model=request.model,
-            max_tokens=1,
-            messages=request.messages,
-            system=request.system,
-            tools=request.tools,
-        )
-        
-        litellm_data = convert_anthropic_to_litellm(temp_request)
-        
         # Log request
         num_tools = len(request.tools) if request.tools else 0
         log_request_beautifully(
             "POST", raw_request.url.path,
             request.original_model or request.model,
-            litellm_data.get('model'),
-            len(litellm_data['messages']), num_tools, 200
+            request.model,
+            len(request.messages), num_tools, 200
         )
 
-        # Count tokens
-        token_count = litellm.token_counter(
-            model=litellm_data["model"],
-            messages=litellm_data["messages"],
-        )
+        if token_count_client is not None:
+            token_count = await count_tokens_exact(request)
+        else:
+            token_count = await count_tokens_estimate(request)
         
+        if isinstance(request, Record):
+            return fast_json_response({"input_tokens": token_count})
         return TokenCountResponse(input_tokens=token_count)
 
     except Exception as e:
@@ -1377,12 +2934,49 @@ async def health_check():
             "gemini_base_url_configured": bool(config.gemini_base_url),
             "gemini_base_url": config.gemini_base_url or "default",
             "auth_token_configured": bool(config.auth_token),
+            "fast_path": config.fast_path,
+            "compression": {
+                "request_encodings": list(http_compression.request_encodings()),
+                "responses": response_compressor.stats() if response_compressor is not None else {"enabled": False},
+                "upstream_requests": (native_client or token_count_client).compression_stats()
+                                     if (native_client or token_count_client) is not None else {"enabled": False}
+            },
             "api_key_valid": config.validate_api_key(),
+            "upstream_engine": config.upstream_engine,
+            "workers": {
+                "count": config.workers,
+                "mode": config.worker_mode if config.workers > 1 else "single",
+                "worker_id": config.worker_id,
+                "pid": os.getpid()
+            },
+            "shared_state": shared_state.stats() if shared_state is not None else {"enabled": False},
             "streaming_config": {
                 "force_disabled": config.force_disable_streaming,
                 "emergency_disabled": config.emergency_disable_streaming,
-                "max_retries": config.max_streaming_retries
-            }
+                "max_retries": config.max_streaming_retries,
+                "coalesce_window_ms": config.stream_coalesce_window_ms,
+                "coalesce_max_chars": config.stream_coalesce_max_chars
+            },
+            "caches": {
+                "tool_schema": tool_schema_cache.stats(),
+                "conversation": conversation_cache.stats(),
+                "gemini_context": context_cache.stats() if context_cache is not None else {"enabled": False},
+                "image_uploads": image_store.stats() if image_store is not None else {"enabled": False},
+                "token_count": token_counter.stats(),
+                "response": response_cache.stats() if response_cache is not None else {"enabled": False}
+            },
+            "single_flight": single_flight.stats() if single_flight is not None else {"enabled": False},
+            "api_keys": key_pool.stats(),
+            "admission": admission_controller.stats() if admission_controller is not None else {"enabled": False},
+            "rate_limits": rate_limiter.stats() if rate_limiter is not None else {"enabled": False},
+            "hedging": hedger.stats() if hedger is not None else {"enabled": False},
+            "circuit_breakers": circuit_breakers.stats() if circuit_breakers is not None else {"enabled": False},
+            "retry_budget": retry_budget.stats() if retry_budget is not None else {"enabled": False},
+            "model_failover": model_manager.failover_chains,
+            "tracing": span_exporter.stats() if span_exporter is not None else {"enabled": False},
+            "stream_capture": stream_capturer.stats() if stream_capturer is not None else {"enabled": False},
+            "stream_replay": stream_replayer.stats() if stream_replayer is not None else {"enabled": False},
+            "token_count_mode": config.token_count_mode
         }
         
         return health_status
@@ -1398,6 +2992,23 @@ async def health_check():
             }
         )
 
+@app.get("/traces")
+async def traces():
+    """Recent request spans (OTLP/JSON shape) held by TRACE_EXPORTER=memory."""
+    return {"exporter": config.trace_exporter, "spans": span_exporter.get_spans() if span_exporter is not None else []}
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text exposition of the in-process metrics (summed over worker processes)."""
+    if shared_state is not None and config.worker_id is not None:
+        await publish_metrics()
+        try:
+            others = shared_state.metric_snapshots(exclude_worker=config.worker_id)
+            return Response(content=metrics_registry.render(others), media_type=MetricsRegistry.CONTENT_TYPE)
+        except SharedStateUnavailable as e:
+            logger.warning(f"Reading worker metrics failed, serving this worker's only: {e}")
+    return Response(content=metrics_registry.render(), media_type=MetricsRegistry.CONTENT_TYPE)
+
 @app.get("/")
 async def root():
     return {
@@ -1412,6 +3023,7 @@ async def root():
             "gemini_base_url_configured": bool(config.gemini_base_url),
             "gemini_base_url": config.gemini_base_url or "default",
             "auth_token_configured": bool(config.auth_token),
+            "upstream_engine": config.upstream_engine,
             "streaming": {
                 "force_disabled": config.force_disable_streaming,
                 "emergency_disabled": config.emergency_disable_streaming,
@@ -1421,7 +3033,9 @@ async def root():
         "endpoints": {
             "messages": "/v1/messages",
             "count_tokens": "/v1/messages/count_tokens", 
-            "health": "/health"
+            "health": "/health",
+            "metrics": "/metrics",
+            "traces": "/traces"
         },
         "authentication": {
             "required": bool(config.auth_token),
@@ -1503,6 +3117,11 @@ def validate_startup():
     return True
 
 def main():
+    if config.worker_id is not None:
+        # Started by the WORKERS supervisor: serve on the shared or SO_REUSEPORT socket
+        workers.serve_worker(app, config.host, config.port, config.log_level.lower())
+        return
+
     if len(sys.argv) > 1 and sys.argv[1] == "--help":
         print("Enhanced Gemini-to-Claude API Proxy v2.5.0")
         print("")
@@ -1513,6 +3132,7 @@ def main():
         print("")
         print("Optional environment variables:")
         print("  AUTH_TOKEN - Your API key for x-api-key header authentication (optional)")
+        print("  FAST_PATH - Skip request model validation for trusted clients: off, authenticated or all (default: off)")
         print("  GEMINI_BASE_URL - Custom Gemini API base URL (optional)")
         print(f"  BIG_MODEL - Big model name (default: gemini/gemini-2.5-pro)")
         print(f"  SMALL_MODEL - Small model name (default: gemini/gemini-2.5-pro)")
@@ -1525,6 +3145,76 @@ def main():
         print(f"  MAX_STREAMING_RETRIES - Maximum streaming retries (default: 2)")
         print(f"  FORCE_DISABLE_STREAMING - Force disable streaming (default: false)")
         print(f"  EMERGENCY_DISABLE_STREAMING - Emergency disable streaming (default: false)")
+        print(f"  STREAM_COALESCE_WINDOW_MS - Merge streamed deltas for up to N ms, 0 disables (default: 0)")
+        print(f"  STREAM_COALESCE_MAX_CHARS - Flush merged deltas at this size (default: 512)")
+        print(f"  TOOL_SCHEMA_CACHE_SIZE - Cached translated tool sets, 0 disables (default: 64)")
+        print(f"  CONVERSATION_CACHE_SIZE - Cached converted messages, 0 disables (default: 20000)")
+        print(f"  CONVERSATION_CACHE_MAX_MB - Memory cap for cached converted messages (default: 128)")
+        print(f"  WORKERS - Worker processes, each with its own event loop (default: 1)")
+        print(f"  WORKER_MODE - reuseport (SO_REUSEPORT, Linux) or prefork (shared socket) (default: {workers.default_mode()})")
+        print(f"  SHARED_STATE_DIR - SQLite state shared by the workers (default: <tmp>/gemini-proxy-<PORT>)")
+        print(f"  SHARED_STATE_BUSY_TIMEOUT_MS - Wait for a locked shared database before using per-worker state (default: 50)")
+        print(f"  UPSTREAM_ENGINE - Upstream engine: litellm, native or replay (default: litellm)")
+        print(f"  UPSTREAM_HTTP2 - Use HTTP/2 for the native engine, needs 'h2' (default: false)")
+        print(f"  UPSTREAM_MAX_CONNECTIONS - Native engine connection pool size (default: 100)")
+        print(f"  UPSTREAM_MAX_KEEPALIVE - Native engine idle keep-alive connections (default: 20)")
+        print(f"  UPSTREAM_KEEPALIVE_EXPIRY - Native engine keep-alive expiry in seconds (default: 30)")
+        print(f"  UPSTREAM_REQUEST_COMPRESSION - gzip large native engine request bodies (default: false)")
+        print(f"  UPSTREAM_COMPRESSION_MIN_BYTES - Smallest request body to gzip upstream (default: 16384)")
+        print(f"  REQUEST_MAX_DECOMPRESSED_MB - Size cap for decoded gzip/deflate/zstd request bodies (default: 64)")
+        print(f"  RESPONSE_COMPRESSION - zstd/gzip for non-streaming responses per Accept-Encoding (default: false)")
+        print(f"  RESPONSE_COMPRESSION_MIN_BYTES - Smallest response body to compress (default: 1024)")
+        print(f"  GEMINI_CONTEXT_CACHE - Map cache_control breakpoints to Gemini context caches, native engine only (default: false)")
+        print(f"  GEMINI_CONTEXT_CACHE_TTL - Context cache TTL in seconds (default: 300)")
+        print(f"  GEMINI_CONTEXT_CACHE_MIN_TOKENS - Skip prefixes smaller than this estimate (default: 1024)")
+        print(f"  IMAGE_UPLOAD_CACHE - Upload history images once via the Gemini Files API (default: false)")
+        print(f"  IMAGE_UPLOAD_MIN_KB - Smaller images stay inline (default: 32)")
+        print(f"  IMAGE_UPLOAD_TTL - Seconds an uploaded file is reused, capped by Gemini's expiry (default: 172800)")
+        print(f"  IMAGE_UPLOAD_CACHE_SIZE - Uploaded files tracked (default: 1024)")
+        print(f"  TOKEN_COUNT_MODE - count_tokens mode: estimate or exact (Gemini countTokens) (default: estimate)")
+        print(f"  TOKEN_COUNT_CACHE_SIZE - Cached per-message token counts, 0 disables (default: 50000)")
+        print(f"  TOKEN_COUNT_WORKERS - Threads used for tokenization (default: 4)")
+        print(f"  RESPONSE_CACHE - Response cache: off, deterministic or all (default: off)")
+        print(f"  RESPONSE_CACHE_SIZE - In-memory cached responses (default: 1000)")
+        print(f"  RESPONSE_CACHE_TTL - Cached response lifetime in seconds (default: 3600)")
+        print(f"  RESPONSE_CACHE_DISK_PATH - SQLite file for the on-disk tier (default: unset, memory only)")
+        print(f"  RESPONSE_CACHE_DISK_MAX_MB - Size cap for the on-disk tier (default: 512)")
+        print(f"  SINGLE_FLIGHT - Share one upstream call between identical concurrent requests (default: false)")
+        print(f"  GEMINI_API_KEYS - Comma-separated API key pool, used together with GEMINI_API_KEY")
+        print(f"  GEMINI_API_KEY_WEIGHTS - Comma-separated key weights, same order as the pool (default: all 1)")
+        print(f"  KEY_POOL_STRATEGY - Key selection: least_load or weighted_round_robin (default: least_load)")
+        print(f"  KEY_COOLDOWN_SECONDS - Base cooldown after a 429 without Retry-After (default: 30)")
+        print(f"  KEY_MAX_COOLDOWN_SECONDS - Cap for the exponential cooldown (default: 300)")
+        print(f"  ADMISSION_CONTROL - Per-model concurrency caps with a priority wait queue (default: false)")
+        print(f"  BIG_MODEL_MAX_CONCURRENCY - Concurrent upstream calls to BIG_MODEL (default: 16)")
+        print(f"  SMALL_MODEL_MAX_CONCURRENCY - Concurrent upstream calls to SMALL_MODEL (default: 32)")
+        print(f"  OTHER_MODEL_MAX_CONCURRENCY - Concurrent upstream calls to all other models together (default: 16)")
+        print(f"  ADMISSION_MAX_QUEUE - Waiting requests per model before fast 429s (default: 64)")
+        print(f"  ADMISSION_QUEUE_TIMEOUT - Longest queue wait in seconds (default: 30)")
+        print(f"  BIG_MODEL_RPM / BIG_MODEL_TPM - Local requests / tokens per minute budget for BIG_MODEL, 0 disables (default: 0)")
+        print(f"  SMALL_MODEL_RPM / SMALL_MODEL_TPM - Local requests / tokens per minute budget for SMALL_MODEL (default: 0)")
+        print(f"  OTHER_MODEL_RPM / OTHER_MODEL_TPM - Local requests / tokens per minute budget for other models (default: 0)")
+        print(f"  RATE_LIMIT_MAX_WAIT - Longest local pacing delay before a fast 429, in seconds (default: 30)")
+        print(f"  HEDGING - Send a backup request when the first is slower than the latency percentile (default: false)")
+        print(f"  HEDGE_PERCENTILE - Latency percentile (time to first chunk for streams) that triggers a hedge (default: 90)")
+        print(f"  HEDGE_MIN_DELAY_MS - Never hedge earlier than this (default: 300)")
+        print(f"  HEDGE_MAX_RATE - Maximum hedges as a fraction of recent requests (default: 0.1)")
+        print(f"  CIRCUIT_BREAKER - Stop sending to a model after repeated overload errors (default: false)")
+        print(f"  CIRCUIT_FAILURE_THRESHOLD - Consecutive 429/5xx/timeout errors that open a circuit (default: 5)")
+        print(f"  CIRCUIT_OPEN_SECONDS - How long an open circuit skips its model before probing (default: 30)")
+        print(f"  MODEL_FAILOVER - Failover chains, e.g. gemini-2.5-pro>gemini-2.5-flash (default: none)")
+        print(f"  RETRY_BUDGET - Share one retry budget across all retry layers (default: false)")
+        print(f"  RETRY_BUDGET_RATIO - Retries allowed per request in the window (default: 0.2)")
+        print(f"  RETRY_BUDGET_WINDOW - Sliding window in seconds (default: 60)")
+        print(f"  RETRY_BUDGET_MIN_RETRIES - Retries always allowed per window (default: 10)")
+        print(f"  SERVER_TIMING - Per-phase timings in a Server-Timing header and message_start metadata (default: true)")
+        print(f"  TRACE_EXPORTER - Request span export: off, memory (GET /traces), file or otel (default: off)")
+        print(f"  TRACE_FILE - JSON-lines file for TRACE_EXPORTER=file (default: traces.jsonl)")
+        print(f"  TRACE_MEMORY_SPANS - Spans kept by TRACE_EXPORTER=memory (default: 1000)")
+        print(f"  STREAM_CAPTURE_DIR - Record upstream streams and SSE output here (default: unset, off)")
+        print(f"  STREAM_CAPTURE_SAMPLE_RATE - Fraction of streams to record (default: 1)")
+        print(f"  STREAM_REPLAY_DIR - Recordings served by UPSTREAM_ENGINE=replay")
+        print(f"  STREAM_REPLAY_SPEED - Replay speed, 1 = recorded timing, 0 = as fast as possible (default: 1)")
         print("")
         print("Debug options:")
         print("  DEBUG_REQUESTS - Enable detailed request/response logging (default: false)")
@@ -1562,8 +3252,12 @@ def main():
     print(f"   Max Streaming Retries: {config.max_streaming_retries}")
     print(f"   Force Disable Streaming: {config.force_disable_streaming}")
     print(f"   Emergency Disable Streaming: {config.emergency_disable_streaming}")
+    print(f"   Stream Coalescing: {config.stream_coalesce_window_ms}ms / {config.stream_coalesce_max_chars} chars")
+    print(f"   Upstream Engine: {config.upstream_engine}")
     print(f"   Log Level: {config.log_level}")
     print(f"   Server: {config.host}:{config.port}")
+    if config.workers > 1:
+        print(f"   Workers: {config.workers} ({config.worker_mode})")
     auth_note = "Required (x-api-key header)" if config.auth_token else "Disabled"
     print(f"   Authentication: {auth_note}")
     debug_status = "Enabled" if config.debug_requests else "Disabled"
@@ -1573,6 +3267,15 @@ def main():
     print("")
 
     # Start server
+    if config.workers > 1:
+        # Metrics of a previous run would otherwise be summed into this one
+        if shared_state is not None:
+            try:
+                shared_state.clear_metrics()
+            except SharedStateUnavailable as e:
+                print(f"⚠️ Could not clear worker metrics of a previous run: {e}")
+        command = [sys.executable, os.path.abspath(__file__)]
+        sys.exit(workers.WorkerSupervisor(command, config.workers, config.worker_mode, config.host, config.port).run())
     uvicorn.run(
         app, 
         host=config.host, 
@@ -0,0 +1,272 @@
+"""State shared by the worker processes of a multi-worker proxy (WORKERS > 1).
+
+Each worker is a separate process with its own event loop, so anything that
+has to hold across the whole proxy lives in one SQLite database in WAL mode on
+local disk: rate-limit token buckets, API key cooldowns and reported quota,
+sliding-window counters (retry budget) and per-worker metric snapshots.
+Every operation is a single statement or one short ``BEGIN IMMEDIATE``
+transaction on a local file. Writes can wait on another worker's lock, so
+callers on the event loop send them to a single background thread
+(``run`` / ``submit``, as the response cache does with its SQLite tier);
+plain reads never wait in WAL mode and stay inline. The busy timeout is kept
+short so a locked or broken database cannot hold that thread up for long:
+operations then raise ``SharedStateUnavailable`` and callers fall back to
+their per-process state.
+
+Times are stored as wall-clock seconds (``time.time()``), the only clock all
+processes agree on.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Width of one sliding-window counter slot (seconds)
+WINDOW_SLOT_SECONDS = 1.0
+
+# Drop counter slots older than this many seconds on the next write
+WINDOW_RETENTION_SECONDS = 3600
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS api_keys (key_id TEXT PRIMARY KEY, cooldown_until REAL NOT NULL DEFAULT 0, "
+    "consecutive_rate_limits INTEGER NOT NULL DEFAULT 0, remaining_requests INTEGER, remaining_tokens INTEGER)",
+    "CREATE TABLE IF NOT EXISTS windows (name TEXT NOT NULL, slot INTEGER NOT NULL, count REAL NOT NULL, "
+    "PRIMARY KEY (name, slot))",
+    "CREATE TABLE IF NOT EXISTS metrics (worker TEXT PRIMARY KEY, updated REAL NOT NULL, snapshot TEXT NOT NULL)",
+)
+
+
+class SharedStateUnavailable(Exception):
+    """The shared database is locked past the busy timeout or otherwise unusable."""
+
+
+class SharedState:
+    """SQLite (WAL) store for cross-process limits and counters (blocking, thread-safe)."""
+
+    def __init__(self, path: str, busy_timeout: float = 0.05):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._lock = threading.RLock()
+        self._last_prune = 0.0
+        self.transactions = 0
+        self.errors = 0
+        self.degraded = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-state")
+        try:
+            # Autocommit: single statements are atomic, multi-statement updates use transaction()
+            self._db = sqlite3.connect(path, timeout=busy_timeout, isolation_level=None, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        except sqlite3.Error as e:
+            raise SharedStateUnavailable(f"Cannot open shared state {path}: {e}") from e
+        with self.transaction():
+            for statement in _SCHEMA:
+                self._db.execute(statement)
+
+    def _unavailable(self, error: sqlite3.Error) -> SharedStateUnavailable:
+        self.errors += 1
+        if not self.degraded:
+            self.degraded = True
+            logger.warning(f"Shared state unavailable, using per-process state: {error}")
+        return SharedStateUnavailable(str(error))
+
+    def _available(self):
+        if self.degraded:
+            self.degraded = False
+            logger.info("Shared state available again")
+
+    async def run(self, fn: Callable, *args) -> Any:
+        """Await ``fn(*args)`` on the background thread, off the event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    def submit(self, fn: Callable, *args):
+        """Run ``fn(*args)`` on the background thread without waiting for it."""
+        self._executor.submit(fn, *args).add_done_callback(self._log_failure)
+
+    @staticmethod
+    def _log_failure(future: Future):
+        error = future.exception()
+        # SharedStateUnavailable is counted and logged where it is raised
+        if error is not None and not isinstance(error, SharedStateUnavailable):
+            logger.warning(f"Shared state update failed: {error}")
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Exclusive write transaction, for read-modify-write updates across processes."""
+        with self._lock:
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+            except sqlite3.Error as e:
+                raise self._unavailable(e) from e
+            try:
+                yield self._db
+                self._db.execute("COMMIT")
+            except BaseException as e:
+                if self._db.in_transaction:
+                    try:
+                        self._db.execute("ROLLBACK")
+                    except sqlite3.Error:
+                        pass
+                if isinstance(e, sqlite3.Error):
+                    raise self._unavailable(e) from e
+                raise
+            self.transactions += 1
+            self._available()
+
+    def _query(self, sql: str, params: Sequence[Any] = ()) -> List[Tuple]:
+        with self._lock:
+            try:
+                rows = self._db.execute(sql, params).fetchall()
+            except sqlite3.Error as e:
+                raise self._unavailable(e) from e
+            # Readers are never blocked in WAL mode, so only a write shows the lock is gone
+            if not self._db.in_transaction and not sql.startswith("SELECT"):
+                self._available()
+            return rows
+
+    # Token buckets (refilled continuously at rate units per second, starting full)
+    @staticmethod
+    def _bucket_level(db: sqlite3.Connection, name: str, capacity: float, rate: float, now: float) -> float:
+        row = db.execute("SELECT level, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+        if row is None:
+            return capacity
+        return min(capacity, row[0] + (now - row[1]) * rate)
+
+    def take_buckets(self, asks: Sequence[Tuple[str, float, float, float]], max_wait: float) -> float:
+        """Take ``amount`` from every ``(name, capacity, rate, amount)`` bucket if the wait fits ``max_wait``.
+
+        Returns the wait until the taken amounts are covered; the buckets are left
+        in debt for that long, which later callers see as a longer wait. Nothing is
+        taken when the wait is over ``max_wait``. Larger-than-capacity asks need a
+        full bucket, as with the in-process TokenBucket.
+        """
+        now = time.time()
+        with self.transaction() as db:
+            levels = [self._bucket_level(db, name, capacity, rate, now) for name, capacity, rate, _ in asks]
+            wait = 0.0
+            for (_, capacity, rate, amount), level in zip(asks, levels):
+                needed = min(amount, capacity)
+                if level < needed:
+                    wait = max(wait, (needed - level) / rate)
+            if wait <= max_wait:
+                for (name, _, _, amount), level in zip(asks, levels):
+                    db.execute("INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                               (name, level - amount, now))
+        return wait
+
+    def adjust_bucket(self, name: str, capacity: float, rate: float, amount: float):
+        """Give back (positive) or charge (negative) ``amount`` after the fact."""
+        now = time.time()
+        with self.transaction() as db:
+            level = min(capacity, self._bucket_level(db, name, capacity, rate, now) + amount)
+            db.execute("INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)", (name, level, now))
+
+    def bucket_level(self, name: str, capacity: float, rate: float) -> float:
+        with self._lock:
+            try:
+                return self._bucket_level(self._db, name, capacity, rate, time.time())
+            except sqlite3.Error as e:
+                raise self._unavailable(e) from e
+
+    # API key scheduling state
+    def key_states(self) -> Dict[str, Tuple[float, int, Optional[int], Optional[int]]]:
+        """key_id -> (cooldown_until, consecutive_rate_limits, remaining_requests, remaining_tokens)."""
+        rows = self._query("SELECT key_id, cooldown_until, consecutive_rate_limits, remaining_requests, "
+                           "remaining_tokens FROM api_keys")
+        return {row[0]: row[1:] for row in rows}
+
+    def record_key_rate_limit(self, key_id: str, cooldown_seconds: Optional[float],
+                              backoff_base: float, backoff_max: float) -> Tuple[float, int]:
+        """Count a 429 for a key and extend its cooldown; returns (cooldown seconds, consecutive 429s).
+
+        Without a server-given ``cooldown_seconds`` the backoff doubles with the
+        consecutive 429s seen by all workers.
+        """
+        now = time.time()
+        with self.transaction() as db:
+            row = db.execute("SELECT cooldown_until, consecutive_rate_limits FROM api_keys WHERE key_id = ?",
+                             (key_id,)).fetchone()
+            cooldown_until, consecutive = row if row is not None else (0.0, 0)
+            consecutive += 1
+            if cooldown_seconds is None:
+                cooldown_seconds = min(backoff_base * 2 ** (consecutive - 1), backoff_max)
+            db.execute(
+                "INSERT INTO api_keys (key_id, cooldown_until, consecutive_rate_limits) VALUES (?, ?, ?) "
+                "ON CONFLICT (key_id) DO UPDATE SET cooldown_until = excluded.cooldown_until, "
+                "consecutive_rate_limits = excluded.consecutive_rate_limits",
+                (key_id, max(cooldown_until, now + cooldown_seconds), consecutive),
+            )
+        return cooldown_seconds, consecutive
+
+    def reset_key_rate_limits(self, key_id: str):
+        self._query("UPDATE api_keys SET consecutive_rate_limits = 0 WHERE key_id = ? AND consecutive_rate_limits > 0",
+                    (key_id,))
+
+    def set_key_quota(self, key_id: str, remaining_requests: Optional[int], remaining_tokens: Optional[int]):
+        self._query(
+            "INSERT INTO api_keys (key_id, remaining_requests, remaining_tokens) VALUES (?, ?, ?) "
+            "ON CONFLICT (key_id) DO UPDATE SET remaining_requests = excluded.remaining_requests, "
+            "remaining_tokens = excluded.remaining_tokens",
+            (key_id, remaining_requests, remaining_tokens),
+        )
+
+    # Sliding-window counters, kept in WINDOW_SLOT_SECONDS slots
+    def add_to_window(self, name: str, amount: float = 1):
+        now = time.time()
+        with self._lock:
+            self._query(
+                "INSERT INTO windows (name, slot, count) VALUES (?, ?, ?) "
+                "ON CONFLICT (name, slot) DO UPDATE SET count = count + excluded.count",
+                (name, int(now // WINDOW_SLOT_SECONDS), amount),
+            )
+            if now - self._last_prune >= 60:
+                self._last_prune = now
+                self._query("DELETE FROM windows WHERE slot < ?",
+                            (int((now - WINDOW_RETENTION_SECONDS) // WINDOW_SLOT_SECONDS),))
+
+    def window_totals(self, names: Sequence[str], window_seconds: float) -> List[float]:
+        """Sum of each counter over the last ``window_seconds`` (to slot granularity)."""
+        first_slot = int((time.time() - window_seconds) // WINDOW_SLOT_SECONDS) + 1
+        rows = dict(self._query(
+            f"SELECT name, SUM(count) FROM windows WHERE slot >= ? AND name IN ({','.join('?' * len(names))}) "
+            "GROUP BY name", (first_slot, *names)))
+        return [rows.get(name) or 0 for name in names]
+
+    # Metric snapshots, one row per worker
+    def publish_metrics(self, worker: str, snapshot: Dict[str, Any]):
+        self._query("INSERT OR REPLACE INTO metrics (worker, updated, snapshot) VALUES (?, ?, ?)",
+                    (worker, time.time(), json.dumps(snapshot)))
+
+    def metric_snapshots(self, exclude_worker: Optional[str] = None) -> List[Dict[str, Any]]:
+        rows = self._query("SELECT worker, snapshot FROM metrics")
+        return [json.loads(snapshot) for worker, snapshot in rows if worker != exclude_worker]
+
+    def clear_metrics(self):
+        self._query("DELETE FROM metrics")
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            self._db.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": True,
+            "path": self.path,
+            "busy_timeout_ms": round(self.busy_timeout * 1000),
+            "transactions": self.transactions,
+            "errors": self.errors,
+            "degraded": self.degraded,
+        }
@@ -0,0 +1,155 @@
+"""Single-flight deduplication of identical concurrent upstream requests.
+
+Identical requests that arrive while one is already in flight (client
+timeouts and retries, several agents starting with the same prompt) share the
+first request's upstream call instead of issuing their own:
+
+* non-streaming waiters await the leader's task and get the same response;
+* streaming waiters subscribe to a ``StreamBroadcaster`` that replays the
+  frames already sent and then follows the live stream.
+
+Entries only live while the upstream call is running; finished results are
+never served from here (that is the response cache's job).
+"""
+import asyncio
+import logging
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class StreamBroadcaster:
+    """Fan one SSE byte stream out to any number of subscribers.
+
+    A pump task drains the source into a frame log; each subscriber replays
+    the log from the start and then waits for new frames. The upstream stream
+    is closed early only when every subscriber has gone away.
+    """
+
+    def __init__(self, source: AsyncIterator[bytes], on_done: Optional[Callable[[], None]] = None):
+        self._source = source
+        self._on_done = on_done
+        self._frames: List[bytes] = []
+        self._new_frame = asyncio.Event()
+        self._subscribers = 0
+        self.done = False
+        self._pump_task = asyncio.ensure_future(self._pump())
+
+    async def _pump(self):
+        try:
+            async for frame in self._source:
+                self._frames.append(frame)
+                self._notify()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Shared stream source failed: {e}")
+        finally:
+            self.done = True
+            self._notify()
+            await self._source.aclose()
+            if self._on_done is not None:
+                self._on_done()
+
+    def _notify(self):
+        new_frame, self._new_frame = self._new_frame, asyncio.Event()
+        new_frame.set()
+
+    def subscribe(self) -> AsyncIterator[bytes]:
+        """Return an iterator over every frame of the stream, past and future."""
+        # Counted at subscription time so a slow first iteration cannot race a cancel
+        self._subscribers += 1
+        return self._follow()
+
+    async def _follow(self) -> AsyncIterator[bytes]:
+        position = 0
+        try:
+            while True:
+                if position < len(self._frames):
+                    end = len(self._frames)
+                    yield b"".join(self._frames[position:end])
+                    position = end
+                    continue
+                if self.done:
+                    break
+                await self._new_frame.wait()
+        finally:
+            self._subscribers -= 1
+            if not self._subscribers and not self.done:
+                self._pump_task.cancel()
+
+
+class SingleFlight:
+    """Registry of in-flight upstream calls keyed by request identity."""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self._streams: Dict[Hashable, Any] = {}
+        self.leaders = 0
+        self.shared_responses = 0
+        self.shared_streams = 0
+
+    async def run(self, key: Hashable, call: Callable[[], Awaitable[Any]]) -> Any:
+        """Await ``call()``, or the identical call that is already running."""
+        task = self._calls.get(key)
+        if task is None:
+            self.leaders += 1
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda finished: self._forget(self._calls, key, finished))
+        else:
+            self.shared_responses += 1
+        # Shielded so a disconnecting waiter does not cancel the call for the others
+        return await asyncio.shield(task)
+
+    async def join_stream(self, key: Hashable) -> Optional[StreamBroadcaster]:
+        """Return the broadcaster of an identical in-flight stream.
+
+        Returns None when there is none; the caller is then registered as the
+        leader and must end with ``publish_stream`` or ``abandon_stream``.
+        """
+        while True:
+            entry = self._streams.get(key)
+            if entry is None:
+                self._streams[key] = asyncio.get_running_loop().create_future()
+                self.leaders += 1
+                return None
+            if isinstance(entry, StreamBroadcaster):
+                self.shared_streams += 1
+                return entry
+            broadcaster = await asyncio.shield(entry)
+            if broadcaster is not None:
+                self.shared_streams += 1
+                return broadcaster
+            # The leader could not open a stream; try again (possibly as the new leader)
+
+    def publish_stream(self, key: Hashable, source: AsyncIterator[bytes]) -> StreamBroadcaster:
+        """Share the leader's SSE stream with current and future waiters."""
+        broadcaster = StreamBroadcaster(source, on_done=lambda: self._forget(self._streams, key, broadcaster))
+        pending = self._streams.get(key)
+        self._streams[key] = broadcaster
+        if isinstance(pending, asyncio.Future) and not pending.done():
+            pending.set_result(broadcaster)
+        return broadcaster
+
+    def abandon_stream(self, key: Hashable):
+        """Leader failed to open a stream: release the key and wake waiters."""
+        pending = self._streams.get(key)
+        if isinstance(pending, asyncio.Future):
+            del self._streams[key]
+            if not pending.done():
+                pending.set_result(None)
+
+    @staticmethod
+    def _forget(registry: Dict[Hashable, Any], key: Hashable, entry: Any):
+        if registry.get(key) is entry:
+            del registry[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": True,
+            "in_flight": len(self._calls) + len(self._streams),
+            "leaders": self.leaders,
+            "shared_responses": self.shared_responses,
+            "shared_streams": self.shared_streams,
+        }
@@ -0,0 +1,195 @@
+"""Anthropic SSE event encoding for the streaming path.
+
+Static frames (ping, message_stop, per-index content_block_start/stop) are
+rendered once and reused; per-token frames splice the escaped delta text into
+prebuilt byte templates instead of building and serializing a nested dict.
+Everything is returned as ``bytes`` so StreamingResponse can send it as-is.
+orjson is used for string escaping and dict encoding when it is installed.
+``DeltaCoalescer`` optionally merges small consecutive deltas into fewer events,
+and ``replay_message`` turns a finished message back into a stream.
+"""
+import json
+import time
+from functools import lru_cache
+from typing import Any, Dict, Iterator, Optional
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj: Any) -> bytes:
+    """Serialize ``obj`` to JSON bytes (orjson when available)."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+def encode_event(event_type: str, data: Dict[str, Any]) -> bytes:
+    """Encode an arbitrary SSE event."""
+    return b"event: " + event_type.encode("ascii") + b"\ndata: " + dumps(data) + b"\n\n"
+
+
+# Static frames, rendered once at import time
+PING = encode_event("ping", {"type": "ping"})
+MESSAGE_STOP = encode_event("message_stop", {"type": "message_stop"})
+
+_MESSAGE_START_PREFIX = b'event: message_start\ndata: {"type": "message_start", "message": {"id": '
+_MESSAGE_START_MODEL = b', "type": "message", "role": "assistant", "model": '
+_MESSAGE_START_MESSAGE_END = (
+    b', "content": [], "stop_reason": null, "stop_sequence": null, '
+    b'"usage": {"input_tokens": 0, "output_tokens": 0}}'
+)
+_MESSAGE_START_METADATA = b', "metadata": '
+_EVENT_END = b'}\n\n'
+
+_DELTA_PREFIX = b'event: content_block_delta\ndata: {"type": "content_block_delta", "index": '
+_TEXT_DELTA_MIDDLE = b', "delta": {"type": "text_delta", "text": '
+_INPUT_JSON_DELTA_MIDDLE = b', "delta": {"type": "input_json_delta", "partial_json": '
+_DELTA_SUFFIX = b'}}\n\n'
+
+_TOOL_START_PREFIX = b'event: content_block_start\ndata: {"type": "content_block_start", "index": '
+_TOOL_START_ID = b', "content_block": {"type": "tool_use", "id": '
+_TOOL_START_NAME = b', "name": '
+_TOOL_START_SUFFIX = b', "input": {}}}\n\n'
+
+_MESSAGE_DELTA_PREFIX = b'event: message_delta\ndata: {"type": "message_delta", "delta": {"stop_reason": '
+_MESSAGE_DELTA_USAGE = b', "stop_sequence": null}, "usage": '
+_MESSAGE_DELTA_SUFFIX = b'}\n\n'
+
+
+def message_start(message_id: str, model: str, metadata: Optional[Dict[str, Any]] = None) -> bytes:
+    """message_start frame; ``metadata`` (e.g. proxy phase timings) goes next to ``message``."""
+    frame = _MESSAGE_START_PREFIX + dumps(message_id) + _MESSAGE_START_MODEL + dumps(model) + _MESSAGE_START_MESSAGE_END
+    if metadata:
+        return frame + _MESSAGE_START_METADATA + dumps(metadata) + _EVENT_END
+    return frame + _EVENT_END
+
+
+@lru_cache(maxsize=64)
+def text_block_start(index: int) -> bytes:
+    return (b'event: content_block_start\ndata: {"type": "content_block_start", "index": %d, '
+            b'"content_block": {"type": "text", "text": ""}}\n\n' % index)
+
+
+@lru_cache(maxsize=64)
+def content_block_stop(index: int) -> bytes:
+    return b'event: content_block_stop\ndata: {"type": "content_block_stop", "index": %d}\n\n' % index
+
+
+@lru_cache(maxsize=64)
+def _index_bytes(index: int) -> bytes:
+    return b"%d" % index
+
+
+def text_delta(index: int, text: str) -> bytes:
+    return _DELTA_PREFIX + _index_bytes(index) + _TEXT_DELTA_MIDDLE + dumps(text) + _DELTA_SUFFIX
+
+
+def input_json_delta(index: int, partial_json: str) -> bytes:
+    return _DELTA_PREFIX + _index_bytes(index) + _INPUT_JSON_DELTA_MIDDLE + dumps(partial_json) + _DELTA_SUFFIX
+
+
+def tool_block_start(index: int, tool_id: str, name: str) -> bytes:
+    return (_TOOL_START_PREFIX + _index_bytes(index) + _TOOL_START_ID + dumps(tool_id)
+            + _TOOL_START_NAME + dumps(name) + _TOOL_START_SUFFIX)
+
+
+def message_delta(stop_reason: Optional[str], usage: Dict[str, Any]) -> bytes:
+    return _MESSAGE_DELTA_PREFIX + dumps(stop_reason) + _MESSAGE_DELTA_USAGE + dumps(usage) + _MESSAGE_DELTA_SUFFIX
+
+
+class DeltaCoalescer:
+    """Merge consecutive text / input_json deltas for the same block into one event.
+
+    Fragments are buffered until ``max_chars`` is reached or ``window`` seconds
+    have passed since the first buffered fragment. The stream handler calls
+    ``flush()`` before any other event and when ``time_left()`` runs out while
+    waiting for upstream, so buffering never delays text beyond the window.
+    A window of 0 disables coalescing: every delta is encoded immediately.
+    """
+
+    def __init__(self, window: float = 0.0, max_chars: int = 512):
+        self.window = window
+        self.max_chars = max_chars
+        self.enabled = window > 0
+        self._pieces = []
+        self._size = 0
+        self._index = 0
+        self._delta_type = None
+        self._started = 0.0
+        self.fragments_in = 0
+        self.events_out = 0
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._pieces)
+
+    def time_left(self) -> float:
+        """Seconds until the buffered fragments must be flushed."""
+        return max(0.0, self._started + self.window - time.monotonic())
+
+    @staticmethod
+    def _encode(delta_type: str, index: int, text: str) -> bytes:
+        if delta_type == "input_json_delta":
+            return input_json_delta(index, text)
+        return text_delta(index, text)
+
+    def add(self, index: int, delta_type: str, text: str) -> bytes:
+        """Buffer a delta; returns any frames that are ready to send (possibly b"")."""
+        self.fragments_in += 1
+        if not self.enabled:
+            self.events_out += 1
+            return self._encode(delta_type, index, text)
+
+        frames = b""
+        if self._pieces and (index != self._index or delta_type != self._delta_type):
+            frames = self.flush()
+        if not self._pieces:
+            self._index = index
+            self._delta_type = delta_type
+            self._started = time.monotonic()
+        self._pieces.append(text)
+        self._size += len(text)
+
+        if self._size >= self.max_chars or time.monotonic() - self._started >= self.window:
+            frames += self.flush()
+        return frames
+
+    def flush(self) -> bytes:
+        """Encode and clear the buffered fragments (b"" when nothing is buffered)."""
+        if not self._pieces:
+            return b""
+        text = self._pieces[0] if len(self._pieces) == 1 else "".join(self._pieces)
+        self._pieces = []
+        self._size = 0
+        self.events_out += 1
+        return self._encode(self._delta_type, self._index, text)
+
+
+def replay_message(response: Dict[str, Any]) -> Iterator[bytes]:
+    """Re-emit a complete Anthropic message (e.g. a cached response) as an SSE stream.
+
+    Mirrors the live stream layout: text always goes to block 0, tool_use blocks
+    follow, each with its input sent as a single input_json_delta.
+    """
+    yield message_start(response["id"], response["model"])
+    yield text_block_start(0)
+    text = "".join(block["text"] for block in response["content"] if block["type"] == "text")
+    if text:
+        yield text_delta(0, text)
+    yield content_block_stop(0)
+
+    index = 0
+    for block in response["content"]:
+        if block["type"] != "tool_use":
+            continue
+        index += 1
+        yield tool_block_start(index, block["id"], block["name"])
+        yield input_json_delta(index, json.dumps(block["input"]))
+        yield content_block_stop(index)
+
+    usage = {key: value for key, value in response["usage"].items() if value or key in ("input_tokens", "output_tokens")}
+    yield message_delta(response.get("stop_reason"), usage)
+    yield MESSAGE_STOP
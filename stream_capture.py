@@ -0,0 +1,271 @@
+"""Record-and-replay of upstream streams.
+
+Capture (STREAM_CAPTURE_DIR): every streamed response is written to one
+gzip-compressed JSON-lines file holding
+
+* a header: format version, capture time, engine, mapped model, stream
+  settings and the originating Anthropic request;
+* ``["u", offset, kind, payload]`` for each upstream chunk exactly as the
+  stream handler received it (``d`` dict, ``s`` raw string fragment, ``o``
+  engine object dumped to a dict, ``e`` mid-stream error, ``end``);
+* ``["d", offset, frame]`` for each SSE frame the proxy sent downstream.
+
+Offsets are seconds since the upstream stream opened. Replay
+(UPSTREAM_ENGINE=replay) serves recordings as the upstream instead of Gemini,
+at recorded speed, scaled, or as fast as possible, so production traffic
+shapes can be load-tested offline and benchmarks/replay_streams.py can check
+that the SSE output is unchanged byte for byte.
+"""
+import asyncio
+import glob
+import gzip
+import json
+import logging
+import os
+import random
+import time
+import uuid
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+from cache_utils import fingerprint
+
+logger = logging.getLogger(__name__)
+
+CAPTURE_VERSION = 1
+CAPTURE_SUFFIX = ".jsonl.gz"
+
+
+def request_fingerprint(request_data: Dict[str, Any]) -> str:
+    """Identity of a request for matching it against recordings (conversation, tools, system)."""
+    return fingerprint({key: request_data.get(key) for key in ("messages", "system", "tools")})
+
+
+def _dumps(obj: Any) -> str:
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False, default=str)
+
+
+def encode_chunk(chunk: Any) -> List[Any]:
+    if isinstance(chunk, dict):
+        return ["d", chunk]
+    if isinstance(chunk, str):
+        return ["s", chunk]
+    # Engine objects (LiteLLM stream chunks) replay as the equivalent dict; unset fields are dropped
+    data = chunk.model_dump() if hasattr(chunk, "model_dump") else dict(chunk)
+    return ["o", {key: value for key, value in data.items() if value is not None}]
+
+
+def replay_error(error_type: str, message: str) -> Exception:
+    """Rebuild a recorded mid-stream error with the class family the stream handler distinguishes."""
+    if error_type in ("APIConnectionError", "RuntimeError"):
+        return RuntimeError(message)
+    if error_type in ("JSONDecodeError", "ValueError"):
+        return ValueError(message)
+    return Exception(message)
+
+
+class CapturedUpstream:
+    """Pass-through async iterator that records every chunk and error it relays.
+
+    Class-based on purpose: an upstream (e.g. LiteLLM's stream wrapper) may keep
+    producing chunks after raising a per-chunk error, which an async generator
+    could not relay.
+    """
+
+    def __init__(self, capture: "StreamCapture", iterator: AsyncIterator[Any]):
+        self._capture = capture
+        self._source = iterator
+        self._iterator = iterator.__aiter__()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            chunk = await self._iterator.__anext__()
+        except StopAsyncIteration:
+            self._capture.add_upstream("end")
+            raise
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self._capture.add_upstream("e", [type(e).__name__, str(e)])
+            raise
+        self._capture.add_upstream(*encode_chunk(chunk))
+        return chunk
+
+    async def aclose(self):
+        aclose = getattr(self._source, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+
+class StreamCapture:
+    """One stream being recorded; written to disk when the downstream SSE stream ends."""
+
+    def __init__(self, directory: str, header: Dict[str, Any]):
+        self.path = os.path.join(
+            directory, f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}{CAPTURE_SUFFIX}"
+        )
+        self.header = header
+        self.started = time.monotonic()
+        self.events: List[List[Any]] = []
+        self.saved = False
+
+    def _offset(self) -> float:
+        return round(time.monotonic() - self.started, 6)
+
+    def add_upstream(self, kind: str, payload: Any = None):
+        self.events.append(["u", self._offset(), kind, payload])
+
+    def upstream(self, iterator: AsyncIterator[Any]) -> CapturedUpstream:
+        return CapturedUpstream(self, iterator)
+
+    async def downstream(self, sse_stream: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        complete = False
+        try:
+            async for frame in sse_stream:
+                self.events.append(["d", self._offset(), frame.decode("utf-8") if isinstance(frame, bytes) else frame])
+                yield frame
+            complete = True
+        finally:
+            self.save(complete)
+
+    def save(self, complete: bool):
+        if self.saved:
+            return
+        self.saved = True
+        try:
+            with gzip.open(self.path, "wt", encoding="utf-8") as f:
+                f.write(_dumps({**self.header, "complete": complete}) + "\n")
+                for event in self.events:
+                    f.write(_dumps(event) + "\n")
+        except OSError as e:
+            logger.warning(f"Failed to write stream capture {self.path}: {e}")
+
+
+class StreamCapturer:
+    """Decides which streams to record (STREAM_CAPTURE_SAMPLE_RATE) and where."""
+
+    def __init__(self, directory: str, sample_rate: float = 1.0):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        os.makedirs(directory, exist_ok=True)
+        self.started = 0
+        self.skipped = 0
+
+    def start(self, request_data: Dict[str, Any], model: str, engine: str,
+              cache_creation_tokens: int = 0, settings: Optional[Dict[str, Any]] = None) -> Optional[StreamCapture]:
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            self.skipped += 1
+            return None
+        self.started += 1
+        return StreamCapture(self.directory, {
+            "version": CAPTURE_VERSION,
+            "captured_at": datetime.now(timezone.utc).isoformat(),
+            "engine": engine,
+            "model": model,
+            "cache_creation_tokens": cache_creation_tokens,
+            "settings": settings or {},
+            "request": request_data,
+        })
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": True, "directory": self.directory, "sample_rate": self.sample_rate,
+                "captured": self.started, "skipped": self.skipped}
+
+
+class Recording:
+    """A capture file loaded back into memory."""
+
+    def __init__(self, path: str):
+        self.path = path
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            self.header = json.loads(f.readline())
+            events = [json.loads(line) for line in f if line.strip()]
+        if self.header.get("version") != CAPTURE_VERSION:
+            raise ValueError(f"{path}: unsupported capture version {self.header.get('version')}")
+        self.upstream = [event[1:] for event in events if event[0] == "u"]
+        self.downstream = [event[2] for event in events if event[0] == "d"]
+
+    @property
+    def request(self) -> Dict[str, Any]:
+        return self.header["request"]
+
+    @property
+    def sse_output(self) -> str:
+        return "".join(self.downstream)
+
+    def replay(self, speed: float = 0.0) -> "ReplayStream":
+        return ReplayStream(self.upstream, speed)
+
+
+class ReplayStream:
+    """Serves recorded upstream events; ``speed`` 1 is recorded timing, 2 twice as fast, 0 no waiting."""
+
+    def __init__(self, events: List[List[Any]], speed: float = 0.0):
+        self._events = events
+        self._speed = speed
+        self._index = 0
+        self._started = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._index >= len(self._events):
+            raise StopAsyncIteration
+        offset, kind, payload = self._events[self._index]
+        self._index += 1
+        if self._speed > 0:
+            if self._started is None:
+                self._started = time.monotonic() - offset / self._speed
+            delay = self._started + offset / self._speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        if kind == "end":
+            self._index = len(self._events)
+            raise StopAsyncIteration
+        if kind == "e":
+            raise replay_error(*payload)
+        return payload
+
+    async def aclose(self):
+        self._index = len(self._events)
+
+
+class StreamReplayer:
+    """Replay upstream: answers a request with its own recording, or the next one round-robin."""
+
+    def __init__(self, directory: str, speed: float = 1.0):
+        self.directory = directory
+        self.speed = speed
+        self.recordings: List[Recording] = []
+        for path in sorted(glob.glob(os.path.join(directory, f"*{CAPTURE_SUFFIX}"))):
+            try:
+                self.recordings.append(Recording(path))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable stream capture {path}: {e}")
+        if not self.recordings:
+            raise ValueError(f"No stream captures (*{CAPTURE_SUFFIX}) found in {directory}")
+        self.by_fingerprint = {request_fingerprint(recording.request): recording for recording in self.recordings}
+        self._next = 0
+        self.served = 0
+        self.matched = 0
+
+    def recording_for(self, request_data: Dict[str, Any]) -> Recording:
+        self.served += 1
+        recording = self.by_fingerprint.get(request_fingerprint(request_data))
+        if recording is not None:
+            self.matched += 1
+            return recording
+        recording = self.recordings[self._next % len(self.recordings)]
+        self._next += 1
+        return recording
+
+    def open(self, request_data: Dict[str, Any]) -> ReplayStream:
+        return self.recording_for(request_data).replay(self.speed)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": True, "directory": self.directory, "speed": self.speed,
+                "recordings": len(self.recordings), "served": self.served, "matched": self.matched}
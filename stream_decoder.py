@@ -0,0 +1,106 @@
+"""Incremental JSON object decoder for fragmented upstream stream chunks.
+
+Upstream streams sometimes deliver raw string fragments instead of parsed
+chunks (a JSON object split across several reads, several objects glued into
+one read, SSE ``data:`` prefixes, array brackets and commas between objects).
+``IncrementalJSONDecoder`` keeps its brace depth and string/escape state between
+feeds, so every character is scanned exactly once no matter how the stream is
+split, and there is no buffer size cutoff.
+"""
+import json
+import re
+from typing import Any, List, Optional
+
+# Characters that matter outside / inside a JSON string
+_STRUCTURAL = re.compile(r'[{}"]')
+_STRING_SPECIAL = re.compile(r'["\\]')
+
+
+class IncrementalJSONDecoder:
+    """Extract complete top-level JSON objects from a stream of text fragments."""
+
+    def __init__(self):
+        self._pieces: List[str] = []  # fragments of the object currently being scanned
+        self._depth = 0
+        self._in_string = False
+        self._escape_pending = False  # previous fragment ended on a backslash inside a string
+        self.objects_decoded = 0
+        self.malformed_count = 0
+
+    @property
+    def pending(self) -> int:
+        """Number of buffered characters belonging to an incomplete object."""
+        return sum(len(piece) for piece in self._pieces)
+
+    def reset(self):
+        self._pieces = []
+        self._depth = 0
+        self._in_string = False
+        self._escape_pending = False
+
+    def feed(self, text: str) -> List[Any]:
+        """Scan ``text`` and return every JSON object completed by it, in order."""
+        objects = []
+        pos = 0
+        end = len(text)
+        # Start of the current object's segment within ``text``
+        segment_start: Optional[int] = 0 if self._depth else None
+
+        if self._escape_pending and end:
+            self._escape_pending = False
+            pos = 1
+
+        while pos < end:
+            if not self._depth:
+                # Between objects: skip prefixes, whitespace, commas and brackets
+                start = text.find("{", pos)
+                if start == -1:
+                    break
+                segment_start = start
+                self._depth = 1
+                pos = start + 1
+                continue
+
+            if self._in_string:
+                match = _STRING_SPECIAL.search(text, pos)
+                if match is None:
+                    pos = end
+                    break
+                if match.group() == "\\":
+                    if match.end() >= end:
+                        self._escape_pending = True
+                        pos = end
+                        break
+                    pos = match.end() + 1
+                    continue
+                self._in_string = False
+                pos = match.end()
+                continue
+
+            match = _STRUCTURAL.search(text, pos)
+            if match is None:
+                pos = end
+                break
+            char = match.group()
+            pos = match.end()
+            if char == '"':
+                self._in_string = True
+            elif char == "{":
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if not self._depth:
+                    self._pieces.append(text[segment_start:pos])
+                    json_str = "".join(self._pieces)
+                    self._pieces = []
+                    segment_start = None
+                    try:
+                        objects.append(json.loads(json_str))
+                        self.objects_decoded += 1
+                    except json.JSONDecodeError:
+                        self.malformed_count += 1
+
+        if self._depth and segment_start is not None:
+            self._pieces.append(text[segment_start:])
+
+        return objects
@@ -0,0 +1,57 @@
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import server
+from gemini_native import gemini_stream_event_to_chunk
+
+
+def stream_stop_reason(events):
+    async def chunks():
+        for event in events:
+            yield gemini_stream_event_to_chunk(event)
+
+    async def collect():
+        request = server.MessagesRequest(model="claude-3-haiku", max_tokens=16,
+                                         messages=[{"role": "user", "content": "hi"}])
+        return [frame async for frame in server.handle_streaming_with_recovery(chunks(), request)]
+
+    frames = b"".join(asyncio.run(collect())).decode()
+    for line in frames.splitlines():
+        if line.startswith("data: ") and '"message_delta"' in line:
+            return json.loads(line[len("data: "):])["delta"]["stop_reason"]
+    raise AssertionError("no message_delta event in stream")
+
+
+def function_call_event(finish_reason=None):
+    candidate = {"content": {"role": "model", "parts": [{"functionCall": {"name": "Read", "args": {"path": "a.py"}}}]}}
+    if finish_reason:
+        candidate["finishReason"] = finish_reason
+    return {"candidates": [candidate]}
+
+
+def test_tool_use_when_function_call_and_finish_reason_share_an_event():
+    assert stream_stop_reason([function_call_event("STOP")]) == "tool_use"
+
+
+def test_tool_use_when_finish_reason_arrives_in_a_later_event():
+    events = [
+        function_call_event(),
+        {"candidates": [{"content": {"role": "model", "parts": [{"text": ""}]}, "finishReason": "STOP"}],
+         "usageMetadata": {"promptTokenCount": 12, "candidatesTokenCount": 5}},
+    ]
+    assert stream_stop_reason(events) == "tool_use"
+
+
+def test_end_turn_without_tool_calls():
+    events = [{"candidates": [{"content": {"role": "model", "parts": [{"text": "Hello"}]}, "finishReason": "STOP"}]}]
+    assert stream_stop_reason(events) == "end_turn"
+
+
+def test_max_tokens_wins_over_tool_calls():
+    events = [function_call_event(), {"candidates": [{"finishReason": "MAX_TOKENS"}]}]
+    assert stream_stop_reason(events) == "max_tokens"
@@ -0,0 +1,126 @@
+"""Cached, non-blocking token counting for /v1/messages/count_tokens.
+
+Claude Code calls count_tokens with the full conversation on almost every
+turn. Tokenizing that history with ``litellm.token_counter`` on the event loop
+stalls every in-flight stream, so this engine:
+
+* keeps token counts per message and per tool set in an LRU keyed by content,
+  so a new turn only tokenizes the newly appended messages;
+* runs any tokenization that is still needed in a small thread pool;
+* optionally ("exact" mode) asks Gemini ``countTokens`` for the whole request
+  and stores that answer in the same cache.
+
+Message conversion stays in server.py; callers hand in a cache key and a
+zero-argument callable that produces the LiteLLM-format messages for it.
+"""
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+
+import litellm
+
+from cache_utils import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# litellm.token_counter adds this many "reply priming" tokens once per call
+REPLY_PRIMING_TOKENS = 3
+
+# Tool overhead is measured against a one-message base conversation
+_TOOL_BASE_MESSAGES = [{"role": "system", "content": ""}]
+
+MessageItem = Tuple[Hashable, Callable[[], List[Dict[str, Any]]]]
+
+
+class TokenCounter:
+    """Per-message token count cache with thread-pool offload and optional exact counting."""
+
+    def __init__(self, cache_size: int = 50000, max_workers: int = 4):
+        self.cache = LRUCache(cache_size)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="token-count")
+        self.offloaded = 0
+        self.exact_calls = 0
+        self.exact_failures = 0
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def _count_messages(model: str, messages: List[Dict[str, Any]]) -> int:
+        if not messages:
+            return 0
+        return litellm.token_counter(model=model, messages=messages) - REPLY_PRIMING_TOKENS
+
+    @staticmethod
+    def _count_tools(model: str, tools: List[Dict[str, Any]]) -> int:
+        if not tools:
+            return 0
+        base = litellm.token_counter(model=model, messages=_TOOL_BASE_MESSAGES)
+        return litellm.token_counter(model=model, messages=_TOOL_BASE_MESSAGES, tools=tools) - base
+
+    def _tokenize(self, model: str, missing: List[MessageItem],
+                  tools_item: Optional[MessageItem]) -> Dict[Hashable, int]:
+        """Thread-pool side: convert and tokenize everything that missed the cache."""
+        counts = {}
+        for key, build_messages in missing:
+            counts[key] = self._count_messages(model, build_messages())
+        if tools_item is not None:
+            key, build_tools = tools_item
+            counts[key] = self._count_tools(model, build_tools())
+        return counts
+
+    async def count(self, model: str, items: List[MessageItem],
+                    tools_item: Optional[MessageItem] = None) -> int:
+        """Estimate the prompt tokens of ``items`` (system + messages) and the tool set."""
+        total = REPLY_PRIMING_TOKENS
+        missing = []
+        for key, build_messages in items:
+            cached = self.cache.get((model, key))
+            if cached is None:
+                missing.append((key, build_messages))
+            else:
+                total += cached
+
+        pending_tools = None
+        if tools_item is not None:
+            cached = self.cache.get((model, tools_item[0]))
+            if cached is None:
+                pending_tools = tools_item
+            else:
+                total += cached
+
+        if missing or pending_tools is not None:
+            self.offloaded += 1
+            loop = asyncio.get_running_loop()
+            counts = await loop.run_in_executor(self.executor, self._tokenize, model, missing, pending_tools)
+            for key, count in counts.items():
+                self.cache.set((model, key), count)
+                total += count
+        return total
+
+    async def count_exact(self, model: str, key: Hashable, fetch: Callable[[], Awaitable[int]],
+                          fallback: Callable[[], Awaitable[int]]) -> int:
+        """Whole-request count from Gemini countTokens, cached by ``key``; ``fallback`` on API errors."""
+        cache_key = ("exact", model, key)
+        cached = self.cache.get(cache_key)
+        if cached is not None:
+            return cached
+        try:
+            self.exact_calls += 1
+            count = await fetch()
+        except Exception as e:
+            self.exact_failures += 1
+            logger.warning(f"Gemini countTokens failed, using local estimate: {e}")
+            return await fallback()
+        self.cache.set(cache_key, count)
+        return count
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.cache.stats()
+        stats.update({
+            "offloaded_batches": self.offloaded,
+            "exact_calls": self.exact_calls,
+            "exact_failures": self.exact_failures,
+        })
+        return stats
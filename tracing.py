@@ -0,0 +1,235 @@
+"""Per-request phase timing and trace spans.
+
+A ``RequestTimer`` lives in a context variable for the duration of one
+request. Code anywhere below the endpoint records phases with
+``with phase("convert_request"):``, which is a no-op outside a request. The
+phases are reported as a ``Server-Timing`` header, and finished requests can
+be exported as spans: one server span per request with a child span per
+phase, in the OpenTelemetry (OTLP/JSON) shape. Exporters:
+
+* ``memory``: the most recent spans, kept in a ring buffer;
+* ``file``: one OTLP/JSON span object per line, appended to a file;
+* ``otel``: handed to the OpenTelemetry SDK's global tracer provider (needs
+  the ``opentelemetry-api`` / ``opentelemetry-sdk`` packages).
+
+An incoming W3C ``traceparent`` header makes the request span a child of the
+caller's span.
+"""
+import contextvars
+import json
+import logging
+import re
+import secrets
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+_TRACEPARENT_RE = re.compile(r"^[0-9a-f]{2}-([0-9a-f]{32})-([0-9a-f]{16})-[0-9a-f]{2}$")
+
+_current_timer: contextvars.ContextVar[Optional["RequestTimer"]] = contextvars.ContextVar("request_timer", default=None)
+
+
+class RequestTimer:
+    """Phases of one request as (name, start, end) on the monotonic clock."""
+
+    def __init__(self, name: str, traceparent: Optional[str] = None):
+        self.name = name
+        self.start = time.monotonic()
+        self.start_unix_ns = time.time_ns()
+        self.end: Optional[float] = None
+        self.phases: List[Tuple[str, float, float]] = []
+        self.attributes: Dict[str, Any] = {}
+        self.trace_id = secrets.token_hex(16)
+        self.parent_span_id = ""
+        match = _TRACEPARENT_RE.match((traceparent or "").strip().lower())
+        if match:
+            self.trace_id, self.parent_span_id = match.groups()
+
+    def record(self, name: str, start: float, end: Optional[float] = None):
+        self.phases.append((name, start, time.monotonic() if end is None else end))
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(name, start)
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.monotonic()
+
+    def durations_ms(self) -> Dict[str, float]:
+        """Milliseconds per phase name (repeated phases, e.g. retries, are summed) plus the total so far."""
+        durations: Dict[str, float] = {}
+        for name, start, end in self.phases:
+            durations[name] = durations.get(name, 0.0) + (end - start) * 1000
+        end = self.end if self.end is not None else time.monotonic()
+        durations["total"] = (end - self.start) * 1000
+        return {name: round(ms, 1) for name, ms in durations.items()}
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={ms}" for name, ms in self.durations_ms().items())
+
+    def _unix_ns(self, monotonic: float) -> int:
+        return self.start_unix_ns + int((monotonic - self.start) * 1e9)
+
+    def to_spans(self) -> List[Dict[str, Any]]:
+        """The request as OTLP/JSON span objects: the server span first, then one per phase."""
+        root_id = secrets.token_hex(8)
+        end = self.end if self.end is not None else time.monotonic()
+        spans = [_span(self.trace_id, root_id, self.parent_span_id, self.name, "SPAN_KIND_SERVER",
+                       self.start_unix_ns, self._unix_ns(end), self.attributes)]
+        for name, start, phase_end in self.phases:
+            spans.append(_span(self.trace_id, secrets.token_hex(8), root_id, name, "SPAN_KIND_INTERNAL",
+                               self._unix_ns(start), self._unix_ns(phase_end), {}))
+        return spans
+
+
+def _attribute_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _span(trace_id: str, span_id: str, parent_span_id: str, name: str, kind: str,
+          start_ns: int, end_ns: int, attributes: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "parentSpanId": parent_span_id,
+        "name": name,
+        "kind": kind,
+        "startTimeUnixNano": str(start_ns),
+        "endTimeUnixNano": str(end_ns),
+        "attributes": [{"key": key, "value": _attribute_value(value)} for key, value in attributes.items()],
+    }
+
+
+def start_request(name: str, traceparent: Optional[str] = None) -> Tuple[RequestTimer, contextvars.Token]:
+    timer = RequestTimer(name, traceparent)
+    return timer, _current_timer.set(timer)
+
+
+def end_request(token: contextvars.Token):
+    _current_timer.reset(token)
+
+
+def current_timer() -> Optional[RequestTimer]:
+    return _current_timer.get()
+
+
+@contextmanager
+def phase(name: str) -> Iterator[None]:
+    """Time a phase of the current request (no-op outside a request)."""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    with timer.phase(name):
+        yield
+
+
+class InMemorySpanExporter:
+    """Keeps the spans of the most recent requests."""
+
+    def __init__(self, max_spans: int = 1000):
+        self.spans: Deque[Dict[str, Any]] = deque(maxlen=max_spans)
+        self.exported = 0
+
+    def export(self, timer: RequestTimer):
+        self.spans.extend(timer.to_spans())
+        self.exported += 1
+
+    def get_spans(self) -> List[Dict[str, Any]]:
+        return list(self.spans)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": True, "exporter": "memory", "requests_exported": self.exported, "spans_held": len(self.spans)}
+
+
+class FileSpanExporter:
+    """Appends one OTLP/JSON span per line to ``path``."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, "a", encoding="utf-8")
+        self.exported = 0
+
+    def export(self, timer: RequestTimer):
+        lines = "".join(json.dumps(span, separators=(",", ":")) + "\n" for span in timer.to_spans())
+        with self._lock:
+            self._file.write(lines)
+            self._file.flush()
+        self.exported += 1
+
+    def get_spans(self) -> List[Dict[str, Any]]:
+        return []
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": True, "exporter": "file", "path": self.path, "requests_exported": self.exported}
+
+
+class OpenTelemetrySpanExporter:
+    """Replays finished requests as spans on the OpenTelemetry global tracer."""
+
+    def __init__(self):
+        self.tracer = otel_trace.get_tracer("gemini-claude-proxy")
+        self.exported = 0
+
+    def export(self, timer: RequestTimer):
+        context = None
+        if timer.parent_span_id:
+            parent = otel_trace.SpanContext(
+                trace_id=int(timer.trace_id, 16), span_id=int(timer.parent_span_id, 16),
+                is_remote=True, trace_flags=otel_trace.TraceFlags(otel_trace.TraceFlags.SAMPLED)
+            )
+            context = otel_trace.set_span_in_context(otel_trace.NonRecordingSpan(parent))
+        end = timer.end if timer.end is not None else time.monotonic()
+        root = self.tracer.start_span(timer.name, context=context, kind=otel_trace.SpanKind.SERVER,
+                                      start_time=timer.start_unix_ns, attributes=dict(timer.attributes))
+        child_context = otel_trace.set_span_in_context(root)
+        for name, start, phase_end in timer.phases:
+            span = self.tracer.start_span(name, context=child_context, start_time=timer._unix_ns(start))
+            span.end(end_time=timer._unix_ns(phase_end))
+        root.end(end_time=timer._unix_ns(end))
+        self.exported += 1
+
+    def get_spans(self) -> List[Dict[str, Any]]:
+        return []
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": True, "exporter": "otel", "requests_exported": self.exported}
+
+
+def create_exporter(kind: str, file_path: str = "traces.jsonl", max_spans: int = 1000):
+    """Exporter for TRACE_EXPORTER (memory, file or otel); None when tracing is off."""
+    if kind == "memory":
+        return InMemorySpanExporter(max_spans)
+    if kind == "file":
+        return FileSpanExporter(file_path)
+    if kind == "otel":
+        if otel_trace is None:
+            logger.warning("TRACE_EXPORTER=otel requested but 'opentelemetry-api' is not installed, tracing disabled")
+            return None
+        return OpenTelemetrySpanExporter()
+    return None
@@ -0,0 +1,146 @@
+"""Multi-process serving (WORKERS > 1).
+
+One event loop is the proxy's CPU ceiling, so with WORKERS > 1 ``python
+server.py`` becomes a small supervisor that starts that many worker
+processes, each running the whole proxy with its own event loop, and
+restarts any that exit. Workers are started as fresh interpreters (not
+forked from the supervisor) so each one builds its state once, at import.
+
+Connections are spread over the workers in one of two ways:
+
+* ``reuseport``: every worker binds its own listening socket with
+  ``SO_REUSEPORT`` and the kernel balances new connections across them
+  (Linux);
+* ``prefork``: the supervisor binds one socket and the workers inherit it
+  and accept from it in turn (any POSIX system).
+
+State that must hold across workers (rate limits, key cooldowns, the retry
+budget, metrics) goes through ``shared_state.SharedState``.
+"""
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import uvicorn
+
+# Set by the supervisor in each worker's environment
+WORKER_ID_ENV = "PROXY_WORKER_ID"
+WORKER_FD_ENV = "PROXY_WORKER_FD"
+
+# Restart delay after a worker exits, doubled while it keeps exiting soon after start
+RESTART_DELAY_SECONDS = 1.0
+MAX_RESTART_DELAY_SECONDS = 30.0
+STABLE_AFTER_SECONDS = 30.0
+
+# How long stopping workers get to finish their in-flight requests
+GRACEFUL_TIMEOUT_SECONDS = 30.0
+
+
+def reuseport_supported() -> bool:
+    """SO_REUSEPORT with kernel load balancing (Linux); BSD/macOS accept the option but do not balance."""
+    return hasattr(socket, "SO_REUSEPORT") and sys.platform.startswith("linux")
+
+
+def default_mode() -> str:
+    return "reuseport" if reuseport_supported() else "prefork"
+
+
+def bind_socket(host: str, port: int, reuseport: bool = False) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    return sock
+
+
+def serve_worker(app, host: str, port: int, log_level: str):
+    """Run one worker: uvicorn on the inherited socket (prefork) or on its own SO_REUSEPORT socket."""
+    fd = os.environ.get(WORKER_FD_ENV)
+    sock = socket.socket(fileno=int(fd)) if fd else bind_socket(host, port, reuseport=True)
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_level=log_level))
+    server.run(sockets=[sock])
+
+
+class WorkerSupervisor:
+    """Starts ``workers`` copies of ``command``, restarts them when they exit, stops them on SIGINT/SIGTERM."""
+
+    def __init__(self, command: List[str], workers: int, mode: str, host: str, port: int):
+        self.command = command
+        self.workers = workers
+        self.mode = mode
+        self.host = host
+        self.port = port
+        self.processes: Dict[int, subprocess.Popen] = {}
+        self._started_at: Dict[int, float] = {}
+        self._restart_delay: Dict[int, float] = {}
+        self._restart_at: Dict[int, float] = {}
+        self._socket: Optional[socket.socket] = None
+        self._stopping = False
+        self.restarts = 0
+
+    def _spawn(self, slot: int):
+        env = {**os.environ, WORKER_ID_ENV: str(slot)}
+        pass_fds = ()
+        if self._socket is not None:
+            env[WORKER_FD_ENV] = str(self._socket.fileno())
+            pass_fds = (self._socket.fileno(),)
+        self.processes[slot] = subprocess.Popen(self.command, env=env, pass_fds=pass_fds)
+        self._started_at[slot] = time.monotonic()
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _check(self, slot: int, now: float):
+        process = self.processes[slot]
+        if process.poll() is None:
+            return
+        restart_at = self._restart_at.get(slot)
+        if restart_at is None:
+            delay = RESTART_DELAY_SECONDS
+            if now - self._started_at[slot] < STABLE_AFTER_SECONDS:
+                delay = min(self._restart_delay.get(slot, RESTART_DELAY_SECONDS / 2) * 2, MAX_RESTART_DELAY_SECONDS)
+            self._restart_delay[slot] = delay
+            self._restart_at[slot] = now + delay
+            print(f"⚠️ Worker {slot} (pid {process.pid}) exited with code {process.returncode}, restarting in {delay:.0f}s")
+        elif now >= restart_at:
+            del self._restart_at[slot]
+            self.restarts += 1
+            self._spawn(slot)
+
+    def run(self) -> int:
+        if self.mode == "prefork":
+            self._socket = bind_socket(self.host, self.port)
+            self._socket.listen(2048)
+            self._socket.set_inheritable(True)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGTERM, self._stop)
+        for slot in range(self.workers):
+            self._spawn(slot)
+        print(f"👷 Supervisor pid {os.getpid()} started {self.workers} workers ({self.mode}) on {self.host}:{self.port}")
+
+        while not self._stopping:
+            now = time.monotonic()
+            for slot in range(self.workers):
+                self._check(slot, now)
+            time.sleep(0.5)
+
+        print("👷 Stopping workers")
+        for process in self.processes.values():
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT_SECONDS
+        for process in self.processes.values():
+            try:
+                process.wait(timeout=max(deadline - time.monotonic(), 0.1))
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        if self._socket is not None:
+            self._socket.close()
+        return 0